@@ -0,0 +1,93 @@
+# !python3
+#
+# Arrival processes for the messages published by devices.
+#
+# By default, every device publishes once per period, and all devices
+# publish at the same instants. An arrival process instead gives each
+# device its own schedule of publish times. The schedules of all devices
+# are computed up front, as a NumPy array of shape (num_devices, count),
+# so generating them costs little even for very large fleets.
+#
+# The processes are:
+#	"periodic": once every <period> seconds
+#	"poisson":  a Poisson process with <rate> messages per second
+#	"on_off":   bursty traffic. Messages arrive at <rate> per second during
+#	            ON periods, which alternate with OFF periods (no messages).
+#	            ON and OFF periods last <mean_on> and <mean_off> seconds
+#	            on average (exponentially distributed).
+#	"diurnal":  a Poisson process whose rate follows a daily cycle, with
+#	            mean <rate>, period <day_length> seconds, the highest rate at
+#	            <peak_time> and a ratio <peak_to_trough> between the highest
+#	            and lowest rates.
+#
+# For all processes, each device's schedule can be shifted by a random
+# phase offset (uniform in [0, <phase>) seconds) and each publish time by
+# a random jitter (normal, with standard deviation <jitter> seconds).
+# Periodic schedules get a random phase of up to one period by default,
+# so that devices do not publish in lockstep.
+#
+# Usage:
+#	times = schedule("poisson", num_devices, count=10, rate=2.0, seed=1)
+#	SimpleDevice(env, ID, apikey, publish_times=times[i])
+#
+# Requires NumPy.
+
+from __future__ import print_function
+import numpy as np
+import logging
+logger = logging.getLogger(__name__)
+
+
+def periodic(n, count, rng, period=1.0):
+	return np.tile(np.arange(count) * float(period), (n, 1))
+
+def poisson(n, count, rng, rate=1.0):
+	assert(rate > 0)
+	return np.cumsum(rng.exponential(1.0 / rate, (n, count)), axis=1)
+
+def on_off(n, count, rng, rate=10.0, mean_on=1.0, mean_off=5.0):
+	assert(rate > 0 and mean_on > 0 and mean_off >= 0)
+	# The ON periods are memoryless, so after each message, the ON
+	# period ends (before the next message) with probability q.
+	# An OFF period then adds an exponential gap.
+	q = 1.0 / (1.0 + rate * mean_on)
+	gaps = rng.exponential(1.0 / rate, (n, count))
+	off = rng.random((n, count)) < q
+	gaps[off] += rng.exponential(mean_off, int(off.sum())) if mean_off > 0 else 0
+	return np.cumsum(gaps, axis=1)
+
+def diurnal(n, count, rng, rate=1.0, day_length=86400.0, peak_time=None, peak_to_trough=4.0):
+	assert(rate > 0 and day_length > 0 and peak_to_trough >= 1)
+	if peak_time is None:
+		peak_time = day_length / 2.0
+	a = (peak_to_trough - 1.0) / (peak_to_trough + 1.0)
+	w = 2 * np.pi / day_length
+	# cumulative intensity of the rate(t) = rate*(1 + a*cos(w*(t - peak_time)))
+	def cumulative(t):
+		return rate * (t + a / w * (np.sin(w * (t - peak_time)) + np.sin(w * peak_time)))
+	# unit-rate arrivals, mapped through the inverse of the cumulative intensity
+	u = np.cumsum(rng.exponential(1.0, (n, count)), axis=1)
+	t_max = u.max() / (rate * (1 - a)) + day_length
+	grid = np.linspace(0, t_max, 100001)
+	return np.interp(u, cumulative(grid), grid)
+
+PROCESSES = {"periodic": periodic, "poisson": poisson, "on_off": on_off, "diurnal": diurnal}
+
+
+def schedule(process, n, count, phase=None, jitter=0.0, seed=None, **params):
+	""" Publish times (in seconds from the start) for <count> messages from
+	each of <n> devices, as an array of shape (n, count). <params> are
+	the parameters of the arrival process (see above)."""
+	assert(process in PROCESSES), "Invalid arrival process {}".format(process)
+	assert(n > 0 and count > 0)
+	rng = np.random.default_rng(seed)
+	times = PROCESSES[process](n, count, rng, **params)
+	if phase is None:
+		phase = params.get("period", 1.0) if process == "periodic" else 0.0
+	if phase > 0:
+		times = times + rng.uniform(0, phase, (n, 1))
+	if jitter > 0:
+		times = np.sort(np.maximum(0, times + rng.normal(0, jitter, times.shape)), axis=1)
+	logger.debug("Arrival schedule ({}) for {} devices: {:.3f} messages/s per device.".format(
+		process, n, count / max(times[:, -1].mean(), 1e-9)))
+	return times
@@ -0,0 +1,142 @@
+#!python3
+# asyncio versions of the routines in corinthian_messaging.py
+# for communicating with the Corinthian middleware.
+#
+# Thousands of requests can be in flight at the same time from a
+# single thread. All requests go through an AsyncCorinthianClient,
+# which limits the number of requests in progress and keeps a pool
+# of keep-alive connections to the middleware.
+#
+# Requires the aiohttp library.
+#
+# The routines are coroutines with the same arguments as their
+# counterparts in corinthian_messaging.py, plus a keyword argument
+# for the client to be used.
+# Since the response body can only be read inside the coroutine,
+# routines that return a response in corinthian_messaging.py
+# (follow, subscribe, follow_requests) return the decoded JSON body instead.
+#
+# Usage:
+#	async def main():
+#		async with AsyncCorinthianClient(concurrency=500) as client:
+#			apikeys = await asyncio.gather(*[register(e, client=client) for e in entities])
+#	asyncio.run(main())
+
+from __future__ import print_function
+import asyncio
+import json
+import logging
+logger = logging.getLogger(__name__)
+import aiohttp
+
+from corinthian_messaging import Corinthian_base_url, admin_apikey
+
+
+class AsyncCorinthianClient(object):
+	""" asyncio HTTPS client for the middleware's REST API.
+	At most <concurrency> requests are in progress at a time;
+	further requests wait for their turn.
+	"""
+	def __init__(self, concurrency=100):
+		assert(concurrency > 0)
+		self.concurrency = concurrency
+		self.semaphore = asyncio.Semaphore(concurrency)
+		self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency, ssl=False))
+
+	async def request(self, method, url, headers, data=None, expected_status=200, json_response=False):
+		""" Make a request and check its status code.
+		Returns the decoded JSON body (None if the body is empty)
+		if json_response is True.
+		"""
+		async with self.semaphore:
+			async with self.session.request(method, url, headers=headers, data=data) as r:
+				text = await r.text()
+				assert(r.status == expected_status), "URL = "+str(r.url)+"\n"+"Status code = " \
+					+str(r.status)+"\n"+"Message = "+text
+				if json_response and text:
+					return json.loads(text)
+
+	async def close(self):
+		await self.session.close()
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, *exc_info):
+		await self.close()
+
+
+async def register(entity_id, *, client):
+	url = Corinthian_base_url + "/owner/register-entity"
+	headers = {"id": "admin", "apikey": admin_apikey, "entity": entity_id, "is-autonomous": "true"}
+	r = await client.request("POST", url, headers, data="{\"test\":\"schema\"}", expected_status=201, json_response=True)
+	return r["apikey"]
+
+async def deregister(entity_id, *, client):
+	url = Corinthian_base_url + "/owner/deregister-entity"
+	headers = {"id": "admin", "apikey": admin_apikey, "entity": entity_id}
+	await client.request("POST", url, headers)
+	return True
+
+async def publish(ID, apikey, to, topic, message_type, data, *, client):
+	url = Corinthian_base_url + "/entity/publish"
+	headers = {"id": ID, "apikey": apikey, "to": to, "subject": topic, "message-type": message_type, "content-type": "text/plain"}
+	await client.request("POST", url, headers, data=data, expected_status=202)
+	return True
+
+async def follow(ID, apikey, to_id, permission, from_id="", topic ="", validity = "", message_type="", *, client):
+	url = Corinthian_base_url + "/entity/follow"
+	headers = {}
+	if from_id:
+		headers['from'] = from_id
+	headers['id'] = ID
+	headers['apikey'] = apikey
+	headers['to'] = to_id
+	headers['topic'] = topic if topic else "#"
+	headers['validity'] = validity if validity else "24"
+	if message_type:
+		headers['message-type'] = message_type
+	headers['permission'] = permission
+	return await client.request("POST", url, headers, expected_status=202, json_response=True)
+
+async def share(ID, apikey, follow_id, *, client):
+	url = Corinthian_base_url + "/entity/share"
+	headers = {"id": ID, "apikey": apikey, "follow-id": follow_id}
+	await client.request("POST", url, headers)
+
+async def bind_unbind(ID, apikey, to, topic, message_type, from_id="", is_priority="false", req_type="bind", *, client):
+	url = Corinthian_base_url
+	headers = {}
+	if req_type == "bind":
+		url = url + "/entity/bind"
+	elif req_type == "unbind":
+		url = url + "/entity/unbind"
+	if from_id:
+		headers['from'] = from_id
+	headers['message-type'] = message_type
+	headers['id'] = ID
+	headers['apikey'] = apikey
+	headers['to'] = to
+	headers['topic'] = topic
+	headers['is-priority'] = is_priority
+	await client.request("POST", url, headers)
+
+async def subscribe(ID, apikey, message_type="", num_messages="", *, client):
+	url = Corinthian_base_url + "/entity/subscribe"
+	headers = {}
+	if message_type:
+		headers['message-type'] = message_type
+	if num_messages:
+		headers['num-messages'] = str(num_messages)
+	headers['id'] = ID
+	headers['apikey'] = apikey
+	return await client.request("GET", url, headers, json_response=True)
+
+async def follow_requests(ID, apikey, request_type, *, client):
+	url = Corinthian_base_url
+	if request_type == "requests":
+		url = url + "/entity/follow-requests"
+	elif request_type == "status":
+		url = url + "/entity/follow-status"
+	headers = {"id": ID, "apikey": apikey}
+	return await client.request("GET", url, headers, json_response=True)
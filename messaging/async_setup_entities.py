@@ -0,0 +1,195 @@
+#! python3
+#
+# asyncio versions of the routines in setup_entities.py.
+#
+# Registrations, permission set-up and de-registrations are
+# done from a single asyncio event loop using async_corinthian_messaging,
+# with up to <concurrency> requests in flight at the same time.
+# The system description, return values, progress reporting and
+# the rollback-on-failure behavior are the same as in setup_entities.py,
+# as is the optional journal for resuming setup and teardown.
+#
+# Requires the aiohttp library.
+
+from __future__ import print_function
+import asyncio
+import logging
+logger = logging.getLogger(__name__)
+
+import async_corinthian_messaging as acm
+import permission_handshake
+from setup_entities import check_system_description, write_registration_info, log_progress
+from setup_entities import resume_from_journal, pending_deregistrations
+from setup_entities import HANDSHAKE_POLL_ATTEMPTS, HANDSHAKE_POLL_INTERVAL
+
+
+async def gather_with_progress(coroutines, stage="", progress_callback=log_progress):
+	""" Run a list of coroutines concurrently, calling
+	progress_callback(stage, num_done, num_total) as each one completes.
+	On the first exception, the remaining coroutines are cancelled
+	and the exception is re-raised.
+	"""
+	tasks = [asyncio.ensure_future(c) for c in coroutines]
+	done = 0
+	try:
+		for f in asyncio.as_completed(tasks):
+			await f
+			done += 1
+			if progress_callback:
+				progress_callback(stage, done, len(tasks))
+	except:
+		for t in tasks:
+			t.cancel()
+		await asyncio.gather(*tasks, return_exceptions=True)
+		raise
+
+
+async def deregister_journaled_async(entity, journal, client):
+	""" asyncio version of setup_entities.deregister_journaled()."""
+	uncertain = journal.is_uncertain(entity)
+	journal.deregistering(entity)
+	try:
+		await acm.deregister(entity, client=client)
+	except AssertionError:
+		if not uncertain:
+			raise
+		logger.debug("DE-REGISTER: {} was not registered.".format(entity))
+	journal.record_deregistration(entity)
+
+
+async def deregister_entities_async(list_of_entity_names, concurrency=100, progress_callback=log_progress, journal=None):
+	""" Takes a list of entity names and deregisters them."""
+	if journal is not None:
+		list_of_entity_names = pending_deregistrations(list_of_entity_names, journal)
+	async with acm.AsyncCorinthianClient(concurrency) as client:
+		async def deregister(entity):
+			if journal is None:
+				await acm.deregister(entity, client=client)
+			else:
+				await deregister_journaled_async(entity, journal, client)
+			logger.debug("DE-REGISTER: de-registering {} successful.".format(entity))
+		await gather_with_progress([deregister(e) for e in list_of_entity_names], "DE-REGISTER", progress_callback)
+
+
+async def setup_permissions_async(permissions, registered_entities, client, progress_callback=log_progress, on_done=None):
+	""" asyncio version of setup_entities.setup_permissions()."""
+	handshake = permission_handshake.PermissionHandshake(permissions)
+
+	# FOLLOW: each app sends follow requests to the devices.
+	async def follow(p):
+		app, target_device, permission = p
+		r = await acm.follow("admin/"+app, registered_entities["admin/"+app], "admin/"+target_device, permission, client=client)
+		handshake.record_follow_response(r)
+		logger.debug("FOLLOW: {} sent a follow request to {} for permission {}".format(app, target_device, permission))
+	logger.info("SETUP: sending {} follow requests...".format(len(permissions)))
+	await gather_with_progress([follow(p) for p in permissions], "FOLLOW", progress_callback)
+
+	# SHARE: each device approves all the follow requests meant for it.
+	async def share(device):
+		apikey = registered_entities[device]
+		for attempt in range(HANDSHAKE_POLL_ATTEMPTS):
+			if attempt:
+				await asyncio.sleep(HANDSHAKE_POLL_INTERVAL)
+			pending = await acm.follow_requests(device, apikey, "requests", client=client)
+			to_approve, missing = handshake.match_follow_requests(device, pending)
+			await asyncio.gather(*[acm.share(device, apikey, follow_id, client=client) for follow_id, requester in to_approve])
+			for follow_id, requester in to_approve:
+				handshake.record_approval(follow_id, requester)
+			if not missing:
+				return
+		assert(False), "Follow requests {} never reached {}".format(sorted(missing), device)
+	logger.info("SETUP: approving follow requests at {} devices...".format(len(handshake.devices())))
+	await gather_with_progress([share(d) for d in handshake.devices()], "SHARE", progress_callback)
+
+	# STATUS: each app checks that its follow requests were approved.
+	async def check_status(app):
+		apikey = registered_entities[app]
+		for attempt in range(HANDSHAKE_POLL_ATTEMPTS):
+			if attempt:
+				await asyncio.sleep(HANDSHAKE_POLL_INTERVAL)
+			statuses = await acm.follow_requests(app, apikey, "status", client=client)
+			not_approved = handshake.check_follow_status(app, statuses)
+			if not not_approved:
+				if on_done is not None:
+					for p in handshake.completed_by_status(app):
+						on_done(p)
+				return
+		assert(False), "Follow requests {} of {} were not approved".format(sorted(not_approved), app)
+	await gather_with_progress([check_status(a) for a in handshake.apps()], "STATUS", progress_callback)
+
+	# BIND: for read permissions, get the app to bind to the device's protected stream.
+	async def bind(b):
+		app, target_device = b
+		await acm.bind_unbind("admin/"+app, registered_entities["admin/"+app], "admin/"+target_device, "#", "protected", client=client)
+		logger.debug("BIND: {} sent a bind request for {} .".format(app, target_device))
+		if on_done is not None:
+			for p in handshake.completed_by_bind(app, target_device):
+				on_done(p)
+	await gather_with_progress([bind(b) for b in handshake.binds()], "BIND", progress_callback)
+
+
+async def register_entities_async(system_description, registration_info_file=None, concurrency=100, progress_callback=log_progress, journal=None):
+	""" asyncio version of setup_entities.register_entities()
+	(see the description of the arguments and return values there).
+	"""
+	registered_entities = {}
+	logger.info("SETUP: setting up entities and permissions from system description.")
+
+	try:
+		async with acm.AsyncCorinthianClient(concurrency) as client:
+			devices = system_description["devices"]
+			apps   = system_description["apps"]
+			entities = devices+apps
+			permissions = system_description["permissions"]
+			check_system_description(system_description)
+
+			# skip what an earlier run recorded in the journal
+			to_register = entities
+			to_set_up = permissions
+			if journal is not None:
+				registered, to_register, to_set_up = resume_from_journal(journal, entities, permissions)
+				registered_entities.update(registered)
+
+			# Now register all entities:
+			async def register(i):
+				if journal is not None:
+					if journal.is_uncertain("admin/"+i):
+						# an earlier run died while registering it
+						await deregister_journaled_async("admin/"+i, journal, client)
+					journal.registering("admin/"+i)
+				apikey = await acm.register(i, client=client)
+				logger.debug("REGISTER: registering entity {} successful. apikey ={} ".format(i,apikey))
+				registered_entities["admin/"+i]=apikey
+				if journal is not None:
+					journal.record_registration("admin/"+i, apikey)
+
+			logger.info("SETUP: registering {} entities...".format(len(to_register)))
+			await gather_with_progress([register(i) for i in to_register], "REGISTER", progress_callback)
+
+			# Set up permissions
+			await setup_permissions_async(to_set_up, registered_entities, client, progress_callback,
+				on_done=journal.record_permission if journal is not None else None)
+
+		# setup done!
+		logger.info("SETUP: done.")
+		if(registration_info_file):
+			write_registration_info(registration_info_file, system_description, registered_entities)
+		return True, registered_entities
+
+	except:
+		if journal is not None:
+			logger.error("An exception occurred during setup. The progress so far is recorded in {}."
+				" Run the setup again to resume.".format(journal.path))
+			raise
+		logger.error("An exception occurred during setup. Deregistering all registered entities.")
+		await deregister_entities_async(list(registered_entities), concurrency)
+		raise
+
+
+# Blocking wrappers for use from scripts:
+
+def register_entities(system_description, registration_info_file=None, concurrency=100, progress_callback=log_progress, journal=None):
+	return asyncio.run(register_entities_async(system_description, registration_info_file, concurrency, progress_callback, journal))
+
+def deregister_entities(list_of_entity_names, concurrency=100, progress_callback=log_progress, journal=None):
+	return asyncio.run(deregister_entities_async(list_of_entity_names, concurrency, progress_callback, journal))
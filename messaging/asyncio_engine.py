@@ -0,0 +1,73 @@
+# !python3
+#
+# A single-threaded asyncio I/O engine for the communication interfaces.
+#
+# The AsyncioEngine runs one asyncio event loop in one thread. All
+# publish, subscribe, send-commands and receive-commands interfaces
+# of a simulation are served by this loop using pika's AsyncioConnection,
+# so a simulation needs one I/O thread in total instead of one thread
+# per interface. The interfaces keep the same publish(), send_command()
+# and .queue surface, so the entity models need not change.
+#
+# As with the ConnectionPool, interfaces of the same entity share
+# one connection (the middleware authenticates connections per entity).
+#
+# Usage:
+#	engine = AsyncioEngine()
+#	communication_interface.set_transport(engine)
+#	... create SimpleDevice/SimpleApp entities as usual ...
+#	engine.close()
+#
+# Coroutines can also be run on the engine's loop from
+# other threads using engine.run_coroutine().
+
+from __future__ import print_function
+import asyncio
+import logging
+logger = logging.getLogger(__name__)
+from pika.adapters.asyncio_connection import AsyncioConnection
+
+import connection_pool
+
+
+class AsyncioIOThread(connection_pool.IOThread):
+	""" An I/O thread running an asyncio event loop."""
+
+	def create_loop(self):
+		self.loop = asyncio.new_event_loop()
+
+	def run(self):
+		asyncio.set_event_loop(self.loop)
+		self.loop.run_forever()
+
+	def wakeup(self, callback):
+		self.loop.call_soon_threadsafe(callback)
+
+	def call_later(self, delay, callback):
+		return self.loop.call_later(delay, callback)
+
+	def stop_loop(self):
+		self.loop.stop()
+
+	def open_connection(self, parameters, on_open, on_open_error, on_close):
+		return AsyncioConnection(parameters,
+			on_open_callback=on_open,
+			on_open_error_callback=on_open_error,
+			on_close_callback=on_close,
+			stop_ioloop_on_close=False,
+			custom_ioloop=self.loop)
+
+
+class AsyncioEngine(connection_pool.ConnectionPool):
+	""" Transport serving all interfaces from a single asyncio event loop thread."""
+
+	io_thread_class = AsyncioIOThread
+
+	def __init__(self):
+		super(AsyncioEngine, self).__init__(num_threads=1)
+		self.loop = self.io_threads[0].loop
+
+	# run a coroutine on the engine's loop (thread-safe).
+	# Returns a concurrent.futures.Future.
+	def run_coroutine(self, coroutine):
+		return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
@@ -5,6 +5,8 @@
 # A device/app entity can spawn multiple communication 
 # interfaces. Each interface runs as an independent thread. 
 # The threads communicate with the parent entity via queues.
+# (Alternatively, all interfaces can share a small pool of connections
+# and threads. See "Shared transport" below.)
 #
 # There are four basic interface types:
 #		
@@ -22,8 +24,10 @@
 from __future__ import print_function 
 import os, sys
 import threading
-from queue import Queue
+import functools
+from queue import Queue, Empty
 import json
+import time
 import logging
 logger = logging.getLogger(__name__)
 import pika
@@ -32,10 +36,132 @@ import pika
 import corinthian_messaging
 from corinthian_messaging import Corinthian_ip_address, Corinthian_port
 
+# latency histograms
+import latency
+# loss, duplication and reordering checks
+import stream_checker
+# recording of the traffic to disk
+import recorder as traffic_recorder
+
+#=============================
+# Shared transport
+#=============================
+# By default, each interface opens its own connection to the
+# middleware and runs its own thread. Alternatively, a shared
+# transport (such as a connection_pool.ConnectionPool) can be set
+# for all the interfaces created after it. The entity models
+# (devices/apps) need not change in either case.
+#
+# A transport is any object with a method open_channel(ID, apikey)
+# which returns a channel handle with the following non-blocking,
+# thread-safe methods:
+#	publish(exchange, routing_key, body, properties)
+#	consume(queue, callback)
+#	close()
+# and, for publishing in confirm mode:
+#	publish_batch(messages)
+#	enable_confirms(on_confirm, on_return)
+# (see connection_pool.PooledChannel).
+# Optionally, the transport can have a method publish_many(messages)
+# for publishing a list of (channel, exchange, routing_key, body, properties)
+# on many channels at once (used by the fleet interfaces).
+transport = None
+
+def set_transport(t):
+	""" Set the transport used by all interfaces created from now on.
+	Passing None restores the default (one connection and thread per interface).
+	"""
+	global transport
+	transport = t
+
+def make_transport(backend, devices=None, apps=None, permissions=None):
+	""" The shared transport for a backend:
+		"threads": None (one connection and thread per interface)
+		"pool":    a connection_pool.ConnectionPool
+		"asyncio": an asyncio_engine.AsyncioEngine
+		"local":   a local_broker.LocalBroker for <devices> and <apps>,
+		           with <permissions> (see local_broker.py)
+	"""
+	assert(backend in ["threads", "pool", "asyncio", "local"]), "Invalid backend"
+	t = None
+	if backend == "pool":
+		import connection_pool
+		t = connection_pool.ConnectionPool()
+	elif backend == "asyncio":
+		import asyncio_engine
+		t = asyncio_engine.AsyncioEngine()
+	elif backend == "local":
+		import local_broker
+		t = local_broker.LocalBroker()
+		t.setup(devices, apps, permissions)
+	return t
+
+
+#=============================
+# Message stamps
+#=============================
+# Each message published and each command sent carries two AMQP headers:
+#	"seq": a sequence number, counted separately for each
+#	       sender (and, for commands, each device the commands are sent to)
+#	"sent": the time at which the entity handed the message to
+#	       the interface (latency.now(), in nanoseconds)
+# A command sent in reply to a message also carries the "sent" time of
+# that message as "reply_to_sent". The receiving interfaces add "seq"
+# and "sent" to the messages they push into their queues, record the
+# latencies in histograms (see latency.py) and check the sequence
+# numbers of each sender for gaps, duplicates and reordering
+# (see stream_checker.py).
+
+def stamped_properties(ID, seq, in_reply_to=None):
+	headers = {"seq": seq, "sent": latency.now()}
+	if in_reply_to is not None and in_reply_to.get("sent") is not None:
+		headers["reply_to_sent"] = in_reply_to["sent"]
+	return pika.BasicProperties(user_id=ID, headers=headers)
+
+# the stamps of a received message (None for unstamped messages).
+# (pika decodes 64-bit integers as its own "long" type, so they
+# are converted back to int.)
+def stamps(properties):
+	headers = properties.headers or {}
+	return tuple(None if v is None else int(v) for v in
+		(headers.get("seq"), headers.get("sent"), headers.get("reply_to_sent")))
+
+
+#=============================
+# Traffic recorder
+#=============================
+# Optionally, every message published, received, sent as a command
+# or received as a command by the interfaces is recorded by
+# a recorder (see recorder.Recorder).
+recorder = None
+
+def set_recorder(r):
+	""" Set the recorder used by all interfaces (None for no recording)."""
+	global recorder
+	recorder = r
+
+def record(ID, direction, body, seq, timestamp=None):
+	r = recorder
+	if r is not None:
+		size = len(body) if isinstance(body, bytes) else len(str(body).encode('utf-8'))
+		r.record(latency.now() if timestamp is None else timestamp, ID, direction, size, seq)
+
 
 class PublishInterface(object):
-	""" Interface used by a device for publishing data to the middleware."""
-	def __init__(self, ID, apikey):
+	""" Interface used by a device for publishing data to the middleware.
+	
+	Optionally, with confirms=True, the interface turns on publisher 
+	confirms and publishes in batches: each cycle drains up to <batch_size>
+	messages from the queue (waiting at most <batch_timeout> seconds for
+	the batch to fill up) and publishes them as a single burst. 
+	Confirms are tracked asynchronously. At most <max_in_flight> messages
+	can be awaiting a confirm; publishing pauses when this window is full.
+	The counts of confirmed, nacked and returned (unroutable) messages
+	are kept in confirmed_count, nacked_count and returned_count, and the
+	count of messages dropped because the interface was stopped before
+	publishing them in dropped_count.
+	"""
+	def __init__(self, ID, apikey, confirms=False, batch_size=100, batch_timeout=0.005, max_in_flight=1000):
 		self.ID = ID
 		self.apikey = apikey
 		
@@ -44,6 +170,24 @@ class PublishInterface(object):
 		
 		# count of the messages published
 		self.count =0
+		
+		# sequence number of the next message
+		self.seq =0
+		
+		self.stop_event = threading.Event()
+		self.confirms = confirms
+		if self.confirms:
+			self.init_confirms(batch_size, batch_timeout, max_in_flight)
+			return
+			
+		if transport is not None:
+			# use a channel on the shared transport.
+			# No thread is needed as messages are handed
+			# to the transport directly.
+			self.channel = transport.open_channel(self.ID, self.apikey)
+			self.thread = None
+			logger.debug("PublishInterface created with ID={} on a shared transport.".format(self.ID))
+			return
 	
 		# open a channel in pika
 		credentials = pika.PlainCredentials(self.ID, self.apikey)
@@ -52,17 +196,60 @@ class PublishInterface(object):
 		self.channel = connection.channel()
 
 		# spawn the behaviour function as an independent thread
-		self.stop_event = threading.Event()
 		self.thread = threading.Thread(target=self.behavior)
 		self.thread.daemon = True
 		self.thread.start()
 		logger.debug("PublishInterface thread created with ID={}.".format(self.ID))
 
+	# set up the batched publisher-confirms mode.
+	def init_confirms(self, batch_size, batch_timeout, max_in_flight):
+		assert(batch_size > 0 and batch_size <= max_in_flight)
+		self.batch_size = batch_size
+		self.batch_timeout = batch_timeout
+		self.max_in_flight = max_in_flight
+		
+		# counts of messages confirmed, nacked and returned by the broker
+		self.confirmed_count = 0
+		self.nacked_count = 0
+		self.returned_count = 0
+		self.dropped_count = 0
+		
+		# number of messages handed over by publish() and not yet
+		# confirmed, nacked or dropped (queued or awaiting a confirm)
+		self.pending = 0
+		# number of messages published and awaiting a confirm
+		self.in_flight = 0
+		self.confirm_condition = threading.Condition()
+		
+		# Confirms need an asynchronous channel. Use the shared transport
+		# if there is one, or else a private single-threaded connection pool.
+		self.private_transport = None
+		t = transport
+		if t is None:
+			import connection_pool
+			t = self.private_transport = connection_pool.ConnectionPool(num_threads=1)
+		self.channel = t.open_channel(self.ID, self.apikey)
+		self.channel.enable_confirms(self.on_confirm, self.on_return)
+		
+		# spawn the batched behaviour function as an independent thread
+		self.thread = threading.Thread(target=self.behavior_confirms)
+		self.thread.daemon = True
+		self.thread.start()
+		logger.debug("PublishInterface thread created with ID={} in confirm mode.".format(self.ID))
+
 	# a function to stop the thread from outside
 	def stop(self):
+		if self.confirms:
+			# give messages already handed over a chance to be confirmed
+			self.wait_for_confirms(timeout=1)
 		self.stop_event.set()
 		logger.debug("PublishInterface thread with ID={} was stopped.".format(self.ID))
 		self.channel.close()
+		if self.confirms:
+			# wake up the behavior thread so that it can exit.
+			self.queue.put(None)
+			if self.private_transport is not None:
+				self.private_transport.close()
 	    
 	# check if the thread was stopped.
 	def stopped(self):
@@ -71,22 +258,104 @@ class PublishInterface(object):
 	# routine used by a device for inserting a 
 	# message into the publish queue.
 	def publish(self,data):
-		self.queue.put(data)
+		properties = stamped_properties(self.ID, self.seq)
+		record(self.ID, traffic_recorder.PUBLISHED, data, self.seq, properties.headers["sent"])
+		self.seq +=1
+		if self.thread is None:
+			self.channel.publish(exchange=self.ID+".protected", routing_key="<unspecified>",
+				body=str(data), properties=properties)
+			self.count +=1
+		else:
+			if self.confirms:
+				with self.confirm_condition:
+					self.pending +=1
+			self.queue.put((data, properties))
 	
 	# main behavior
 	def behavior(self):
 		while not self.stopped():
 			# wait until there's a msg to be published
-			data = self.queue.get()
+			data, properties = self.queue.get()
 			# send the message to the middleware
 			#corinthian_messaging.publish(self.ID, self.apikey, self.ID, "#", "protected", data)
-			success = self.channel.basic_publish(exchange=self.ID+".protected", properties=pika.BasicProperties(user_id=self.ID), 
+			success = self.channel.basic_publish(exchange=self.ID+".protected", properties=properties, 
 				routing_key="<unspecified>", body=str(data))
 			if success:
 				logger.debug("PublishInterface thread with ID={} published data={}".format(self.ID, data))
 			else:
 				logger.error("PublishInterface thread with ID={} FAILED to publish data={}".format(self.ID, data))
 			self.count +=1
+	
+	# main behavior in confirm mode
+	def behavior_confirms(self):
+		batch = []
+		while not self.stopped():
+			# wait until there's a msg to be published
+			batch = [self.queue.get()]
+			# collect more messages until the batch is full
+			# or the batch timeout expires.
+			deadline = time.perf_counter() + self.batch_timeout
+			while len(batch) < self.batch_size:
+				try:
+					batch.append(self.queue.get(timeout=max(0, deadline - time.perf_counter())))
+				except Empty:
+					break
+			if self.stopped():
+				break
+			
+			# wait for room in the in-flight window
+			with self.confirm_condition:
+				while self.in_flight + len(batch) > self.max_in_flight and not self.stopped():
+					self.confirm_condition.wait(timeout=0.1)
+				self.in_flight += len(batch)
+			
+			# publish the whole batch as a single burst
+			self.channel.publish_batch([(self.ID+".protected", "<unspecified>", str(data), properties) for data, properties in batch])
+			self.count += len(batch)
+			logger.debug("PublishInterface thread with ID={} published a batch of {} messages".format(self.ID, len(batch)))
+			batch = []
+		self.drop(batch)
+
+	# count the messages of <batch> and those left in the queue
+	# as dropped, once the interface was stopped.
+	def drop(self, batch):
+		while True:
+			try:
+				batch.append(self.queue.get_nowait())
+			except Empty:
+				break
+		# (None wakes up the behavior thread, see stop)
+		dropped = len([m for m in batch if m is not None])
+		if not dropped:
+			return
+		with self.confirm_condition:
+			self.dropped_count += dropped
+			self.pending -= dropped
+			self.confirm_condition.notify_all()
+		logger.error("PublishInterface thread with ID={}: {} messages were dropped as it was stopped".format(self.ID, dropped))
+
+	# called by the transport when messages are confirmed
+	def on_confirm(self, num_acked, num_nacked):
+		with self.confirm_condition:
+			self.confirmed_count += num_acked
+			self.nacked_count += num_nacked
+			self.in_flight -= (num_acked + num_nacked)
+			self.pending -= (num_acked + num_nacked)
+			self.confirm_condition.notify_all()
+		if num_nacked:
+			logger.error("PublishInterface thread with ID={}: {} messages were NOT confirmed by the middleware".format(self.ID, num_nacked))
+
+	# called by the transport when a message is returned as unroutable
+	def on_return(self):
+		with self.confirm_condition:
+			self.returned_count += 1
+
+	def wait_for_confirms(self, timeout=None):
+		""" Wait until all queued messages have been published and confirmed.
+		Returns False if the timeout expired first.
+		"""
+		with self.confirm_condition:
+			return self.confirm_condition.wait_for(lambda: self.pending == 0, timeout=timeout)
         
 
 class SubscribeInterface(object):
@@ -101,9 +370,16 @@ class SubscribeInterface(object):
 		data = json.loads(body.decode('utf-8'))
 		sender = properties.user_id
 		logger.debug("SubscribeInterface thread with ID={} received a message: {} from {}".format(self.ID,data,sender))
-		msg={"data":data,"sender":sender}
+		seq, sent, _ = stamps(properties)
+		latency.record_latency(self.latency, sent)
+		if seq is not None:
+			self.checker.check(sender, seq)
+		record(self.ID, traffic_recorder.RECEIVED, body, seq)
+		msg={"data":data,"sender":sender,"seq":seq,"sent":sent}
 		# push the message into the queue
 		self.queue.put(msg)
+		if self.on_message is not None:
+			self.on_message()
 
 	def __init__(self, ID, apikey):
 		
@@ -113,9 +389,28 @@ class SubscribeInterface(object):
 		# create a queue to communicate with the parent entity
 		self.queue = Queue()
 		
+		# optional call-back, called after a message is pushed
+		# into the queue (see event_bridge.py)
+		self.on_message = None
+		
 		# count of the messages received
 		self.count =0
 		
+		# latency of the messages received
+		self.latency = latency.LatencyHistogram()
+		# checks of the stream from each device
+		self.checker = stream_checker.StreamChecker()
+		
+		self.stop_event = threading.Event()
+		if transport is not None:
+			# use a channel on the shared transport.
+			# The call-back is run by the transport's I/O thread.
+			self.channel = transport.open_channel(self.ID, self.apikey)
+			self.channel.consume(self.ID, self.callback)
+			self.thread = None
+			logger.debug("SubscribeInterface created with ID={} on a shared transport.".format(self.ID))
+			return
+		
 		# open a channel in pika
 		credentials = pika.PlainCredentials(self.ID, self.apikey)
 		parameters = pika.ConnectionParameters(Corinthian_ip_address, Corinthian_port, '/', credentials, ssl=True)
@@ -126,7 +421,6 @@ class SubscribeInterface(object):
 		self.channel.basic_consume(self.callback, queue=self.ID, no_ack=True)
 		
 		# spawn the behaviour function as an independent thread
-		self.stop_event = threading.Event()
 		self.thread = threading.Thread(target=self.behavior)
 		self.thread.daemon = True
 		self.thread.start()
@@ -135,7 +429,10 @@ class SubscribeInterface(object):
 	# a function to stop the thread from outside
 	def stop(self):
 		self.stop_event.set()
-		self.channel.stop_consuming()
+		if self.thread is None:
+			self.channel.close()
+		else:
+			self.channel.stop_consuming()
 		logger.debug("SubscribeInterface thread with ID={} was stopped.".format(self.ID))
 	    
 	# check if the thread was stopped.
@@ -162,6 +459,19 @@ class SendCommandsInterface(object):
 		# count of the commands sent
 		self.count =0
 		
+		# sequence number of the next command to each device
+		self.seq = {}
+		
+		self.stop_event = threading.Event()
+		if transport is not None:
+			# use a channel on the shared transport.
+			# No thread is needed as commands are handed
+			# to the transport directly.
+			self.channel = transport.open_channel(self.ID, self.apikey)
+			self.thread = None
+			logger.debug("SendCommandsInterface created with ID={} on a shared transport.".format(self.ID))
+			return
+		
 		# open a channel in pika
 		credentials = pika.PlainCredentials(self.ID, self.apikey)
 		parameters = pika.ConnectionParameters(Corinthian_ip_address, Corinthian_port, '/', credentials, ssl=True)
@@ -170,7 +480,6 @@ class SendCommandsInterface(object):
 
 		
 		# spawn the behaviour function as an independent thread
-		self.stop_event = threading.Event()
 		self.thread = threading.Thread(target=self.behavior)
 		self.thread.daemon = True
 		self.thread.start()
@@ -188,9 +497,20 @@ class SendCommandsInterface(object):
 	
 	# routine used by an app for sending a 
 	# command to a specified device.
-	def send_command(self,device_id,command):
+	# (<in_reply_to> is the received message that
+	# the command is a reply to, if any.)
+	def send_command(self,device_id,command,in_reply_to=None):
 		cmd = {"device_id":str(device_id), "command":str(command)}
-		self.queue.put(cmd)
+		seq = self.seq.get(cmd["device_id"], 0)
+		self.seq[cmd["device_id"]] = seq + 1
+		cmd["properties"] = stamped_properties(self.ID, seq, in_reply_to)
+		record(self.ID, traffic_recorder.COMMAND_SENT, cmd["command"], seq, cmd["properties"].headers["sent"])
+		if self.thread is None:
+			self.channel.publish(exchange=self.ID+".publish", routing_key=cmd["device_id"]+".command.#",
+				body=cmd["command"], properties=cmd["properties"])
+			self.count +=1
+		else:
+			self.queue.put(cmd)
 	
 	# main behavior
 	def behavior(self):
@@ -202,7 +522,7 @@ class SendCommandsInterface(object):
 			
 			# send a command to the device via the middleware
 			#corinthian_messaging.publish(ID=self.ID, apikey=self.apikey, to=device_id, topic="#", message_type="command", data=command)
-			success = self.channel.basic_publish(exchange=self.ID+".publish", properties=pika.BasicProperties(user_id=self.ID),
+			success = self.channel.basic_publish(exchange=self.ID+".publish", properties=cmd["properties"],
 				routing_key=device_id+".command.#", body=str(command))
 			if success:
 				logger.debug("SendCommandsInterface thread with ID={} sent a command={} to device={}".format(self.ID, command, device_id))
@@ -220,9 +540,17 @@ class ReceiveCommandsInterface(object):
 		command = json.loads(body.decode('utf-8'))
 		sender = properties.user_id
 		logger.debug("ReceiveCommandsInterface thread with ID={} received a command {} from {}".format(self.ID, command, sender))
-		msg={"data":command,"sender":sender}
+		seq, sent, reply_to_sent = stamps(properties)
+		latency.record_latency(self.latency, sent)
+		latency.record_latency(self.round_trip_latency, reply_to_sent)
+		if seq is not None:
+			self.checker.check(sender, seq)
+		record(self.ID, traffic_recorder.COMMAND_RECEIVED, body, seq)
+		msg={"data":command,"sender":sender,"seq":seq,"sent":sent}
 		# push the message into the queue
 		self.queue.put(msg)
+		if self.on_message is not None:
+			self.on_message()
 
 	def __init__(self, ID, apikey):
 		
@@ -232,9 +560,30 @@ class ReceiveCommandsInterface(object):
 		# create a queue to communicate with the parent entity
 		self.queue = Queue()
 		
+		# optional call-back, called after a message is pushed
+		# into the queue (see event_bridge.py)
+		self.on_message = None
+		
 		# count of the messages received
 		self.count =0
 		
+		# latency of the commands received, and the round-trip
+		# latency of the commands sent in reply to a message
+		self.latency = latency.LatencyHistogram()
+		self.round_trip_latency = latency.LatencyHistogram()
+		# checks of the stream from each app
+		self.checker = stream_checker.StreamChecker()
+		
+		self.stop_event = threading.Event()
+		if transport is not None:
+			# use a channel on the shared transport.
+			# The call-back is run by the transport's I/O thread.
+			self.channel = transport.open_channel(self.ID, self.apikey)
+			self.channel.consume(self.ID+".command", self.callback)
+			self.thread = None
+			logger.debug("ReceiveCommandsInterface created with ID={} on a shared transport.".format(self.ID))
+			return
+		
 		# open a channel in pika
 		credentials = pika.PlainCredentials(self.ID, self.apikey)
 		parameters = pika.ConnectionParameters(Corinthian_ip_address, Corinthian_port, '/', credentials, ssl=True)
@@ -246,7 +595,6 @@ class ReceiveCommandsInterface(object):
 
 		
 		# spawn the behaviour function as an independent thread
-		self.stop_event = threading.Event()
 		self.thread = threading.Thread(target=self.behavior)
 		self.thread.daemon = True
 		self.thread.start()
@@ -255,7 +603,10 @@ class ReceiveCommandsInterface(object):
 	# a function to stop the thread from outside
 	def stop(self):
 		self.stop_event.set()
-		self.channel.stop_consuming()
+		if self.thread is None:
+			self.channel.close()
+		else:
+			self.channel.stop_consuming()
 		logger.debug("ReceiveCommandsInterface thread with ID={} was stopped.".format(self.ID))
 
 	# check if the thread was stopped.
@@ -266,6 +617,111 @@ class ReceiveCommandsInterface(object):
 		if not self.stopped():
 			self.channel.start_consuming()
 
+#=============================
+# Fleet interfaces
+#=============================
+# Interfaces used by a fleet of devices that is simulated as a whole
+# (such as simple_entities/device_fleet.py) instead of one object per device.
+# Each device still has its own channel (the middleware authenticates
+# each device separately), but the fleet publishes a whole batch
+# of messages at once and reads the commands for all its devices
+# from a single queue. These interfaces need a shared transport.
+
+class FleetPublishInterface(object):
+	""" Interface used by a fleet of devices for publishing data."""
+	def __init__(self, IDs, apikeys):
+		assert(transport is not None), "Fleet interfaces need a shared transport"
+		assert(len(IDs) == len(apikeys))
+		self.IDs = list(IDs)
+		self.transport = transport
+		self.channels = [transport.open_channel(ID, apikey) for ID, apikey in zip(IDs, apikeys)]
+		self.exchanges = [ID+".protected" for ID in self.IDs]
+		
+		# count of the messages published (by all devices)
+		self.count = 0
+		
+		# sequence number of the next message of each device
+		self.seq = [0] * len(self.IDs)
+		logger.debug("FleetPublishInterface created for {} devices.".format(len(self.IDs)))
+	
+	# publish data[k] from device number indices[k].
+	def publish_batch(self, indices, data):
+		messages = []
+		for i, d in zip(indices, data):
+			properties = stamped_properties(self.IDs[i], self.seq[i])
+			record(self.IDs[i], traffic_recorder.PUBLISHED, d, self.seq[i], properties.headers["sent"])
+			messages.append((self.channels[i], self.exchanges[i], "<unspecified>", str(d), properties))
+			self.seq[i] += 1
+		if hasattr(self.transport, "publish_many"):
+			self.transport.publish_many(messages)
+		else:
+			for channel, exchange, routing_key, body, properties in messages:
+				channel.publish(exchange, routing_key, body, properties)
+		self.count += len(messages)
+	
+	def stop(self):
+		for channel in self.channels:
+			channel.close()
+		logger.debug("FleetPublishInterface for {} devices was stopped.".format(len(self.IDs)))
+
+
+class FleetReceiveCommandsInterface(object):
+	""" Interface used by a fleet of devices for receiving commands.
+	Commands for all the devices are pushed into a single queue
+	as (<device number>, <message>).
+	"""
+	# The call-back function
+	def callback(self, index, ch, method, properties, body):
+		self.count+=1
+		command = json.loads(body.decode('utf-8'))
+		sender = properties.user_id
+		seq, sent, reply_to_sent = stamps(properties)
+		latency.record_latency(self.latency, sent)
+		latency.record_latency(self.round_trip_latency, reply_to_sent)
+		if seq is not None:
+			self.checker.check((index, sender), seq)
+		record(self.IDs[index], traffic_recorder.COMMAND_RECEIVED, body, seq)
+		msg={"data":command,"sender":sender,"seq":seq,"sent":sent}
+		# push the message into the queue
+		self.queue.put((index, msg))
+		if self.on_message is not None:
+			self.on_message()
+	
+	def __init__(self, IDs, apikeys):
+		assert(transport is not None), "Fleet interfaces need a shared transport"
+		assert(len(IDs) == len(apikeys))
+		self.IDs = list(IDs)
+		
+		# create a queue to communicate with the parent fleet
+		self.queue = Queue()
+		
+		# optional call-back, called after a message is pushed
+		# into the queue (see event_bridge.py)
+		self.on_message = None
+		
+		# count of the messages received (by all devices)
+		self.count = 0
+		
+		# latency of the commands received (by all devices),
+		# and the round-trip latency of commands sent in reply to a message
+		self.latency = latency.LatencyHistogram()
+		self.round_trip_latency = latency.LatencyHistogram()
+		# checks of the stream from each app to each device
+		self.checker = stream_checker.StreamChecker()
+		
+		self.channels = []
+		for index, (ID, apikey) in enumerate(zip(IDs, apikeys)):
+			channel = transport.open_channel(ID, apikey)
+			channel.consume(ID+".command", functools.partial(self.callback, index))
+			self.channels.append(channel)
+		logger.debug("FleetReceiveCommandsInterface created for {} devices.".format(len(self.IDs)))
+	
+	def stop(self):
+		for channel in self.channels:
+			channel.close()
+		logger.debug("FleetReceiveCommandsInterface for {} devices was stopped.".format(len(self.IDs)))
+
+
 #=============================
 # Polling-based interfaces...
 # these are less responsive than their
@@ -286,6 +742,10 @@ class SubscribeInterfacePolling(object):
 		# create a queue to communicate with the parent entity
 		self.queue = Queue()
 		
+		# optional call-back, called after a message is pushed
+		# into the queue (see event_bridge.py)
+		self.on_message = None
+		
 		# count of the messages received
 		self.count =0
 		
@@ -316,6 +776,8 @@ class SubscribeInterfacePolling(object):
 				# push the message into the queue
 				self.queue.put(msg)
 				self.count += 1
+				if self.on_message is not None:
+					self.on_message()
 
 class ReceiveCommandsInterfacePolling(object):
 	""" Polling-based Interface used by a device for receiving commands."""
@@ -331,6 +793,10 @@ class ReceiveCommandsInterfacePolling(object):
 		# create a queue to communicate with the parent entity
 		self.queue = Queue()
 		
+		# optional call-back, called after a message is pushed
+		# into the queue (see event_bridge.py)
+		self.on_message = None
+		
 		# count of the messages received
 		self.count =0
 		
@@ -365,6 +831,8 @@ class ReceiveCommandsInterfacePolling(object):
 				# push the command into the queue
 				self.queue.put(msg)
 				self.count += 1
+				if self.on_message is not None:
+					self.on_message()
 
 
 
@@ -374,7 +842,6 @@ class ReceiveCommandsInterfacePolling(object):
 # Testbench
 #======================================
 import setup_entities
-import time
 
 if __name__=='__main__':
     
@@ -0,0 +1,483 @@
+# !python3
+#
+# A shared pool of AMQP connections for the communication interfaces.
+#
+# By default each communication interface opens its own TLS connection
+# to the middleware and blocks its own thread on it. With thousands of
+# entities this exhausts file descriptors, broker connection slots
+# and OS threads long before the middleware is saturated.
+#
+# The ConnectionPool instead runs a small, fixed number of I/O threads
+# (one per core by default). Each I/O thread runs a single pika ioloop
+# which serves many connections. Every interface gets its own channel
+# on a pooled connection.
+#
+# The middleware authenticates an AMQP connection as a single entity
+# (and checks the user_id of every message published on it against
+# that entity), so connections can only be shared between the
+# interfaces of the same entity. A device's publish and receive-commands
+# interfaces (or an app's subscribe and send-commands interfaces) therefore
+# share one connection, and all connections are multiplexed over the
+# fixed set of I/O threads.
+#
+# Usage:
+#	pool = ConnectionPool(num_threads=4)
+#	communication_interface.set_transport(pool)
+#	... create SimpleDevice/SimpleApp entities as usual ...
+#	pool.close()
+
+from __future__ import print_function
+import os
+import threading
+import functools
+from collections import deque, OrderedDict
+import logging
+logger = logging.getLogger(__name__)
+import pika
+from pika.adapters.select_connection import IOLoop
+
+from corinthian_messaging import Corinthian_ip_address, Corinthian_port
+
+
+def connection_parameters(ID, apikey):
+	""" AMQP connection parameters for an entity."""
+	credentials = pika.PlainCredentials(ID, apikey)
+	return pika.ConnectionParameters(Corinthian_ip_address, Corinthian_port, '/', credentials, ssl=True)
+
+
+class IOThread(object):
+	""" A thread running a pika ioloop that is shared by many connections.
+	Work is handed to the thread via call(), which is thread-safe.
+	
+	Sub-classes can run a different event loop by overriding 
+	create_loop(), run(), wakeup(), call_later(), stop_loop() 
+	and open_connection().
+	"""
+	def __init__(self, name):
+		self.name = name
+		self.create_loop()
+
+		# connections served by this thread:
+		# (ID, apikey) : _PooledConnection
+		self.connections = {}
+
+		# tasks submitted from other threads. The ioloop is woken up
+		# once per batch of tasks rather than once per task.
+		self.lock = threading.Lock()
+		self.tasks = deque()
+		self.wakeup_scheduled = False
+
+		self.thread = threading.Thread(target=self.run, name=name)
+		self.thread.daemon = True
+		self.thread.start()
+		logger.debug("IOThread {} created.".format(self.name))
+
+	#---------------------------
+	# event loop specific parts
+	#---------------------------
+	def create_loop(self):
+		self.ioloop = IOLoop()
+
+	def run(self):
+		self.ioloop.start()
+
+	# thread-safe: request a call to callback() on this thread.
+	def wakeup(self, callback):
+		self.ioloop.add_callback_threadsafe(callback)
+
+	def call_later(self, delay, callback):
+		return self.ioloop.add_timeout(delay, callback)
+
+	def stop_loop(self):
+		self.ioloop.stop()
+
+	def open_connection(self, parameters, on_open, on_open_error, on_close):
+		return pika.SelectConnection(parameters,
+			on_open_callback=on_open,
+			on_open_error_callback=on_open_error,
+			on_close_callback=on_close,
+			stop_ioloop_on_close=False,
+			custom_ioloop=self.ioloop)
+	
+	#---------------------------
+	
+	# run fn(*args) in the context of this thread.
+	def call(self, fn, *args):
+		with self.lock:
+			self.tasks.append(functools.partial(fn, *args))
+			if self.wakeup_scheduled:
+				return
+			self.wakeup_scheduled = True
+		self.wakeup(self.run_tasks)
+
+	def run_tasks(self):
+		with self.lock:
+			tasks = self.tasks
+			self.tasks = deque()
+			self.wakeup_scheduled = False
+		for task in tasks:
+			try:
+				task()
+			except Exception:
+				logger.exception("IOThread {}: task {} failed.".format(self.name, task))
+
+	# the following are called on the I/O thread only.
+	def attach(self, channel):
+		key = (channel.ID, channel.apikey)
+		if key not in self.connections:
+			self.connections[key] = _PooledConnection(self, channel.ID, channel.apikey)
+		self.connections[key].attach(channel)
+
+	def detach(self, channel):
+		key = (channel.ID, channel.apikey)
+		if key in self.connections:
+			self.connections[key].detach(channel)
+
+	def stop(self):
+		self.call(self._stop)
+		self.thread.join(timeout=5)
+
+	def _stop(self):
+		try:
+			for connection in list(self.connections.values()):
+				connection.close()
+		finally:
+			# give the close handshakes a moment to go out
+			# (and stop the loop even if a close failed).
+			self.call_later(0.1, self.stop_loop)
+
+
+class _PooledConnection(object):
+	""" A connection shared by all pooled channels of one entity.
+	Lives entirely on its IOThread.
+	"""
+	def __init__(self, io_thread, ID, apikey):
+		self.io_thread = io_thread
+		self.ID = ID
+		self.apikey = apikey
+		self.is_open = False
+		self.closed = False
+		self.channels = set()
+		self.connection = io_thread.open_connection(connection_parameters(ID, apikey),
+			self.on_open, self.on_open_error, self.on_close)
+
+	def on_open(self, connection):
+		self.is_open = True
+		if self.closed:
+			# closed while it was opening
+			connection.close()
+			return
+		logger.debug("Pooled connection for ID={} opened on {}.".format(self.ID, self.io_thread.name))
+		for channel in list(self.channels):
+			channel.on_connection_open(connection)
+
+	def on_open_error(self, connection, error):
+		logger.error("Pooled connection for ID={} could not be opened: {}".format(self.ID, error))
+		self.lost()
+
+	def on_close(self, connection, reply_code, reply_text):
+		self.is_open = False
+		if self.channels:
+			logger.error("Pooled connection for ID={} was closed: ({}) {}".format(self.ID, reply_code, reply_text))
+		self.lost()
+
+	# the connection failed or was closed by the broker.
+	def lost(self):
+		self.forget()
+		for channel in list(self.channels):
+			channel.on_channel_closed(None, 0, "connection lost")
+		self.channels.clear()
+
+	def forget(self):
+		key = (self.ID, self.apikey)
+		if self.io_thread.connections.get(key) is self:
+			del self.io_thread.connections[key]
+
+	def attach(self, channel):
+		self.channels.add(channel)
+		if self.is_open:
+			channel.on_connection_open(self.connection)
+
+	def detach(self, channel):
+		self.channels.discard(channel)
+		if not self.channels:
+			self.close()
+
+	def close(self):
+		self.forget()
+		self.closed = True
+		# (a connection that is still opening can't be closed
+		# by pika 0.13; it is closed once it opens, see on_open)
+		if self.is_open and not (self.connection.is_closed or self.connection.is_closing):
+			self.connection.close()
+
+
+class PooledChannel(object):
+	""" Handle for a channel on a pooled connection.
+	All methods are thread-safe and non-blocking. Operations issued
+	before the channel is open are buffered and performed once it opens.
+	Consumer callbacks are called on the I/O thread with the usual
+	pika arguments (channel, method, properties, body).
+	"""
+	def __init__(self, io_thread, ID, apikey):
+		self.io_thread = io_thread
+		self.ID = ID
+		self.apikey = apikey
+		self.channel = None      # the pika channel, once open
+		self.pending = deque()   # operations issued before the channel opened
+		self.closed = False
+		
+		# publisher confirms (see enable_confirms)
+		self.on_confirm = None
+		self.on_return = None
+		self.next_delivery_tag = 1
+		self.unconfirmed = OrderedDict() # delivery tags awaiting a confirm
+		
+		# callbacks of purges and drains in progress (see purge and drain)
+		self.waiting = set()
+		
+		self.io_thread.call(self.io_thread.attach, self)
+
+	def publish(self, exchange, routing_key, body, properties=None):
+		self.io_thread.call(self._publish_batch, [(exchange, routing_key, body, properties)])
+
+	# publish a list of (exchange, routing_key, body, properties) 
+	# tuples as a single burst.
+	def publish_batch(self, messages):
+		self.io_thread.call(self._publish_batch, list(messages))
+
+	def consume(self, queue, callback):
+		self.io_thread.call(self._consume, queue, callback)
+
+	def enable_confirms(self, on_confirm, on_return=None):
+		""" Turn on publisher confirms for this channel. Must be called
+		before anything is published. Messages are then published
+		as mandatory. On the I/O thread, on_confirm(num_acked, num_nacked) 
+		is called whenever the broker confirms messages (messages lost 
+		because the channel was closed are reported as nacked)
+		and on_return() is called for each message returned as unroutable.
+		"""
+		self.on_confirm = on_confirm
+		self.on_return = on_return
+		self.io_thread.call(self._enable_confirms)
+
+	def purge(self, queue, on_done):
+		""" Remove all the messages in <queue>. On the I/O thread,
+		on_done(count) is called with the number of messages removed
+		(or None if the channel was closed, for example because
+		the queue does not exist)."""
+		self.io_thread.call(self._purge, queue, on_done)
+
+	def drain(self, queue, on_done, prefetch=1000, idle_timeout=1.0):
+		""" Consume and discard the messages in <queue>, with up to
+		<prefetch> messages in flight (acknowledged in bulk), until none
+		arrive for <idle_timeout> seconds. Then on_done(count) is called
+		as for purge()."""
+		self.io_thread.call(self._drain, queue, on_done, prefetch, idle_timeout)
+
+	def close(self):
+		self.io_thread.call(self._close)
+
+	# the following are called on the I/O thread only.
+	def on_connection_open(self, connection):
+		if not self.closed:
+			connection.channel(on_open_callback=self.on_channel_open)
+
+	def on_channel_open(self, channel):
+		if self.closed:
+			channel.close()
+			return
+		self.channel = channel
+		self.channel.add_on_close_callback(self.on_channel_closed)
+		while self.pending:
+			operation = self.pending.popleft()
+			operation()
+
+	def on_channel_closed(self, channel, reply_code, reply_text):
+		self.channel = None
+		if not self.closed:
+			# operations on a channel closed by the broker are dropped.
+			logger.error("Pooled channel for ID={} was closed: ({}) {}".format(self.ID, reply_code, reply_text))
+			self.closed = True
+			self.drop_unconfirmed()
+		waiting = self.waiting
+		self.waiting = set()
+		for on_done in waiting:
+			on_done(None)
+
+	def on_delivery_confirmation(self, method_frame):
+		method = method_frame.method
+		if method.multiple:
+			settled = 0
+			while self.unconfirmed and next(iter(self.unconfirmed)) <= method.delivery_tag:
+				self.unconfirmed.popitem(last=False)
+				settled += 1
+		else:
+			settled = 0
+			if method.delivery_tag in self.unconfirmed:
+				del self.unconfirmed[method.delivery_tag]
+				settled = 1
+		if method.NAME == "Basic.Ack":
+			self.on_confirm(settled, 0)
+		else:
+			self.on_confirm(0, settled)
+
+	def on_message_returned(self, channel, method, properties, body):
+		if self.on_return is not None:
+			self.on_return()
+
+	# report all messages that can no longer be confirmed as nacked.
+	def drop_unconfirmed(self):
+		lost = len(self.unconfirmed)
+		self.unconfirmed.clear()
+		for operation in self.pending:
+			if operation.func == self._publish_batch:
+				lost += len(operation.args[0])
+		self.pending.clear()
+		if lost and self.on_confirm is not None:
+			self.on_confirm(0, lost)
+
+	def _enable_confirms(self):
+		if self.closed:
+			return
+		if self.channel is None:
+			self.pending.append(functools.partial(self._enable_confirms))
+			return
+		self.channel.confirm_delivery(self.on_delivery_confirmation)
+		self.channel.add_on_return_callback(self.on_message_returned)
+
+	def _publish_batch(self, messages):
+		if self.closed:
+			if self.on_confirm is not None:
+				self.on_confirm(0, len(messages))
+			return
+		if self.channel is None:
+			self.pending.append(functools.partial(self._publish_batch, messages))
+			return
+		confirms = self.on_confirm is not None
+		for exchange, routing_key, body, properties in messages:
+			self.channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body, 
+				properties=properties, mandatory=confirms)
+			if confirms:
+				self.unconfirmed[self.next_delivery_tag] = None
+				self.next_delivery_tag += 1
+
+	def _consume(self, queue, callback):
+		if self.closed:
+			return
+		if self.channel is None:
+			self.pending.append(functools.partial(self._consume, queue, callback))
+			return
+		self.channel.basic_consume(callback, queue=queue, no_ack=True)
+
+	def _purge(self, queue, on_done):
+		if self.closed:
+			on_done(None)
+			return
+		if self.channel is None:
+			# (on_done(None) if the channel fails to open)
+			self.waiting.add(on_done)
+			self.pending.append(functools.partial(self._purge, queue, on_done))
+			return
+		self.waiting.add(on_done)
+		def on_purged(method_frame):
+			if on_done in self.waiting:
+				self.waiting.discard(on_done)
+				on_done(method_frame.method.message_count)
+		self.channel.queue_purge(on_purged, queue=queue)
+
+	def _drain(self, queue, on_done, prefetch, idle_timeout):
+		if self.closed:
+			on_done(None)
+			return
+		if self.channel is None:
+			# (on_done(None) if the channel fails to open)
+			self.waiting.add(on_done)
+			self.pending.append(functools.partial(self._drain, queue, on_done, prefetch, idle_timeout))
+			return
+		self.waiting.add(on_done)
+		channel = self.channel
+		state = {"count": 0, "unacked": 0, "last_count": 0, "consumer_tag": None}
+
+		def on_message(ch, method, properties, body):
+			state["count"] += 1
+			state["unacked"] += 1
+			# acknowledge in bulk, before the prefetch window fills up
+			if state["unacked"] >= max(1, prefetch // 2):
+				ch.basic_ack(method.delivery_tag, multiple=True)
+				state["unacked"] = 0
+			state["last_tag"] = method.delivery_tag
+
+		def check_idle():
+			if on_done not in self.waiting:
+				return
+			if state["count"] != state["last_count"]:
+				state["last_count"] = state["count"]
+				self.io_thread.call_later(idle_timeout, check_idle)
+				return
+			# no messages in the last <idle_timeout> seconds: done.
+			if state["unacked"]:
+				channel.basic_ack(state["last_tag"], multiple=True)
+			channel.basic_cancel(consumer_tag=state["consumer_tag"], nowait=True)
+			self.waiting.discard(on_done)
+			on_done(state["count"])
+
+		def on_qos(method_frame):
+			state["consumer_tag"] = channel.basic_consume(on_message, queue=queue, no_ack=False)
+			self.io_thread.call_later(idle_timeout, check_idle)
+
+		channel.basic_qos(on_qos, prefetch_count=prefetch)
+
+	def _close(self):
+		self.closed = True
+		self.drop_unconfirmed()
+		if self.channel is not None and self.channel.is_open:
+			self.channel.close()
+		self.channel = None
+		self.io_thread.detach(self)
+
+
+# called on the I/O thread.
+def _publish_many(messages):
+	for channel, exchange, routing_key, body, properties in messages:
+		channel._publish_batch([(exchange, routing_key, body, properties)])
+
+
+class ConnectionPool(object):
+	""" A fixed pool of I/O threads serving pooled AMQP connections.
+
+	Arguments:
+	    num_threads (optional): number of I/O threads.
+	        Defaults to the number of cores on the machine.
+	"""
+	# the type of I/O thread used by the pool
+	io_thread_class = IOThread
+
+	def __init__(self, num_threads=None):
+		if num_threads is None:
+			num_threads = os.cpu_count() or 1
+		assert(num_threads > 0)
+		self.io_threads = [self.io_thread_class("amqp-io-{}".format(i)) for i in range(num_threads)]
+		logger.info("{} created with {} I/O threads.".format(type(self).__name__, num_threads))
+
+	# open a channel for an entity. All channels of an entity
+	# are served by the same I/O thread and share one connection.
+	def open_channel(self, ID, apikey):
+		io_thread = self.io_threads[hash(ID) % len(self.io_threads)]
+		return PooledChannel(io_thread, ID, apikey)
+
+	def publish_many(self, messages):
+		""" Publish a list of (channel, exchange, routing_key, body, properties)
+		tuples, on channels opened from this pool, with one hand-over
+		to each I/O thread."""
+		batches = {}
+		for message in messages:
+			batches.setdefault(message[0].io_thread, []).append(message)
+		for io_thread, batch in batches.items():
+			io_thread.call(_publish_many, batch)
+
+	# close all connections and stop the I/O threads.
+	def close(self):
+		for io_thread in self.io_threads:
+			io_thread.stop()
+		logger.info("{} closed.".format(type(self).__name__))
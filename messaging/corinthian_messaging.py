@@ -33,33 +33,78 @@ admin_apikey = open(admin_passwd_file,"r").read()[:-1]
 # disable SSL check warnings.
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-# Create a requests session
-def create_session():
+# Create a requests session with a pool of up to <pool_size>
+# keep-alive connections to the middleware.
+# (Re-using a connection also re-uses its TLS session,
+# so the TLS handshake is done once per connection.)
+def create_session(pool_size=10):
 	s = requests.Session();
-	s.mount(Corinthian_base_url, HTTPAdapter(pool_connections=1))
+	s.mount(Corinthian_base_url, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True))
+	s.verify = False
 	return s
 
+
+class CorinthianClient(object):
+	""" HTTPS client for the middleware's REST API.
+	Owns a pool of keep-alive connections which can be shared by 
+	up to <pool_size> threads making requests at the same time. 
+	The pool size should match the concurrency of the caller: 
+	threads beyond <pool_size> wait for a free connection
+	instead of opening (and discarding) new ones.
+	"""
+	def __init__(self, pool_size=10):
+		assert(pool_size > 0)
+		self.pool_size = pool_size
+		self.session = create_session(pool_size)
+	
+	def get(self, url, **kwargs):
+		return self.session.get(url, **kwargs)
+	
+	def post(self, url, **kwargs):
+		return self.session.post(url, **kwargs)
+	
+	def close(self):
+		self.session.close()
+
+
+# client used by all API functions by default.
+default_client = CorinthianClient()
+
+def set_default_client(c):
+	""" Replace the client used by all API functions by default.
+	For example, set_default_client(CorinthianClient(pool_size=64))
+	before making requests from 64 threads.
+	"""
+	global default_client
+	default_client = c
+
+# The client used for a request. Each API function optionally takes 
+# a CorinthianClient or a requests session as an argument, 
+# or else uses the default client.
+def client(session=None):
+	return session if session else default_client
+
 # Common status code check for all APIs
 def check(response, code):
 	assert(response.status_code == code), "URL = "+response.url+"\n"+"Status code = " \
 	+str(response.status_code)+"\n"+"Message = "+response.text
 
-def register(entity_id):
+def register(entity_id, session=None):
 	url = Corinthian_base_url + "/owner/register-entity"
 	headers = {"id": "admin", "apikey": admin_apikey, "entity": entity_id, "is-autonomous": "true"}
-	r = requests.post(url=url, headers=headers, data="{\"test\":\"schema\"}", verify=False)
+	r = client(session).post(url=url, headers=headers, data="{\"test\":\"schema\"}", verify=False)
 	check(r,201)
 	return r.json()["apikey"]
 
-def deregister(entity_id):
+def deregister(entity_id, session=None):
 
 	url = Corinthian_base_url + "/owner/deregister-entity"
 	headers = {"id": "admin", "apikey": admin_apikey, "entity": entity_id}
-	r = requests.post(url=url, headers=headers, verify=False)
+	r = client(session).post(url=url, headers=headers, verify=False)
 	check(r,200)
 	return True
 
-def block_unblock(ID, apikey, entity_id, req_type):
+def block_unblock(ID, apikey, entity_id, req_type, session=None):
 
 	url = Corinthian_base_url 
 	if req_type == "block":
@@ -67,10 +112,10 @@ def block_unblock(ID, apikey, entity_id, req_type):
 	elif req_type == "unblock":
 		url = url + "/owner/unblock"
 	headers = {"id": ID, "apikey": apikey, "entity": entity_id}
-	r = requests.post(url=url, headers=headers, verify=False)
+	r = client(session).post(url=url, headers=headers, verify=False)
 	check(r,200)
 
-def permissions(ID, apikey, entity_id=""):
+def permissions(ID, apikey, entity_id="", session=None):
 
 	url = Corinthian_base_url + "/entity/permissions"
 	headers = {}
@@ -78,21 +123,18 @@ def permissions(ID, apikey, entity_id=""):
 		headers['entity'] = entity_id
 	headers ['id'] = ID
 	headers ['apikey'] = apikey
-	r = requests.get(url=url, headers=headers, verify=False)
+	r = client(session).get(url=url, headers=headers, verify=False)
 	check(r,200)
 
 def publish(ID, apikey, to, topic, message_type, data, session=None):
 
 	url = Corinthian_base_url + "/entity/publish"
 	headers = {"id": ID, "apikey": apikey, "to": to, "subject": topic, "message-type": message_type, "content-type": "text/plain"}
-	if(session):
-		r = session.post(url=url,headers=headers,data=data,verify=False)
-	else:
-		r = requests.post(url=url,headers=headers,data=data,verify=False)
+	r = client(session).post(url=url,headers=headers,data=data,verify=False)
 	check(r,202)
 	return True
 
-def follow(ID, apikey, to_id, permission, from_id="", topic ="", validity = "", message_type=""):
+def follow(ID, apikey, to_id, permission, from_id="", topic ="", validity = "", message_type="", session=None):
 
 	url = Corinthian_base_url + "/entity/follow"
 	headers = {}
@@ -114,18 +156,18 @@ def follow(ID, apikey, to_id, permission, from_id="", topic ="", validity = "",
 		headers['message-type'] = message_type
 	headers['permission'] = permission
 	
-	r = requests.post(url=url,headers=headers,verify=False)
+	r = client(session).post(url=url,headers=headers,verify=False)
 	check(r,202)
 	return r
 
-def reject_follow(ID, apikey, follow_id):
+def reject_follow(ID, apikey, follow_id, session=None):
 
 	url = Corinthian_base_url + "/entity/reject-follow"
 	headers = {"id": ID, "apikey": apikey, "follow-id": follow_id}
-	r = requests.post(url=url, headers=headers, verify=False)
+	r = client(session).post(url=url, headers=headers, verify=False)
 	check(r,200)
 
-def unfollow(ID, apikey, to, topic, permission, message_type, from_id=""):
+def unfollow(ID, apikey, to, topic, permission, message_type, from_id="", session=None):
 
 	url = Corinthian_base_url + "/entity/unfollow"
 	headers = {}
@@ -138,17 +180,17 @@ def unfollow(ID, apikey, to, topic, permission, message_type, from_id=""):
 	headers['permission'] = permission
 	headers['message-type'] = message_type 
 	
-	r = requests.post(url=url,headers=headers,verify=False)
+	r = client(session).post(url=url,headers=headers,verify=False)
 	check(r,200)
 
-def share(ID, apikey, follow_id):
+def share(ID, apikey, follow_id, session=None):
 
 	url = Corinthian_base_url + "/entity/share"
 	headers = {"id": ID, "apikey": apikey, "follow-id": follow_id}
-	r = requests.post(url=url, headers=headers, verify=False)
+	r = client(session).post(url=url, headers=headers, verify=False)
 	check(r,200)
 
-def bind_unbind(ID, apikey, to, topic, message_type, from_id="", is_priority="false", req_type="bind"):
+def bind_unbind(ID, apikey, to, topic, message_type, from_id="", is_priority="false", req_type="bind", session=None):
 
 	url = Corinthian_base_url
 	headers = {}
@@ -167,7 +209,7 @@ def bind_unbind(ID, apikey, to, topic, message_type, from_id="", is_priority="fa
 	headers['to'] = to
 	headers['topic'] = topic
 	headers['is-priority'] = is_priority 
-	r = requests.post(url=url, headers=headers, verify=False)
+	r = client(session).post(url=url, headers=headers, verify=False)
 	check(r,200)
 
 def subscribe(ID, apikey, message_type="", num_messages="",session=None):
@@ -180,14 +222,11 @@ def subscribe(ID, apikey, message_type="", num_messages="",session=None):
 		headers['num-messages'] = num_messages
 	headers['id'] = ID
 	headers['apikey'] = apikey
-	if(session):
-		r = session.get(url=url, headers=headers, verify=False)
-	else:
-		r = requests.get(url=url, headers=headers, verify=False)
+	r = client(session).get(url=url, headers=headers, verify=False)
 	check(r,200)
 	return r
 
-def follow_requests(ID, apikey, request_type):
+def follow_requests(ID, apikey, request_type, session=None):
 
 	url = Corinthian_base_url
 	if request_type == "requests":
@@ -195,7 +234,7 @@ def follow_requests(ID, apikey, request_type):
 	elif request_type == "status":
 		url = url + "/entity/follow-status"
 	headers = {"id": ID, "apikey": apikey}
-	r = requests.get(url=url, headers=headers, verify=False)
+	r = client(session).get(url=url, headers=headers, verify=False)
 	check(r,200)
 	return r
 
@@ -0,0 +1,304 @@
+#! python3
+#
+# A pool of pre-registered entities, leased out to test runs.
+#
+# Registering a large fleet and setting up its permissions takes much
+# longer than most test runs. An entity pool keeps a fleet registered
+# (in a registration store, see registration_store.py) so that test runs
+# can lease a part of it instead of doing their own setup.
+#
+# The fleet of a pool is divided into <num_blocks> blocks of
+# <devices_per_block> devices and <apps_per_block> apps. The apps of a
+# block have read-write permission for the devices of the same block only,
+# so test runs using different blocks (even against the same middleware)
+# never receive each other's messages. A lease is for one block.
+#
+# The leases are kept in the store itself (a SQLite database), so the
+# test runs leasing from a pool can be separate processes, run by several
+# users on the same machine. A lease expires after <duration> seconds
+# unless it is renewed, so the blocks of runs that died are reclaimed.
+# Before a block is leased again, the messages left queued for its apps
+# and devices (by the previous run) are drained.
+#
+# Usage:
+#	pool = create_pool("entity_pool", num_blocks=8, devices_per_block=1000, apps_per_block=2)
+#	...
+#	pool = EntityPool("entity_pool")
+#	with pool.lease(num_devices=500, num_apps=1) as lease:
+#		run_simulation("entity_pool", 500, 1, 60, lease=lease)
+#	...
+#	destroy_pool("entity_pool")
+
+from __future__ import print_function
+import os
+import time
+import uuid
+import socket
+import getpass
+import sqlite3
+import logging
+logger = logging.getLogger(__name__)
+
+import setup_entities
+import setup_journal
+import registration_store
+import queue_drain
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pool (
+	key TEXT PRIMARY KEY,
+	value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS leases (
+	block INTEGER PRIMARY KEY,
+	lease_id TEXT,
+	owner TEXT,
+	expires REAL,
+	dirty INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+# time (in seconds) between attempts to lease a block
+LEASE_POLL_INTERVAL = 1.0
+
+
+def default_owner():
+	return "{}@{}:{}".format(getpass.getuser(), socket.gethostname(), os.getpid())
+
+
+def store_path(name):
+	return name if name.endswith(".db") else name + ".db"
+
+
+class Lease(object):
+	""" A lease of the entities of one block of an entity pool."""
+
+	def __init__(self, pool, lease_id, block, devices, apps, expires):
+		self.pool = pool
+		self.lease_id = lease_id
+		self.block = block
+		self.devices = devices
+		self.apps = apps
+		self.expires = expires
+
+	def renew(self, duration):
+		self.pool.renew(self, duration)
+
+	def release(self, drain=True):
+		self.pool.release(self, drain)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.release()
+
+	def __repr__(self):
+		return "Lease({}, block {}: {} devices, {} apps)".format(self.lease_id, self.block, len(self.devices), len(self.apps))
+
+
+class EntityPool(object):
+	""" The entity pool in the registration store <name>
+	(see registration_store.open_store). Residual messages are
+	removed by drain(entities, apikeys), where entities are (ID, queue)
+	(see queue_drain.drain_queues)."""
+
+	def __init__(self, name, drain=queue_drain.drain_queues):
+		self.name = name
+		self.path = store_path(name)
+		self.drain_queues = drain
+		assert(os.path.exists(self.path)), "No entity pool {} (create it first)".format(self.path)
+		# (isolation_level=None: transactions are begun explicitly)
+		self.db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+		self.db.executescript(SCHEMA)
+		settings = dict(self.db.execute("SELECT key, value FROM pool"))
+		assert(settings), "{} is not an entity pool".format(self.path)
+		self.num_blocks = settings["num_blocks"]
+		self.devices_per_block = settings["devices_per_block"]
+		self.apps_per_block = settings["apps_per_block"]
+
+	def block_entities(self, block):
+		""" The devices and apps of a block."""
+		store = registration_store.RegistrationStore(self.path)
+		try:
+			devices = store.entities("device", block*self.devices_per_block, (block+1)*self.devices_per_block)
+			apps = store.entities("app", block*self.apps_per_block, (block+1)*self.apps_per_block)
+			apikeys = store.apikeys(devices + apps)
+		finally:
+			store.close()
+		return devices, apps, apikeys
+
+	def drain(self, block):
+		""" Remove the messages left in the queues of a block."""
+		devices, apps, apikeys = self.block_entities(block)
+		removed = self.drain_queues(queue_drain.entity_queues(apps, devices), apikeys)
+		failed = [q for q, count in removed.items() if count is None]
+		assert(not failed), "Could not drain the queues {} of block {}".format(failed[:10], block)
+		total = sum(removed.values())
+		if total:
+			logger.info("ENTITY POOL: removed {} residual messages from block {}.".format(total, block))
+		return removed
+
+	def lease(self, num_devices=None, num_apps=None, owner=None, duration=3600, timeout=0):
+		""" Lease a free block with at least <num_devices> devices and
+		<num_apps> apps (all the entities of the block by default), for
+		<duration> seconds. Waits up to <timeout> seconds for a block to
+		become free. Returns a Lease, with the first <num_devices> devices
+		and <num_apps> apps of the block."""
+		num_devices = self.devices_per_block if num_devices is None else num_devices
+		num_apps = self.apps_per_block if num_apps is None else num_apps
+		assert(0 < num_devices <= self.devices_per_block and 0 < num_apps <= self.apps_per_block), \
+			"The blocks of pool {} have {} devices and {} apps".format(self.name, self.devices_per_block, self.apps_per_block)
+		owner = owner or default_owner()
+		deadline = time.time() + timeout
+		while True:
+			claimed = self.claim(owner, duration)
+			if claimed is not None:
+				break
+			assert(time.time() < deadline), "All the {} blocks of pool {} are leased".format(self.num_blocks, self.name)
+			time.sleep(LEASE_POLL_INTERVAL)
+		lease_id, block, needs_drain, expires = claimed
+		try:
+			if needs_drain:
+				self.drain(block)
+			devices, apps, apikeys = self.block_entities(block)
+		except:
+			self.free(lease_id, block, dirty=needs_drain)
+			raise
+		logger.info("ENTITY POOL: {} leased block {} of {} until {}.".format(owner, block, self.name, time.ctime(expires)))
+		return Lease(self, lease_id, block, devices[:num_devices], apps[:num_apps], expires)
+
+	def claim(self, owner, duration):
+		""" Claim the first free (or expired) block.
+		Returns (lease ID, block, needs drain, expiry time) or None."""
+		now = time.time()
+		self.db.execute("BEGIN IMMEDIATE")
+		try:
+			leases = dict((r[0], r[1:]) for r in self.db.execute("SELECT block, lease_id, expires, dirty FROM leases"))
+			for block in range(self.num_blocks):
+				lease_id, expires, dirty = leases.get(block, (None, None, 0))
+				if lease_id is not None and expires > now:
+					continue
+				if lease_id is not None:
+					logger.warning("ENTITY POOL: the lease {} of block {} expired. Reclaiming the block.".format(lease_id, block))
+				new_id = uuid.uuid4().hex
+				self.db.execute("INSERT OR REPLACE INTO leases VALUES (?, ?, ?, ?, ?)",
+					(block, new_id, owner, now + duration, 1 if (dirty or lease_id is not None) else 0))
+				self.db.execute("COMMIT")
+				return new_id, block, bool(dirty or lease_id is not None), now + duration
+			self.db.execute("COMMIT")
+			return None
+		except:
+			self.db.execute("ROLLBACK")
+			raise
+
+	def renew(self, lease, duration):
+		""" Extend a lease to <duration> seconds from now."""
+		expires = time.time() + duration
+		cursor = self.db.execute("UPDATE leases SET expires = ? WHERE block = ? AND lease_id = ?",
+			(expires, lease.block, lease.lease_id))
+		assert(cursor.rowcount == 1), "{} has expired and been reclaimed".format(lease)
+		lease.expires = expires
+
+	def free(self, lease_id, block, dirty):
+		self.db.execute("UPDATE leases SET lease_id = NULL, owner = NULL, expires = NULL, dirty = ? WHERE block = ? AND lease_id = ?",
+			(1 if dirty else 0, block, lease_id))
+
+	def release(self, lease, drain=True):
+		""" Release a lease, draining the queues of its block first (or
+		else marking the block to be drained before it is leased again)."""
+		current = self.db.execute("SELECT lease_id FROM leases WHERE block = ?", (lease.block,)).fetchone()
+		if current is None or current[0] != lease.lease_id:
+			# don't drain the queues of the run that reclaimed the block
+			logger.warning("ENTITY POOL: {} had expired and been reclaimed.".format(lease))
+			return
+		if drain:
+			self.drain(lease.block)
+		self.free(lease.lease_id, lease.block, dirty=not drain)
+		logger.info("ENTITY POOL: released block {} of {}.".format(lease.block, self.name))
+
+	def status(self):
+		""" A list of (block, owner, expiry time) of the active leases."""
+		now = time.time()
+		return [r for r in self.db.execute("SELECT block, owner, expires FROM leases WHERE lease_id IS NOT NULL AND expires > ? ORDER BY block", (now,))]
+
+	def close(self):
+		self.db.close()
+
+
+def pool_description(num_blocks, devices_per_block, apps_per_block, device_prefix="pooldevice", app_prefix="poolapp"):
+	""" The system description of a pool: the apps of each block
+	have read-write permission for the devices of the same block."""
+	devices = [device_prefix+str(i) for i in range(num_blocks*devices_per_block)]
+	apps = [app_prefix+str(i) for i in range(num_blocks*apps_per_block)]
+	permissions = []
+	for b in range(num_blocks):
+		block_devices = devices[b*devices_per_block:(b+1)*devices_per_block]
+		for a in apps[b*apps_per_block:(b+1)*apps_per_block]:
+			permissions += [(a, d, "read-write") for d in block_devices]
+	return {"devices": devices, "apps": apps, "permissions": permissions}
+
+
+def create_pool(name, num_blocks, devices_per_block, apps_per_block, concurrency=8, backend="threads",
+		device_prefix="pooldevice", app_prefix="poolapp", journal_path=None):
+	""" Register the fleet of a new entity pool and save it in the registration
+	store <name>. The setup is recorded in a setup journal (<name>.journal.jsonl
+	by default), so that it can be resumed if it fails. Returns the EntityPool."""
+	path = store_path(name)
+	assert(not os.path.exists(path)), "{} already exists".format(path)
+	assert(num_blocks > 0 and devices_per_block > 0 and apps_per_block > 0)
+	description = pool_description(num_blocks, devices_per_block, apps_per_block, device_prefix, app_prefix)
+	setup_module = setup_entities
+	if backend == "asyncio":
+		import async_setup_entities
+		setup_module = async_setup_entities
+	journal_path = journal_path or path + ".journal.jsonl"
+	journal = setup_journal.SetupJournal(journal_path)
+	store = registration_store.RegistrationStore(path)
+	try:
+		success, registered_entities = setup_module.register_entities(description, store,
+			concurrency=concurrency, journal=journal)
+		assert(success)
+		db = store.db
+		db.executescript(SCHEMA)
+		with db:
+			db.executemany("INSERT INTO pool VALUES (?, ?)", [("num_blocks", num_blocks),
+				("devices_per_block", devices_per_block), ("apps_per_block", apps_per_block)])
+	except:
+		# no partial pool: the setup is resumed from the journal.
+		store.close()
+		os.remove(path)
+		raise
+	finally:
+		journal.close()
+	store.close()
+	os.remove(journal_path)
+	logger.info("ENTITY POOL: created {} with {} blocks of {} devices and {} apps.".format(
+		path, num_blocks, devices_per_block, apps_per_block))
+	return EntityPool(name)
+
+
+def destroy_pool(name, concurrency=8, backend="threads", force=False):
+	""" Deregister the fleet of an entity pool and remove its store.
+	Unless <force> is set, there must not be any active leases."""
+	pool = EntityPool(name)
+	active = pool.status()
+	pool.close()
+	assert(force or not active), "The pool {} has active leases: {}".format(name, active)
+	store = registration_store.open_store(name)
+	entities = store.entities("device") + store.entities("app")
+	store.close()
+	setup_module = setup_entities
+	if backend == "asyncio":
+		import async_setup_entities
+		setup_module = async_setup_entities
+	journal_path = store_path(name) + ".journal.jsonl"
+	journal = setup_journal.SetupJournal(journal_path)
+	try:
+		setup_module.deregister_entities(entities, concurrency, journal=journal)
+	finally:
+		journal.close()
+	os.remove(store_path(name))
+	os.remove(journal_path)
+	logger.info("ENTITY POOL: destroyed {}.".format(name))
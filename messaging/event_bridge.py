@@ -0,0 +1,147 @@
+# !python3
+#
+# Waking up SimPy processes when messages arrive.
+#
+# The communication interfaces receive messages on their own threads
+# (or on the I/O threads of a shared transport) and push them into queues.
+# Instead of polling these queues periodically, an entity can wait on a
+# MessageSignal: a SimPy event that is triggered as soon as a message is
+# pushed into the queue of an interface.
+#
+# SimPy environments are not thread-safe, so events cannot be triggered
+# from other threads directly. The WakeableRealtimeEnvironment is a
+# RealtimeEnvironment that other threads can hand calls to. While it waits
+# for the time of its next event, it wakes up for such calls and runs them
+# at the current (real) simulation time.
+#
+# In a plain simpy.Environment, messages can only be delivered on the
+# simulation's own thread (as with the local_broker), so signals work
+# there as well. In any other environment, MessageSignal.wait() falls back
+# to a timeout, that is, to polling.
+#
+# Usage (in an entity model):
+#	self.data_arrived = event_bridge.MessageSignal(env, self.subscribe_thread)
+#	...
+#	yield self.data_arrived.wait(self.period)
+#	while not self.subscribe_thread.queue.empty(): ...
+
+from __future__ import print_function
+import threading
+from collections import deque
+from time import monotonic
+import logging
+logger = logging.getLogger(__name__)
+import simpy
+import simpy.rt
+from simpy.core import EmptySchedule, Environment, Infinity
+
+
+class WakeableRealtimeEnvironment(simpy.rt.RealtimeEnvironment):
+	""" A RealtimeEnvironment whose waits for the next event can be
+	interrupted by calls handed over from other threads (call_threadsafe).
+	"""
+	def __init__(self, initial_time=0, factor=1.0, strict=True):
+		super(WakeableRealtimeEnvironment, self).__init__(initial_time, factor, strict)
+		self.lock = threading.Lock()
+		self.calls = deque()
+		self.wakeup = threading.Event()
+		self.thread_ident = None
+		# optional function called to process each event in place of
+		# Environment.step (see lag_monitor.py)
+		self.step_monitor = None
+
+	def call_threadsafe(self, fn, *args):
+		""" Call fn(*args) on the thread running the simulation."""
+		if threading.get_ident() == self.thread_ident:
+			fn(*args)
+			return
+		with self.lock:
+			self.calls.append((fn, args))
+		self.wakeup.set()
+
+	def run_calls(self):
+		with self.lock:
+			calls = self.calls
+			self.calls = deque()
+		if not calls:
+			return
+		# advance the simulation time to the current real time
+		# (but not beyond the next scheduled event).
+		now = self.env_start + (monotonic() - self.real_start) / self.factor
+		self._now = max(self._now, min(now, self.peek()))
+		for fn, args in calls:
+			fn(*args)
+
+	def step(self):
+		""" Process the next event after enough real time has passed
+		for it to happen, running the calls handed over in the meantime."""
+		self.thread_ident = threading.get_ident()
+		while True:
+			self.run_calls()
+			evt_time = self.peek()
+			if evt_time is Infinity:
+				raise EmptySchedule
+			real_time = self.real_start + (evt_time - self.env_start) * self.factor
+			delta = real_time - monotonic()
+			if delta <= 0:
+				break
+			self.wakeup.wait(delta)
+			self.wakeup.clear()
+		if self.strict and -delta > self.factor:
+			raise RuntimeError('Simulation too slow for real time ({:.3f}s).'.format(-delta))
+		if self.step_monitor is not None:
+			self.step_monitor(self)
+		else:
+			Environment.step(self)
+
+
+class MessageSignal(object):
+	""" SimPy event triggered when a message is pushed into the queue
+	of a communication interface (see the on_message hook of the
+	SubscribeInterface, ReceiveCommandsInterface and
+	FleetReceiveCommandsInterface).
+	Only one process at a time should wait on a signal.
+	"""
+	def __init__(self, env, interface):
+		self.env = env
+		self.interface = interface
+		self.lock = threading.Lock()
+		self.event = None
+
+		# can messages wake up the simulation?
+		if isinstance(env, WakeableRealtimeEnvironment):
+			self.wakeable = True
+		else:
+			self.wakeable = not isinstance(env, simpy.rt.RealtimeEnvironment)
+		if self.wakeable:
+			interface.on_message = self.notify
+
+	def wait(self, timeout):
+		""" An event that is triggered once there is a message in the
+		interface's queue. If the environment can't be woken up by messages,
+		this is a timeout of <timeout> seconds instead."""
+		if not self.wakeable:
+			return self.env.timeout(timeout)
+		with self.lock:
+			event = self.env.event()
+			if not self.interface.queue.empty():
+				event.succeed()
+			else:
+				self.event = event
+			return event
+
+	# called by the interface (on any thread) after a message was queued.
+	def notify(self):
+		with self.lock:
+			event = self.event
+			self.event = None
+		if event is None:
+			return
+		if isinstance(self.env, WakeableRealtimeEnvironment):
+			self.env.call_threadsafe(self.trigger, event)
+		else:
+			self.trigger(event)
+
+	def trigger(self, event):
+		if not event.triggered:
+			event.succeed()
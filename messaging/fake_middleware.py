@@ -0,0 +1,743 @@
+# !python3
+#
+# A standalone fake of the Corinthian middleware for offline load testing.
+#
+# The fake middleware serves the HTTPS API used by corinthian_messaging.py
+# (registrations, follow/share, bind/unbind, publish/subscribe etc.)
+# and accepts AMQP connections (over TLS) from pika, well enough for
+# the communication interfaces to publish, consume, get and purge.
+# Messages are routed in memory by a local_broker.LocalBroker, so the
+# exchanges, queues and permissions behave as they do in the middleware:
+#
+#	<device>.protected : data published by a device, delivered to the
+#	                     queues of the apps bound to it.
+#	<app>.publish      : commands published by an app with routing key
+#	                     <device>.command.# , delivered to <device>.command
+#	                     if the app has a write permission for the device.
+#
+# Nothing is persisted and there is no real access control beyond
+# checking apikeys, permissions and the user_id of published messages.
+# This is meant for measuring the client side of the test setup
+# (setup scripts, interfaces, entity models) on a machine without
+# a middleware, and for comparing it against the real middleware.
+#
+# The server keeps counters of requests (with their handling times)
+# per HTTP endpoint and of AMQP connections and messages. They are logged
+# every <report_interval> seconds and can be fetched from GET /fake/stats.
+#
+# By default the server listens on the ports used by corinthian_messaging.py
+# (HTTPS on 443, AMQP over TLS on 5671) with a self-signed certificate
+# generated at start-up (requires the openssl command).
+#
+# Requires the aiohttp library.
+#
+# Usage:
+#	$ python3 fake_middleware.py
+
+from __future__ import print_function
+import os
+import ssl
+import json
+import time
+import asyncio
+import tempfile
+import functools
+import subprocess
+import logging
+logger = logging.getLogger(__name__)
+from aiohttp import web
+import pika
+import pika.frame
+import pika.spec
+
+from corinthian_messaging import admin_apikey
+import local_broker
+from permission_handshake import single_permissions
+
+
+def make_self_signed_certificate(directory):
+	""" Create a self-signed certificate for localhost in <directory>.
+	Returns the paths of the certificate and key files."""
+	certfile = os.path.join(directory, "cert.pem")
+	keyfile = os.path.join(directory, "key.pem")
+	subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+		"-keyout", keyfile, "-out", certfile, "-days", "1", "-subj", "/CN=localhost"],
+		stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	return certfile, keyfile
+
+
+#=============================
+# Counters
+#=============================
+
+class RequestCounter(object):
+	""" Number of requests and their handling times."""
+	def __init__(self):
+		self.count = 0
+		self.total_time = 0.0
+		self.max_time = 0.0
+
+	def record(self, elapsed):
+		self.count += 1
+		self.total_time += elapsed
+		self.max_time = max(self.max_time, elapsed)
+
+	def report(self):
+		return {"count": self.count,
+			"mean_ms": round(1000*self.total_time/self.count, 3) if self.count else 0,
+			"max_ms": round(1000*self.max_time, 3)}
+
+
+class Stats(object):
+	""" Counters kept by the fake middleware."""
+	def __init__(self):
+		self.start_time = time.perf_counter()
+		# path : RequestCounter
+		self.requests = {}
+		self.amqp_connections = 0       # connections opened in total
+		self.amqp_open_connections = 0  # connections open at the moment
+		self.amqp_published = 0         # messages published over AMQP
+		self.amqp_delivered = 0         # messages delivered over AMQP
+		self.amqp_returned = 0          # unroutable messages returned
+		self.amqp_rejected = 0          # messages rejected (bad user_id/exchange)
+
+		# totals at the last periodic report (for the rates)
+		self.last_report = (self.start_time, 0, 0, 0)
+
+	def record_request(self, path, elapsed):
+		if path not in self.requests:
+			self.requests[path] = RequestCounter()
+		self.requests[path].record(elapsed)
+
+	def total_requests(self):
+		return sum(c.count for c in self.requests.values())
+
+	def report(self):
+		elapsed = time.perf_counter() - self.start_time
+		return {"uptime": round(elapsed, 3),
+			"http": dict((path, c.report()) for path, c in sorted(self.requests.items())),
+			"amqp": {"connections": self.amqp_connections,
+				"open_connections": self.amqp_open_connections,
+				"published": self.amqp_published,
+				"delivered": self.amqp_delivered,
+				"returned": self.amqp_returned,
+				"rejected": self.amqp_rejected}}
+
+	def log_rates(self):
+		now = time.perf_counter()
+		last_time, last_requests, last_published, last_delivered = self.last_report
+		requests = self.total_requests()
+		interval = max(now - last_time, 1e-9)
+		logger.info("FAKE_MIDDLEWARE: HTTP {} requests ({:.1f}/s), AMQP {} connections open, "
+			"{} published ({:.1f}/s), {} delivered ({:.1f}/s)".format(
+			requests, (requests - last_requests)/interval, self.amqp_open_connections,
+			self.amqp_published, (self.amqp_published - last_published)/interval,
+			self.amqp_delivered, (self.amqp_delivered - last_delivered)/interval))
+		self.last_report = (now, requests, self.amqp_published, self.amqp_delivered)
+
+
+#=============================
+# The middleware
+#=============================
+
+class FakeMiddleware(object):
+	""" State of the fake middleware: registered entities, follow requests,
+	permissions and the message broker. Serves the HTTPS API.
+	"""
+	def __init__(self):
+		self.broker = local_broker.LocalBroker()
+		self.stats = Stats()
+
+		# registered entities: "admin/<entity>" : apikey
+		self.apikeys = {}
+		self.blocked = set()
+
+		# follow requests: follow-id : dict as returned by follow-status
+		self.follow_requests = {}
+		self.next_follow_id = 1
+
+		# (app, device) pairs for which a read permission was granted
+		self.read_permissions = set()
+
+		self.routes = {
+			("POST", "/owner/register-entity"):   self.register_entity,
+			("POST", "/owner/deregister-entity"): self.deregister_entity,
+			("POST", "/owner/block"):             self.block,
+			("POST", "/owner/unblock"):           self.unblock,
+			("GET",  "/entity/permissions"):      self.permissions,
+			("POST", "/entity/publish"):          self.publish,
+			("POST", "/entity/follow"):           self.follow,
+			("POST", "/entity/unfollow"):         self.unfollow,
+			("POST", "/entity/share"):            self.share,
+			("POST", "/entity/reject-follow"):    self.reject_follow,
+			("GET",  "/entity/follow-requests"):  self.pending_follow_requests,
+			("GET",  "/entity/follow-status"):    self.follow_status,
+			("POST", "/entity/bind"):             self.bind,
+			("POST", "/entity/unbind"):           self.unbind,
+			("GET",  "/entity/subscribe"):        self.subscribe,
+			("GET",  "/fake/stats"):              self.get_stats,
+		}
+
+	#---------------------------
+	# HTTP request handling
+	#---------------------------
+	async def handle(self, request):
+		start = time.perf_counter()
+		handler = self.routes.get((request.method, request.path))
+		try:
+			if handler is None:
+				return error(404, "No such API")
+			return await handler(request)
+		finally:
+			self.stats.record_request(request.path, time.perf_counter() - start)
+
+	def check_owner(self, headers):
+		return headers.get("id") == "admin" and headers.get("apikey") == admin_apikey
+
+	def check_entity(self, headers):
+		ID = headers.get("id")
+		return ID in self.apikeys and self.apikeys[ID] == headers.get("apikey") and ID not in self.blocked
+
+	async def register_entity(self, request):
+		h = request.headers
+		if not self.check_owner(h):
+			return error(403, "Unauthorized")
+		ID = "admin/"+h.get("entity", "")
+		if ID in self.apikeys:
+			return error(409, "Entity already exists")
+		self.apikeys[ID] = os.urandom(16).hex()
+		self.broker.register_entity(ID)
+		return web.json_response({"id": ID, "apikey": self.apikeys[ID]}, status=201)
+
+	async def deregister_entity(self, request):
+		h = request.headers
+		if not self.check_owner(h):
+			return error(403, "Unauthorized")
+		ID = h.get("entity", "")
+		if ID not in self.apikeys:
+			return error(400, "No such entity")
+		del self.apikeys[ID]
+		self.blocked.discard(ID)
+		self.broker.deregister_entity(ID)
+		self.read_permissions = set(p for p in self.read_permissions if ID not in p)
+		for follow_id, r in list(self.follow_requests.items()):
+			if ID in (r["from"], r["to"]):
+				del self.follow_requests[follow_id]
+		return web.Response(text="")
+
+	async def block(self, request):
+		return self.block_unblock(request, True)
+
+	async def unblock(self, request):
+		return self.block_unblock(request, False)
+
+	def block_unblock(self, request, blocked):
+		h = request.headers
+		if not self.check_owner(h):
+			return error(403, "Unauthorized")
+		ID = h.get("entity", "")
+		if ID not in self.apikeys:
+			return error(400, "No such entity")
+		if blocked:
+			self.blocked.add(ID)
+		else:
+			self.blocked.discard(ID)
+		return web.Response(text="")
+
+	async def permissions(self, request):
+		h = request.headers
+		if not self.check_entity(h):
+			return error(403, "Unauthorized")
+		ID = h.get("entity") or h["id"]
+		result = []
+		for app, device in sorted(self.read_permissions):
+			if app == ID:
+				result.append({"entity": device, "permission": "read"})
+		for app, device in sorted(self.broker.write_permissions):
+			if app == ID:
+				result.append({"entity": device, "permission": "write"})
+		return web.json_response(result)
+
+	async def publish(self, request):
+		h = request.headers
+		if not self.check_entity(h):
+			return error(403, "Unauthorized")
+		ID = h["id"]
+		to = h.get("to", "")
+		message_type = h.get("message-type", "")
+		data = await request.read()
+		if message_type == "command":
+			exchange, routing_key = ID+".publish", to+".command.#"
+		elif message_type in ["protected", "public", "private"]:
+			if to != ID:
+				return error(403, "Entities can only publish to their own exchanges")
+			exchange, routing_key = ID+"."+message_type, h.get("subject", "#")
+		else:
+			return error(400, "Invalid message-type")
+		self.broker.publish(ID, exchange, routing_key, data, pika.BasicProperties(user_id=ID))
+		return web.Response(text="", status=202)
+
+	async def follow(self, request):
+		h = request.headers
+		if not self.check_entity(h):
+			return error(403, "Unauthorized")
+		requester = h.get("from") or h["id"]
+		to = h.get("to", "")
+		permission = h.get("permission", "")
+		if to not in self.apikeys:
+			return error(400, "No such entity")
+		if permission not in ["read", "write", "read-write"]:
+			return error(400, "Invalid permission")
+		response = {}
+		for p in single_permissions(permission):
+			follow_id = str(self.next_follow_id)
+			self.next_follow_id += 1
+			self.follow_requests[follow_id] = {"follow-id": follow_id, "from": requester, "to": to,
+				"time": time.strftime("%Y-%m-%d %H:%M:%S"), "permission": p,
+				"topic": h.get("topic", "#"), "validity": h.get("validity", "24"), "status": "pending"}
+			response["follow-id-"+p] = follow_id
+		return web.json_response(response, status=202)
+
+	async def unfollow(self, request):
+		h = request.headers
+		if not self.check_entity(h):
+			return error(403, "Unauthorized")
+		requester = h.get("from") or h["id"]
+		to = h.get("to", "")
+		permissions = single_permissions(h.get("permission", ""))
+		for follow_id, r in list(self.follow_requests.items()):
+			if r["from"] == requester and r["to"] == to and r["permission"] in permissions:
+				del self.follow_requests[follow_id]
+		for p in permissions:
+			if p == "read":
+				self.read_permissions.discard((requester, to))
+			self.broker.remove_permission(requester, to, p)
+		return web.Response(text="")
+
+	async def share(self, request):
+		return self.answer_follow_request(request, "approved")
+
+	async def reject_follow(self, request):
+		return self.answer_follow_request(request, "rejected")
+
+	def answer_follow_request(self, request, status):
+		h = request.headers
+		if not self.check_entity(h):
+			return error(403, "Unauthorized")
+		r = self.follow_requests.get(h.get("follow-id", ""))
+		if r is None or r["to"] != h["id"] or r["status"] != "pending":
+			return error(400, "No such follow request")
+		r["status"] = status
+		if status == "approved":
+			if r["permission"] == "read":
+				self.read_permissions.add((r["from"], r["to"]))
+			else:
+				self.broker.add_permission(r["from"], r["to"], "write")
+		return web.Response(text="")
+
+	async def pending_follow_requests(self, request):
+		h = request.headers
+		if not self.check_entity(h):
+			return error(403, "Unauthorized")
+		pending = [without_status(r) for r in self.follow_requests.values()
+			if r["to"] == h["id"] and r["status"] == "pending"]
+		return web.json_response(pending)
+
+	async def follow_status(self, request):
+		h = request.headers
+		if not self.check_entity(h):
+			return error(403, "Unauthorized")
+		statuses = [r for r in self.follow_requests.values() if r["from"] == h["id"]]
+		return web.json_response(statuses)
+
+	async def bind(self, request):
+		return self.bind_unbind(request, True)
+
+	async def unbind(self, request):
+		return self.bind_unbind(request, False)
+
+	def bind_unbind(self, request, bind):
+		h = request.headers
+		if not self.check_entity(h):
+			return error(403, "Unauthorized")
+		app = h.get("from") or h["id"]
+		device = h.get("to", "")
+		if h.get("message-type") != "protected":
+			return error(400, "Only protected streams can be bound to")
+		if (app, device) not in self.read_permissions:
+			return error(403, "Unauthorized")
+		if bind:
+			self.broker.bind(app, device)
+		else:
+			self.broker.unbind(app, device)
+		return web.Response(text="")
+
+	async def subscribe(self, request):
+		h = request.headers
+		if not self.check_entity(h):
+			return error(403, "Unauthorized")
+		queue = h["id"]
+		if h.get("message-type") == "command":
+			queue = queue+".command"
+		try:
+			num_messages = min(int(h.get("num-messages", "10")), 1000)
+		except ValueError:
+			return error(400, "Invalid num-messages")
+		messages = []
+		for method, properties, body in self.broker.get(queue, num_messages):
+			messages.append({"sent-by": properties.user_id, "from": method.exchange,
+				"topic": method.routing_key, "body": body.decode('utf-8', 'replace')})
+		return web.json_response(messages)
+
+	async def get_stats(self, request):
+		return web.json_response(self.stats.report())
+
+	#---------------------------
+	# AMQP
+	#---------------------------
+	def authenticate(self, user, password):
+		return self.apikeys.get(user) == password and user not in self.blocked
+
+
+def error(status, message):
+	return web.json_response({"error": message}, status=status)
+
+def without_status(follow_request):
+	r = dict(follow_request)
+	del r["status"]
+	return r
+
+
+#=============================
+# AMQP server
+#=============================
+
+# reply codes
+ACCESS_REFUSED = 403
+NOT_FOUND = 404
+PRECONDITION_FAILED = 406
+NO_ROUTE = 312
+NOT_IMPLEMENTED = 540
+
+FRAME_MAX = 131072
+
+
+class _ChannelState(object):
+	def __init__(self):
+		self.confirms = False
+		self.publish_count = 0     # delivery tags for publisher confirms
+		self.delivery_count = 0    # delivery tags for deliveries
+		self.consumers = {}        # consumer tag : (queue, callback)
+		self.publish_method = None # the Basic.Publish being received
+		self.properties = None
+		self.body_size = 0
+		self.body = []
+		self.closing = False
+
+
+class AMQPConnection(asyncio.Protocol):
+	""" Server side of one AMQP 0-9-1 connection. Frames are encoded
+	and decoded with pika's own frame and spec classes."""
+
+	def __init__(self, middleware):
+		self.middleware = middleware
+		self.stats = middleware.stats
+		self.broker = middleware.broker
+		self.transport = None
+		self.buffer = b""
+		self.user = None
+		self.frame_max = FRAME_MAX
+		self.channels = {}
+		self.next_consumer_tag = 1
+
+	def connection_made(self, transport):
+		self.transport = transport
+
+	def connection_lost(self, exc):
+		if self.user is not None:
+			self.stats.amqp_open_connections -= 1
+		for channel_number in list(self.channels):
+			self.drop_channel(channel_number)
+
+	def data_received(self, data):
+		self.buffer += data
+		offset = 0
+		while not self.transport.is_closing():
+			# no frame is larger than frame_max (plus the frame header and end)
+			consumed, frame = pika.frame.decode_frame(self.buffer[offset:offset+self.frame_max+8])
+			if not frame:
+				break
+			offset += consumed
+			try:
+				self.on_frame(frame)
+			except Exception:
+				logger.exception("FAKE_MIDDLEWARE: error handling frame {}".format(frame))
+				self.close_connection(NOT_IMPLEMENTED, "Internal error")
+		self.buffer = self.buffer[offset:]
+
+	#---------------------------
+	# sending frames
+	#---------------------------
+	def send_method(self, channel_number, method):
+		self.transport.write(pika.frame.Method(channel_number, method).marshal())
+
+	def send_content(self, channel_number, method, properties, body):
+		frames = [pika.frame.Method(channel_number, method).marshal(),
+			pika.frame.Header(channel_number, len(body), properties).marshal()]
+		chunk = self.frame_max - 8
+		for i in range(0, len(body), chunk):
+			frames.append(pika.frame.Body(channel_number, body[i:i+chunk]).marshal())
+		self.transport.write(b"".join(frames))
+
+	def close_channel(self, channel_number, reply_code, reply_text):
+		logger.debug("FAKE_MIDDLEWARE: closing channel {} of {}: ({}) {}".format(channel_number, self.user, reply_code, reply_text))
+		self.drop_channel(channel_number)
+		self.channels[channel_number] = _ChannelState()
+		self.channels[channel_number].closing = True
+		self.send_method(channel_number, pika.spec.Channel.Close(reply_code=reply_code, reply_text=reply_text))
+
+	def close_connection(self, reply_code, reply_text):
+		self.send_method(0, pika.spec.Connection.Close(reply_code=reply_code, reply_text=reply_text))
+		self.transport.close()
+
+	def drop_channel(self, channel_number):
+		state = self.channels.pop(channel_number, None)
+		if state is not None:
+			for queue, callback in state.consumers.values():
+				self.broker.cancel(queue, callback)
+
+	#---------------------------
+	# receiving frames
+	#---------------------------
+	def on_frame(self, frame):
+		if isinstance(frame, pika.frame.ProtocolHeader):
+			self.send_method(0, pika.spec.Connection.Start(
+				server_properties={"product": "fake corinthian middleware",
+					"capabilities": {"publisher_confirms": True, "basic.nack": True,
+						"consumer_cancel_notify": True}}))
+		elif isinstance(frame, pika.frame.Heartbeat):
+			pass
+		elif isinstance(frame, pika.frame.Method):
+			self.on_method(frame.channel_number, frame.method)
+		elif isinstance(frame, pika.frame.Header):
+			state = self.channels.get(frame.channel_number)
+			if state is not None and state.publish_method is not None:
+				state.properties = frame.properties
+				state.body_size = frame.body_size
+				if state.body_size == 0:
+					self.on_publish(frame.channel_number, state)
+		elif isinstance(frame, pika.frame.Body):
+			state = self.channels.get(frame.channel_number)
+			if state is not None and state.publish_method is not None:
+				state.body.append(frame.fragment)
+				if sum(len(b) for b in state.body) >= state.body_size:
+					self.on_publish(frame.channel_number, state)
+
+	def on_method(self, channel_number, method):
+		spec = pika.spec
+		if isinstance(method, spec.Connection.StartOk):
+			response = method.response
+			if isinstance(response, bytes):
+				response = response.decode('utf-8')
+			parts = response.split("\0")
+			user, password = (parts[1], parts[2]) if len(parts) == 3 else ("", "")
+			if not self.middleware.authenticate(user, password):
+				logger.debug("FAKE_MIDDLEWARE: AMQP login refused for {}".format(user))
+				self.close_connection(ACCESS_REFUSED, "ACCESS_REFUSED - Login was refused")
+				return
+			self.user = user
+			self.stats.amqp_connections += 1
+			self.stats.amqp_open_connections += 1
+			self.send_method(0, spec.Connection.Tune(channel_max=2047, frame_max=FRAME_MAX, heartbeat=0))
+		elif isinstance(method, spec.Connection.TuneOk):
+			if method.frame_max:
+				self.frame_max = min(method.frame_max, FRAME_MAX)
+		elif isinstance(method, spec.Connection.Open):
+			self.send_method(0, spec.Connection.OpenOk())
+		elif isinstance(method, spec.Connection.Close):
+			self.send_method(0, spec.Connection.CloseOk())
+			self.transport.close()
+		elif isinstance(method, spec.Connection.CloseOk):
+			self.transport.close()
+		elif self.user is None:
+			self.close_connection(ACCESS_REFUSED, "ACCESS_REFUSED - not logged in")
+
+		elif isinstance(method, spec.Channel.Open):
+			self.channels[channel_number] = _ChannelState()
+			self.send_method(channel_number, spec.Channel.OpenOk())
+		elif isinstance(method, spec.Channel.Close):
+			self.drop_channel(channel_number)
+			self.send_method(channel_number, spec.Channel.CloseOk())
+		elif isinstance(method, spec.Channel.CloseOk):
+			self.channels.pop(channel_number, None)
+		elif channel_number not in self.channels or self.channels[channel_number].closing:
+			# methods on a closed channel are ignored.
+			pass
+
+		elif isinstance(method, spec.Basic.Publish):
+			state = self.channels[channel_number]
+			state.publish_method = method
+			state.properties = None
+			state.body_size = 0
+			state.body = []
+		elif isinstance(method, spec.Basic.Consume):
+			self.on_consume(channel_number, method)
+		elif isinstance(method, spec.Basic.Cancel):
+			state = self.channels[channel_number]
+			if method.consumer_tag in state.consumers:
+				queue, callback = state.consumers.pop(method.consumer_tag)
+				self.broker.cancel(queue, callback)
+			if not method.nowait:
+				self.send_method(channel_number, spec.Basic.CancelOk(consumer_tag=method.consumer_tag))
+		elif isinstance(method, spec.Basic.Get):
+			self.on_get(channel_number, method)
+		elif isinstance(method, (spec.Basic.Ack, spec.Basic.Nack, spec.Basic.Reject)):
+			# messages are not redelivered, so acks are not tracked.
+			pass
+		elif isinstance(method, spec.Basic.Qos):
+			self.send_method(channel_number, spec.Basic.QosOk())
+		elif isinstance(method, spec.Confirm.Select):
+			self.channels[channel_number].confirms = True
+			if not method.nowait:
+				self.send_method(channel_number, spec.Confirm.SelectOk())
+		elif isinstance(method, spec.Queue.Declare):
+			if self.check_queue(channel_number, method.queue) and not method.nowait:
+				consumers = 1 if method.queue in self.broker.consumers else 0
+				self.send_method(channel_number, spec.Queue.DeclareOk(queue=method.queue,
+					message_count=self.broker.queue_depth(method.queue), consumer_count=consumers))
+		elif isinstance(method, spec.Queue.Purge):
+			if self.check_queue(channel_number, method.queue):
+				count = self.broker.purge(method.queue)
+				if not method.nowait:
+					self.send_method(channel_number, spec.Queue.PurgeOk(message_count=count))
+		else:
+			self.close_connection(NOT_IMPLEMENTED, "NOT_IMPLEMENTED - {} is not supported".format(method.NAME))
+
+	# an entity can only use its own queues
+	def check_queue(self, channel_number, queue):
+		if queue not in [self.user, self.user+".command", self.user+".priority"]:
+			self.close_channel(channel_number, ACCESS_REFUSED, "ACCESS_REFUSED - access to queue '{}' refused".format(queue))
+			return False
+		if queue not in self.broker.queues:
+			self.close_channel(channel_number, NOT_FOUND, "NOT_FOUND - no queue '{}'".format(queue))
+			return False
+		return True
+
+	def on_publish(self, channel_number, state):
+		method = state.publish_method
+		properties = state.properties
+		body = b"".join(state.body)
+		state.publish_method = None
+		state.body = []
+		self.stats.amqp_published += 1
+
+		if method.exchange not in [self.user+".protected", self.user+".publish"]:
+			self.stats.amqp_rejected += 1
+			self.close_channel(channel_number, ACCESS_REFUSED,
+				"ACCESS_REFUSED - access to exchange '{}' refused".format(method.exchange))
+			return
+		if properties.user_id != self.user:
+			self.stats.amqp_rejected += 1
+			self.close_channel(channel_number, PRECONDITION_FAILED,
+				"PRECONDITION_FAILED - user_id property set to '{}' but authenticated user was '{}'".format(
+				properties.user_id, self.user))
+			return
+
+		routed = self.broker.publish(self.user, method.exchange, method.routing_key, body, properties)
+		if not routed and method.mandatory:
+			self.stats.amqp_returned += 1
+			self.send_content(channel_number, pika.spec.Basic.Return(reply_code=NO_ROUTE, reply_text="NO_ROUTE",
+				exchange=method.exchange, routing_key=method.routing_key), properties, body)
+		if state.confirms:
+			state.publish_count += 1
+			self.send_method(channel_number, pika.spec.Basic.Ack(delivery_tag=state.publish_count))
+
+	def on_consume(self, channel_number, method):
+		if not self.check_queue(channel_number, method.queue):
+			return
+		state = self.channels[channel_number]
+		consumer_tag = method.consumer_tag
+		if not consumer_tag:
+			consumer_tag = "ctag-{}".format(self.next_consumer_tag)
+			self.next_consumer_tag += 1
+		if not method.nowait:
+			self.send_method(channel_number, pika.spec.Basic.ConsumeOk(consumer_tag=consumer_tag))
+		# messages held in the queue are delivered right away.
+		callback = functools.partial(self.deliver, channel_number, state, consumer_tag)
+		state.consumers[consumer_tag] = (method.queue, callback)
+		self.broker.consume(method.queue, callback)
+
+	def deliver(self, channel_number, state, consumer_tag, ch, method, properties, body):
+		if self.transport.is_closing():
+			return
+		state.delivery_count += 1
+		self.stats.amqp_delivered += 1
+		self.send_content(channel_number, pika.spec.Basic.Deliver(consumer_tag=consumer_tag,
+			delivery_tag=state.delivery_count, exchange=method.exchange, routing_key=method.routing_key),
+			properties, body)
+
+	def on_get(self, channel_number, method):
+		if not self.check_queue(channel_number, method.queue):
+			return
+		state = self.channels[channel_number]
+		messages = self.broker.get(method.queue, 1)
+		if not messages:
+			self.send_method(channel_number, pika.spec.Basic.GetEmpty())
+			return
+		deliver_method, properties, body = messages[0]
+		state.delivery_count += 1
+		self.stats.amqp_delivered += 1
+		self.send_content(channel_number, pika.spec.Basic.GetOk(delivery_tag=state.delivery_count,
+			exchange=deliver_method.exchange, routing_key=deliver_method.routing_key,
+			message_count=self.broker.queue_depth(method.queue)), properties, body)
+
+
+#=============================
+# Running the server
+#=============================
+
+async def serve(middleware, host, http_port, amqp_port, ssl_context, report_interval):
+	app = web.Application()
+	app.router.add_route("*", "/{tail:.*}", middleware.handle)
+	runner = web.AppRunner(app, access_log=None)
+	await runner.setup()
+	await web.TCPSite(runner, host, http_port, ssl_context=ssl_context).start()
+
+	loop = asyncio.get_running_loop()
+	amqp_server = await loop.create_server(lambda: AMQPConnection(middleware), host, amqp_port, ssl=ssl_context)
+	logger.info("FAKE_MIDDLEWARE: serving HTTPS on {}:{} and AMQP on {}:{}".format(host, http_port, host, amqp_port))
+	try:
+		while True:
+			await asyncio.sleep(report_interval)
+			middleware.stats.log_rates()
+	finally:
+		amqp_server.close()
+		await runner.cleanup()
+
+
+def run_server(host="localhost", http_port=443, amqp_port=5671, certfile=None, keyfile=None, report_interval=10):
+	""" Run the fake middleware until interrupted (Ctrl-C).
+	If no certificate is given, a self-signed one is generated.
+	The counters are logged when the server stops.
+	"""
+	middleware = FakeMiddleware()
+	with tempfile.TemporaryDirectory() as directory:
+		if certfile is None:
+			certfile, keyfile = make_self_signed_certificate(directory)
+		ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+		ssl_context.load_cert_chain(certfile, keyfile)
+		try:
+			asyncio.run(serve(middleware, host, http_port, amqp_port, ssl_context, report_interval))
+		except KeyboardInterrupt:
+			pass
+		finally:
+			logger.info("FAKE_MIDDLEWARE: stopped. Counters:\n{}".format(json.dumps(middleware.stats.report(), indent=2)))
+
+
+if __name__=='__main__':
+	# logging settings:
+	logging.basicConfig(level=logging.INFO)
+	logging.getLogger("aiohttp").setLevel(logging.WARNING)
+
+	# the same ports as in corinthian_messaging.py
+	run_server(host="localhost", http_port=443, amqp_port=5671)
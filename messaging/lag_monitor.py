@@ -0,0 +1,156 @@
+# !python3
+#
+# Monitoring how far a real-time simulation lags behind the wall clock.
+#
+# In a real-time SimPy environment with strict=False, the simulation
+# silently falls behind the wall clock when the entity models (or the
+# communication interfaces) take more CPU time than is available.
+# The LagMonitor is a SimPy process that wakes up every <interval>
+# seconds and measures the scheduler lag: how late (in real time) it was
+# woken up. The lags are recorded in a histogram (see latency.py).
+#
+# In a WakeableRealtimeEnvironment (see event_bridge.py), the monitor also
+# times each event processed by the environment and adds the time to
+# the SimPy process that the event resumed (such as "SimpleApp.behavior").
+# When the lag grows by more than <slow_threshold> seconds during an
+# interval, the times of that interval are added to the "attribution" of
+# each process. So the processes that ran while the simulation fell behind
+# can be identified.
+#
+# Every <report_interval> seconds, the monitor logs the lag, and if a
+# <metrics_file> is specified, appends a line of JSON to it with the lag
+# statistics, the processes that slowed the simulation down, and any
+# other metrics returned by the function <metrics> (such as the counts
+# of messages published and received so far).
+#
+# Usage:
+#	monitor = LagMonitor(env, metrics_file="metrics.jsonl")
+#	env.run(...)
+#	monitor.stop()
+#	monitor.lag    # histogram of the lags
+
+from __future__ import print_function
+import time
+import json
+import logging
+logger = logging.getLogger(__name__)
+import simpy
+import simpy.rt
+
+import latency
+
+
+def process_name(process):
+	return getattr(process._generator, "__qualname__", process.name)
+
+
+class LagMonitor(object):
+	""" Samples the lag of the real-time environment <env>
+	every <interval> seconds of simulation time."""
+	def __init__(self, env, interval=0.01, report_interval=1.0, slow_threshold=0.005,
+			metrics_file=None, metrics=None, top=5):
+		assert(isinstance(env, simpy.rt.RealtimeEnvironment)), "The lag monitor needs a real-time environment"
+		assert(interval > 0 and report_interval >= interval)
+		self.env = env
+		self.interval = interval
+		self.report_interval = report_interval
+		self.slow_threshold = slow_threshold
+		self.metrics = metrics
+		self.top = top
+
+		# histogram of the lags, and the current and maximum lag
+		self.lag = latency.LatencyHistogram()
+		self.current_lag = 0.0
+		self.max_lag = 0.0
+
+		# process name : [seconds, events] in the current interval
+		self.window = {}
+		# process name : seconds spent in intervals in which the lag grew
+		self.attribution = {}
+
+		self.metrics_file = open(metrics_file, "a") if metrics_file is not None else None
+
+		# time each event, if the environment allows it
+		if hasattr(env, "step_monitor"):
+			env.step_monitor = self.step
+
+		self.behavior_process = self.env.process(self.behavior())
+
+	# lag of the simulation behind the wall clock (in seconds)
+	def measure(self):
+		real_elapsed = time.monotonic() - self.env.real_start
+		sim_elapsed = (self.env.now - self.env.env_start) * self.env.factor
+		return max(0.0, real_elapsed - sim_elapsed)
+
+	# process an event of the environment, and time it
+	def step(self, env):
+		names = []
+		try:
+			event = env._queue[0][3]
+			for callback in event.callbacks or ():
+				p = getattr(callback, "__self__", None)
+				if isinstance(p, simpy.events.Process):
+					names.append(process_name(p))
+		except IndexError:
+			pass
+		start = time.perf_counter()
+		try:
+			simpy.core.Environment.step(env)
+		finally:
+			elapsed = time.perf_counter() - start
+			name = names[0] if names else "<other events>"
+			w = self.window.get(name)
+			if w is None:
+				w = self.window[name] = [0.0, 0]
+			w[0] += elapsed
+			w[1] += 1
+
+	def behavior(self):
+		next_report = self.env.now + self.report_interval
+		while True:
+			yield self.env.timeout(self.interval)
+			lag = self.measure()
+			self.lag.record(lag)
+			self.max_lag = max(self.max_lag, lag)
+			if lag - self.current_lag > self.slow_threshold:
+				# the simulation fell behind during this interval
+				for name, (seconds, events) in self.window.items():
+					self.attribution[name] = self.attribution.get(name, 0.0) + seconds
+			self.current_lag = lag
+			self.window = {}
+			if self.env.now >= next_report:
+				next_report += self.report_interval
+				self.report()
+
+	def slowest_processes(self):
+		return [(name, round(seconds, 4)) for name, seconds in
+			sorted(self.attribution.items(), key=lambda x: -x[1])[:self.top]]
+
+	def summary(self):
+		s = {"sim_time": self.env.now,
+			"lag": round(self.current_lag, 4),
+			"max_lag": round(self.max_lag, 4),
+			"lag_histogram": self.lag.summary(),
+			"slowest_processes": self.slowest_processes()}
+		if self.metrics is not None:
+			s.update(self.metrics())
+		return s
+
+	def report(self):
+		s = self.summary()
+		logger.info("SIM_TIME:{} LAG:{:.4f}s MAX_LAG:{:.4f}s".format(self.env.now, self.current_lag, self.max_lag))
+		if self.metrics_file is not None:
+			s["time"] = time.time()
+			self.metrics_file.write(json.dumps(s, default=repr) + "\n")
+			self.metrics_file.flush()
+
+	def stop(self):
+		""" Write a last report and stop timing events."""
+		if getattr(self.env, "step_monitor", None) == self.step:
+			self.env.step_monitor = None
+		self.report()
+		if self.metrics_file is not None:
+			self.metrics_file.close()
+			self.metrics_file = None
+		if self.attribution:
+			logger.info("Processes running while the simulation fell behind: {}".format(self.slowest_processes()))
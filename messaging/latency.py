@@ -0,0 +1,154 @@
+# !python3
+#
+# Streaming latency histograms.
+#
+# Every message published (and every command sent) by the communication
+# interfaces carries a sequence number and its send time in the AMQP
+# headers "seq" and "sent" (time.monotonic_ns() of the sender).
+# The receiving interfaces record the one-way latency of each message
+# in a LatencyHistogram. A command sent in reply to a message
+# (for example, a RESUME command in reply to a FAULT status) also carries
+# the send time of that message in the header "reply_to_sent", so the
+# device receiving the command records the round-trip latency as well.
+#
+# The send times are only comparable between processes on the same
+# machine (monotonic clocks are system-wide on Linux), so the
+# latencies are only meaningful when senders and receivers
+# are simulated on the same machine.
+#
+# A LatencyHistogram is HDR-style: values are counted in log-linear
+# buckets with a fixed relative precision (about 1% by default), so the
+# memory used does not depend on the number of values recorded.
+# Histograms of several entities (or shards) can be merged.
+
+from __future__ import print_function
+import time
+import logging
+logger = logging.getLogger(__name__)
+
+
+class LatencyHistogram(object):
+	""" Histogram of latencies (recorded in seconds, with a resolution
+	of one microsecond). Values below 2**<sub_bucket_bits> microseconds
+	are counted exactly and larger ones with a relative error
+	of at most 2**(1-sub_bucket_bits).
+	"""
+	def __init__(self, sub_bucket_bits=7):
+		assert(sub_bucket_bits > 1)
+		self.sub_bucket_bits = sub_bucket_bits
+		self.counts = []
+		self.count = 0
+		self.total = 0      # sum of the values (in microseconds)
+		self.min = None
+		self.max = None
+
+	# bucket index of a value (in microseconds)
+	def index(self, value):
+		shift = value.bit_length() - self.sub_bucket_bits
+		if shift <= 0:
+			return value
+		half = 1 << (self.sub_bucket_bits - 1)
+		return (2*half) + (shift-1)*half + ((value >> shift) - half)
+
+	# the range of values counted in a bucket
+	def bucket_range(self, index):
+		full = 1 << self.sub_bucket_bits
+		if index < full:
+			return index, index
+		half = full >> 1
+		shift = (index - full) // half + 1
+		sub = (index - full) % half + half
+		return sub << shift, ((sub + 1) << shift) - 1
+
+	def record(self, seconds):
+		value = max(0, int(seconds * 1e6))
+		i = self.index(value)
+		if i >= len(self.counts):
+			self.counts.extend([0] * (i + 1 - len(self.counts)))
+		self.counts[i] += 1
+		self.count += 1
+		self.total += value
+		self.min = value if self.min is None else min(self.min, value)
+		self.max = value if self.max is None else max(self.max, value)
+
+	def merge(self, other):
+		""" Add the values of another histogram to this one."""
+		assert(other.sub_bucket_bits == self.sub_bucket_bits)
+		if len(other.counts) > len(self.counts):
+			self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+		for i, c in enumerate(other.counts):
+			self.counts[i] += c
+		self.count += other.count
+		self.total += other.total
+		for v in (other.min, other.max):
+			if v is not None:
+				self.min = v if self.min is None else min(self.min, v)
+				self.max = v if self.max is None else max(self.max, v)
+		return self
+
+	def percentile(self, p):
+		""" The latency (in seconds) below which <p> percent of the values lie."""
+		if not self.count:
+			return None
+		target = max(1, int(round(self.count * p / 100.0)))
+		seen = 0
+		for i, c in enumerate(self.counts):
+			seen += c
+			if seen >= target:
+				low, high = self.bucket_range(i)
+				return min((low + high) / 2.0, self.max) / 1e6
+		return self.max / 1e6
+
+	def mean(self):
+		return self.total / self.count / 1e6 if self.count else None
+
+	def summary(self, percentiles=(50, 90, 99, 99.9)):
+		""" A dict with the count and the mean, max and percentiles (in ms)."""
+		s = {"count": self.count}
+		if self.count:
+			s["mean_ms"] = round(self.mean() * 1e3, 3)
+			for p in percentiles:
+				s["p{}_ms".format(p)] = round(self.percentile(p) * 1e3, 3)
+			s["max_ms"] = round(self.max / 1e3, 3)
+		return s
+
+	def __repr__(self):
+		return "LatencyHistogram({})".format(self.summary())
+
+
+def now():
+	""" The timestamp used for stamping messages."""
+	return time.monotonic_ns()
+
+def record_latency(histogram, sent):
+	""" Record the latency of a message sent at <sent> (a timestamp from now(),
+	or None if the message was not stamped)."""
+	if sent is not None:
+		histogram.record((now() - sent) / 1e9)
+
+
+def collect(device_instances, app_instances):
+	""" Merged latency histograms of the interfaces of a set of device
+	(or fleet) and app instances:
+	    "data_latency": publish -> subscribe
+	    "command_latency": send command -> receive command
+	    "round_trip_latency": message -> command in reply to it
+	"""
+	data = LatencyHistogram()
+	command = LatencyHistogram()
+	round_trip = LatencyHistogram()
+	for ID, a in app_instances.items():
+		data.merge(a.subscribe_thread.latency)
+		logger.debug("ENTITY:{} data latency {}".format(ID, a.subscribe_thread.latency.summary()))
+	for ID, d in device_instances.items():
+		command.merge(d.receive_commands_thread.latency)
+		round_trip.merge(d.receive_commands_thread.round_trip_latency)
+		logger.debug("ENTITY:{} command latency {}".format(ID, d.receive_commands_thread.latency.summary()))
+	return {"data_latency": data, "command_latency": command, "round_trip_latency": round_trip}
+
+
+def log_latencies(counters):
+	""" Log the percentiles of the histograms in a dict of counters."""
+	for name, h in sorted(counters.items()):
+		if isinstance(h, LatencyHistogram):
+			logger.info("LATENCY {}: {}".format(name, h.summary()))
@@ -0,0 +1,287 @@
+# !python3
+#
+# An in-process stand-in for the Corinthian middleware.
+#
+# The LocalBroker is a transport (see "Shared transport" in
+# communication_interface.py) that routes messages in memory
+# instead of sending them to the middleware. It implements the
+# exchanges and queues that the communication interfaces use:
+#
+#	<device>.protected : exchange to which a device publishes data.
+#	                     Delivered to the queue <app> of every app that
+#	                     has bound to it (a "read" permission).
+#	<app>.publish      : exchange to which an app publishes commands, with
+#	                     routing key <device>.command.# . Delivered to the
+#	                     queue <device>.command if the app has a "write"
+#	                     permission for the device.
+#
+# Messages are delivered synchronously, on the thread that published them.
+# Messages for a queue with no consumer are held in the queue until one
+# is attached. Nothing is sent over the network, so a simulation can
+# run in virtual time (simpy.Environment) as fast as the CPU allows,
+# with the entity models unchanged.
+#
+# Usage:
+#	broker = LocalBroker()
+#	broker.setup(devices, apps, permissions)
+#	communication_interface.set_transport(broker)
+#	... create SimpleDevice/SimpleApp entities as usual ...
+#	broker.close()
+
+from __future__ import print_function
+import threading
+from collections import deque
+import logging
+logger = logging.getLogger(__name__)
+import pika
+
+
+class LocalBroker(object):
+	""" In-memory routing of messages between the interfaces
+	of registered entities."""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+
+		# registered entities
+		self.entities = set()
+
+		# <device>.protected exchange : set of app queues bound to it
+		self.bindings = {}
+
+		# (app, device) pairs for which the app can send commands
+		self.write_permissions = set()
+
+		# queue name : deque of (method, properties, body)
+		# held until a consumer is attached
+		self.queues = {}
+
+		# queue name : consumer call-back
+		self.consumers = {}
+
+		# counts of messages published, delivered to a queue
+		# and dropped as unroutable
+		self.published_count = 0
+		self.routed_count = 0
+		self.unroutable_count = 0
+		self.rejected_count = 0
+
+	#---------------------------
+	# registrations and permissions
+	#---------------------------
+	def register_entity(self, ID):
+		""" Create the queues of an entity."""
+		with self.lock:
+			self.entities.add(ID)
+			self.queues.setdefault(ID, deque())
+			self.queues.setdefault(ID+".command", deque())
+			self.bindings.setdefault(ID+".protected", set())
+
+	def deregister_entity(self, ID):
+		with self.lock:
+			self.entities.discard(ID)
+			for queue in (ID, ID+".command"):
+				self.queues.pop(queue, None)
+				self.consumers.pop(queue, None)
+			self.bindings.pop(ID+".protected", None)
+			for queues in self.bindings.values():
+				queues.discard(ID)
+			self.write_permissions = set(p for p in self.write_permissions if ID not in p)
+
+	def bind(self, app, device):
+		""" Bind the queue of an app to the protected exchange of a device."""
+		with self.lock:
+			self.bindings.setdefault(device+".protected", set()).add(app)
+
+	def unbind(self, app, device):
+		with self.lock:
+			self.bindings.get(device+".protected", set()).discard(app)
+
+	def add_permission(self, app, device, permission):
+		""" Grant an app "read", "write" or "read-write" permission for
+		a device, the way a completed follow/share (and bind) would."""
+		assert(permission in ["read", "write", "read-write"]), "Invalid permission"
+		if permission in ["read", "read-write"]:
+			self.bind(app, device)
+		if permission in ["write", "read-write"]:
+			with self.lock:
+				self.write_permissions.add((app, device))
+
+	def remove_permission(self, app, device, permission):
+		if permission in ["read", "read-write"]:
+			self.unbind(app, device)
+		if permission in ["write", "read-write"]:
+			with self.lock:
+				self.write_permissions.discard((app, device))
+
+	def setup(self, devices, apps, permissions):
+		""" Register entities and set up permissions from a registration
+		info file: <devices> and <apps> are the entity IDs (with the "admin/"
+		prefix) and <permissions> are (<app name>, <device name>, <permission>)
+		as in the system description."""
+		for ID in list(devices)+list(apps):
+			self.register_entity(ID)
+		for app, device, permission in permissions:
+			self.add_permission("admin/"+app, "admin/"+device, permission)
+		logger.info("LocalBroker set up with {} devices, {} apps and {} permissions.".format(
+			len(devices), len(apps), len(permissions)))
+
+	#---------------------------
+	# transport interface
+	#---------------------------
+	def open_channel(self, ID, apikey):
+		return LocalChannel(self, ID)
+
+	def publish_many(self, messages):
+		""" Publish a list of (channel, exchange, routing_key, body, properties)."""
+		for channel, exchange, routing_key, body, properties in messages:
+			channel.publish(exchange, routing_key, body, properties)
+
+	def close(self):
+		logger.info("LocalBroker closed. {} messages published, {} delivered to queues, {} unroutable, {} rejected.".format(
+			self.published_count, self.routed_count, self.unroutable_count, self.rejected_count))
+
+	# number of messages held in a queue (with no consumer attached)
+	def queue_depth(self, queue):
+		with self.lock:
+			return len(self.queues.get(queue, ()))
+
+	def get(self, queue, max_messages=1):
+		""" Remove and return up to <max_messages> messages held
+		in a queue, as a list of (method, properties, body)."""
+		with self.lock:
+			held = self.queues.get(queue)
+			if not held:
+				return []
+			return [held.popleft() for i in range(min(max_messages, len(held)))]
+
+	# discard all messages held in a queue.
+	# Returns the number of messages discarded.
+	def purge(self, queue):
+		with self.lock:
+			held = self.queues.get(queue)
+			if not held:
+				return 0
+			self.queues[queue] = deque()
+			return len(held)
+
+	#---------------------------
+	# routing
+	#---------------------------
+	def route(self, exchange, routing_key):
+		""" The list of queues to which a message published on
+		<exchange> with <routing_key> is delivered."""
+		if exchange.endswith(".protected"):
+			return list(self.bindings.get(exchange, ()))
+		if exchange.endswith(".publish") and routing_key.endswith(".command.#"):
+			app = exchange[:-len(".publish")]
+			device = routing_key[:-len(".command.#")]
+			if (app, device) in self.write_permissions:
+				return [device+".command"]
+		return []
+
+	def accepts(self, sender, properties):
+		""" Is a message from <sender> with <properties> accepted? The middleware
+		rejects messages whose user_id is not the entity that published them."""
+		return properties is not None and properties.user_id == sender
+
+	def publish(self, sender, exchange, routing_key, body, properties):
+		""" Route a message. Returns False if it was unroutable (or rejected)."""
+		if not self.accepts(sender, properties):
+			logger.error("LocalBroker: message from {} with user_id={} rejected.".format(
+				sender, properties.user_id if properties else None))
+			with self.lock:
+				self.rejected_count += 1
+			return False
+
+		if isinstance(body, str):
+			body = body.encode('utf-8')
+		deliveries = []
+		with self.lock:
+			self.published_count += 1
+			queues = self.route(exchange, routing_key)
+			if not queues:
+				self.unroutable_count += 1
+				logger.debug("LocalBroker: unroutable message from {} on exchange {} with routing key {}.".format(
+					sender, exchange, routing_key))
+				return False
+			for queue in queues:
+				if queue not in self.queues:
+					continue
+				self.routed_count += 1
+				method = pika.spec.Basic.Deliver(exchange=exchange, routing_key=routing_key)
+				if queue in self.consumers:
+					deliveries.append((self.consumers[queue], method))
+				else:
+					self.queues[queue].append((method, properties, body))
+
+		# call the consumers outside the lock
+		for callback, method in deliveries:
+			callback(None, method, properties, body)
+		return True
+
+	def consume(self, queue, callback):
+		with self.lock:
+			assert(queue in self.queues), "Queue {} does not exist".format(queue)
+			self.consumers[queue] = callback
+			held = self.queues[queue]
+			self.queues[queue] = deque()
+		for method, properties, body in held:
+			callback(None, method, properties, body)
+
+	def cancel(self, queue, callback):
+		with self.lock:
+			if self.consumers.get(queue) == callback:
+				del self.consumers[queue]
+
+
+class LocalChannel(object):
+	""" Handle for a channel on the LocalBroker, with the same
+	methods as connection_pool.PooledChannel."""
+
+	def __init__(self, broker, ID):
+		self.broker = broker
+		self.ID = ID
+		self.consuming = []
+		self.closed = False
+		self.on_confirm = None
+		self.on_return = None
+
+	def publish(self, exchange, routing_key, body, properties=None):
+		self.publish_batch([(exchange, routing_key, body, properties)])
+
+	def publish_batch(self, messages):
+		if self.closed:
+			if self.on_confirm is not None:
+				self.on_confirm(0, len(messages))
+			return
+		num_acked = 0
+		num_nacked = 0
+		for exchange, routing_key, body, properties in messages:
+			accepted = self.broker.accepts(self.ID, properties)
+			routed = self.broker.publish(self.ID, exchange, routing_key, body, properties)
+			if not accepted:
+				# rejected messages are not confirmed
+				num_nacked += 1
+				continue
+			if not routed and self.on_return is not None:
+				self.on_return()
+			num_acked += 1
+		if self.on_confirm is not None:
+			self.on_confirm(num_acked, num_nacked)
+
+	def consume(self, queue, callback):
+		if self.closed:
+			return
+		self.broker.consume(queue, callback)
+		self.consuming.append((queue, callback))
+
+	def enable_confirms(self, on_confirm, on_return=None):
+		self.on_confirm = on_confirm
+		self.on_return = on_return
+
+	def close(self):
+		self.closed = True
+		for queue, callback in self.consuming:
+			self.broker.cancel(queue, callback)
+		self.consuming = []
@@ -0,0 +1,135 @@
+#! python3
+#
+# Bookkeeping for the permission handshake between apps and devices.
+#
+# Setting up a permission (<app>, <device>, <permission>) involves:
+#	1. FOLLOW: the app sends a follow request to the device.
+#	2. SHARE:  the device reads its pending follow requests and
+#	           approves ("shares") the ones made by the app.
+#	3. STATUS: the app checks that its follow requests were approved.
+#	4. BIND:   for read permissions, the app binds to the device's
+#	           protected stream.
+#
+# Pending requests are matched to the permissions being set up by
+# follow-id (when the follow response carries one) or else by
+# requester and permission, never by their position in the list.
+# This makes it safe to set up any number of permissions
+# for the same device or app concurrently. It also allows the SHARE
+# stage to be done with a single poll per device and the STATUS stage
+# with a single poll per app, instead of one poll per permission.
+#
+# The PermissionHandshake class only does the matching. The requests
+# are made by setup_entities.py / async_setup_entities.py.
+
+from __future__ import print_function
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+
+def single_permissions(permission):
+	""" A "read-write" follow request results in two pending requests
+	(one for "read" and one for "write") at the device."""
+	if permission == "read-write":
+		return ["read", "write"]
+	return [permission]
+
+
+class PermissionHandshake(object):
+	""" Matches follow requests and approvals to a list of permissions
+	specified as (<app name>, <device name>, <permission>).
+	"""
+	def __init__(self, permissions):
+		self.permissions = list(permissions)
+
+		# follow requests expected at each device:
+		# "admin/<device>" : set of ("admin/<app>", <read/write>)
+		self.expected = {}
+		for app, device, permission in self.permissions:
+			for p in single_permissions(permission):
+				self.expected.setdefault("admin/"+device, set()).add(("admin/"+app, p))
+
+		# follow-ids returned in the follow responses
+		self.known_follow_ids = set()
+
+		# expected follow requests found so far at each device
+		self.found = {}
+
+		# follow-ids approved by the devices, per app:
+		# "admin/<app>" : set of follow-ids
+		self.approved = {}
+		self.approved_follow_ids = set()
+
+		# devices and apps are handled by different workers
+		self.lock = threading.Lock()
+
+	def devices(self):
+		return sorted(self.expected)
+
+	def apps(self):
+		return sorted(set("admin/"+p[0] for p in self.permissions))
+
+	def binds(self):
+		""" list of (app, device) pairs for which the app
+		needs to bind to the device's protected stream."""
+		binds = []
+		for app, device, permission in self.permissions:
+			if permission in ("read", "read-write") and (app, device) not in binds:
+				binds.append((app, device))
+		return binds
+
+	def completed_by_status(self, app):
+		""" Permissions of "admin/<app>" that are fully set up once
+		its follow requests are approved (those that need no bind)."""
+		return [p for p in self.permissions if "admin/"+p[0] == app and p[2] == "write"]
+
+	def completed_by_bind(self, app, device):
+		""" Permissions that are fully set up once <app> binds to <device>."""
+		return [p for p in self.permissions if (p[0], p[1]) == (app, device) and p[2] in ("read", "read-write")]
+
+	def record_follow_response(self, response):
+		""" Remember the follow-ids (if any) in the decoded
+		JSON body of a follow response."""
+		if isinstance(response, dict):
+			with self.lock:
+				for key, value in response.items():
+					if key.startswith("follow-id"):
+						self.known_follow_ids.add(str(value))
+
+	def match_follow_requests(self, device, pending_requests):
+		""" Match the pending follow requests of a device
+		(the decoded JSON body of a follow-requests response)
+		with the ones expected.
+
+		Returns a list of (follow-id, requester) to be approved,
+		and the set of expected (requester, permission) pairs
+		that have not been found so far (in this or earlier polls).
+		Requests made by other entities are left alone.
+		"""
+		expected = self.expected.get(device, set())
+		to_approve = []
+		with self.lock:
+			found = self.found.setdefault(device, set())
+			for r in pending_requests:
+				follow_id = str(r["follow-id"])
+				key = (r["from"], r["permission"])
+				if follow_id in self.approved_follow_ids:
+					continue
+				if key in expected or follow_id in self.known_follow_ids:
+					to_approve.append((follow_id, r["from"]))
+					found.add(key)
+			return to_approve, expected - found
+
+	def record_approval(self, follow_id, requester):
+		with self.lock:
+			self.approved.setdefault(requester, set()).add(str(follow_id))
+			self.approved_follow_ids.add(str(follow_id))
+
+	def check_follow_status(self, app, statuses):
+		""" Check the follow-status of an app (the decoded JSON body
+		of a follow-status response) against the requests approved for it.
+		Returns the set of follow-ids that are not (yet) approved.
+		"""
+		approved = set(str(s["follow-id"]) for s in statuses if s["status"] == "approved")
+		with self.lock:
+			return self.approved.get(app, set()) - approved
@@ -0,0 +1,101 @@
+#! python3
+#
+# Draining the messages left in the queues of entities between test runs.
+#
+# Messages that were still queued for the apps (or in the command queues
+# of the devices) when a run ended are delivered to the next run that uses
+# the same entities, and distort its counts. drain_queues() removes them
+# from many queues in parallel, each queue on its own channel of a shared
+# ConnectionPool (see connection_pool.py), with up to <concurrency>
+# queues being drained at the same time. The queues can be:
+#	"purge"d:    removed by the broker in one request (Queue.Purge), or
+#	"consume"d:  consumed and discarded, with up to <prefetch> messages
+#	             in flight and acknowledged in bulk (for middlewares that
+#	             don't let entities purge their queues).
+# The number of stale messages removed from each queue is returned
+# (and the queues that had any are logged).
+#
+# Usage:
+#	removed = drain_queues(entity_queues(apps, devices), apikeys)
+#	# removed = {"admin/app0": 12, "admin/device0.command": 1, ...}
+
+from __future__ import print_function
+import time
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+import connection_pool
+
+
+# number of queues with stale messages that are logged
+LOG_TOP = 10
+
+
+def entity_queues(apps, devices):
+	""" (ID, queue) of the queue of each app and
+	the command queue of each device."""
+	return [(a, a) for a in apps] + [(d, d+".command") for d in devices]
+
+
+def drain_queues(queues, apikeys, mode="purge", concurrency=200, prefetch=1000, idle_timeout=1.0,
+		timeout=600, pool=None):
+	""" Drain a list of queues given as (ID, queue), where each
+	queue is accessed as the entity ID with the apikey apikeys[ID].
+	(See the description of the modes and arguments above.)
+	Queues are drained on channels of <pool>, or of a ConnectionPool
+	created for the purpose. Returns a dict of queue : number of messages
+	removed (None for the queues that could not be drained).
+	"""
+	assert(mode in ("purge", "consume")), "Invalid drain mode {}".format(mode)
+	assert(concurrency > 0)
+	own_pool = pool is None
+	if own_pool:
+		pool = connection_pool.ConnectionPool()
+
+	removed = {}
+	lock = threading.Lock()
+	all_done = threading.Event()
+	slots = threading.Semaphore(concurrency)
+	if not queues:
+		all_done.set()
+
+	def on_done(channel, queue, count):
+		# (on an I/O thread)
+		channel.close()
+		with lock:
+			removed[queue] = count
+			if len(removed) == len(queues):
+				all_done.set()
+		slots.release()
+
+	start = time.time()
+	try:
+		for ID, queue in queues:
+			assert(slots.acquire(timeout=max(0, start + timeout - time.time()))), "Timed out draining queues"
+			channel = pool.open_channel(ID, apikeys[ID])
+			callback = lambda count, channel=channel, queue=queue: on_done(channel, queue, count)
+			if mode == "purge":
+				channel.purge(queue, callback)
+			else:
+				channel.drain(queue, callback, prefetch, idle_timeout)
+		assert(all_done.wait(timeout=max(0, start + timeout - time.time()))), "Timed out draining queues"
+	finally:
+		if own_pool:
+			pool.close()
+
+	log_removed(removed, time.time() - start)
+	return removed
+
+
+def log_removed(removed, elapsed):
+	failed = sorted(q for q, count in removed.items() if count is None)
+	stale = sorted(((count, q) for q, count in removed.items() if count), reverse=True)
+	logger.info("DRAIN: removed {} stale messages from {} of {} queues in {:.2f}s.".format(
+		sum(count for count, q in stale), len(stale), len(removed), elapsed))
+	for count, q in stale[:LOG_TOP]:
+		logger.info("DRAIN:   {}: {} messages".format(q, count))
+	if len(stale) > LOG_TOP:
+		logger.info("DRAIN:   ... and {} more queues".format(len(stale) - LOG_TOP))
+	if failed:
+		logger.error("DRAIN: could not drain {} queues: {}".format(len(failed), failed[:LOG_TOP]))
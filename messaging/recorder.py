@@ -0,0 +1,140 @@
+# !python3
+#
+# Recording the traffic of a simulation to disk.
+#
+# A Recorder set with communication_interface.set_recorder() receives
+# an event for every message published, received, sent as a command
+# or received as a command by the interfaces. The events are buffered
+# in memory and written to an append-only binary log by a background
+# thread, once every <flush_interval> seconds (or when <batch_size>
+# events are buffered).
+#
+# The log <path> is a sequence of fixed-size records (RECORD_FORMAT):
+#	timestamp : int64  time of the event (latency.now(), in nanoseconds)
+#	entity    : int32  number of the entity (see below)
+#	direction : uint8  PUBLISHED, RECEIVED, COMMAND_SENT or COMMAND_RECEIVED
+#	size      : uint32 size of the message body in bytes
+#	seq       : int64  sequence number of the message (-1 if unstamped)
+# The entity names are appended to <path>.entities, one per line,
+# as they are first seen. Entity number i is the name on line i.
+# A Recorder for an existing log (such as the log of an earlier run)
+# appends to it, numbering the entities after those already in it.
+#
+# As the records have a fixed size, the log can be memory-mapped
+# as a NumPy structured array and analysed column by column
+# (see load()), without parsing log messages.
+#
+# Usage:
+#	r = Recorder("traffic.bin")
+#	communication_interface.set_recorder(r)
+#	... run the simulation ...
+#	communication_interface.set_recorder(None)
+#	r.close()
+
+from __future__ import print_function
+import os
+import threading
+import struct
+import logging
+logger = logging.getLogger(__name__)
+
+# directions
+PUBLISHED = 0
+RECEIVED = 1
+COMMAND_SENT = 2
+COMMAND_RECEIVED = 3
+DIRECTIONS = ("published", "received", "command_sent", "command_received")
+
+RECORD_FORMAT = "<qiBIq"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+
+class Recorder(object):
+	""" Writes traffic events to the binary log <path>
+	from a background thread."""
+	def __init__(self, path, flush_interval=1.0, batch_size=100000):
+		self.path = path
+		self.flush_interval = flush_interval
+		self.batch_size = batch_size
+		# entity name : entity number
+		# (with the entities already in the log, if any)
+		self.entity_numbers = {}
+		if os.path.exists(path + ".entities"):
+			with open(path + ".entities") as f:
+				for name in f.read().splitlines():
+					self.entity_numbers[name] = len(self.entity_numbers)
+
+		self.file = open(path, "ab")
+		self.entities_file = open(path + ".entities", "a")
+
+		# events not yet written
+		self.lock = threading.Lock()
+		self.buffer = []
+		self.flush_needed = threading.Event()
+
+		# count of the events written
+		self.count = 0
+
+		self.stop_event = threading.Event()
+		self.thread = threading.Thread(target=self.behavior)
+		self.thread.daemon = True
+		self.thread.start()
+		logger.debug("Recorder writing to {}.".format(path))
+
+	def record(self, timestamp, entity, direction, size, seq):
+		""" Record an event (thread-safe)."""
+		with self.lock:
+			self.buffer.append((timestamp, entity, direction, size, -1 if seq is None else seq))
+			full = len(self.buffer) >= self.batch_size
+		if full:
+			self.flush_needed.set()
+
+	# main behavior of the writer thread
+	def behavior(self):
+		while not self.stop_event.is_set():
+			self.flush_needed.wait(self.flush_interval)
+			self.flush_needed.clear()
+			self.flush()
+
+	def flush(self):
+		with self.lock:
+			events = self.buffer
+			self.buffer = []
+		if not events:
+			return
+		pack = struct.Struct(RECORD_FORMAT).pack
+		records = []
+		for timestamp, entity, direction, size, seq in events:
+			number = self.entity_numbers.get(entity)
+			if number is None:
+				number = self.entity_numbers[entity] = len(self.entity_numbers)
+				self.entities_file.write(entity + "\n")
+			records.append(pack(timestamp, number, direction, size, seq))
+		self.entities_file.flush()
+		self.file.write(b"".join(records))
+		self.file.flush()
+		self.count += len(records)
+
+	def close(self):
+		""" Write the remaining events and close the log."""
+		self.stop_event.set()
+		self.flush_needed.set()
+		self.thread.join()
+		self.flush()
+		self.file.close()
+		self.entities_file.close()
+		logger.info("Recorder wrote {} events to {}.".format(self.count, self.path))
+
+
+def load(path):
+	""" Memory-map the log <path> as a NumPy structured array with the
+	fields timestamp, entity, direction, size and seq.
+	Returns (array, list of entity names). Requires NumPy."""
+	import numpy as np
+	dtype = np.dtype([("timestamp", "<i8"), ("entity", "<i4"), ("direction", "u1"),
+		("size", "<u4"), ("seq", "<i8")])
+	assert(dtype.itemsize == RECORD_SIZE)
+	with open(path + ".entities") as f:
+		entities = f.read().splitlines()
+	records = np.memmap(path, dtype=dtype, mode="r") if entities else np.zeros(0, dtype=dtype)
+	return records, entities
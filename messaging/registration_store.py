@@ -0,0 +1,177 @@
+#! python3
+#
+# An indexed store of registration information.
+#
+# After setup, the names and apikeys of the registered devices and apps
+# and the permissions between them are written to a SQLite database
+# (instead of a Python module with the whole registration info as dict
+# literals, which must be compiled and loaded as a whole when imported).
+# Entities are stored by role ("device" or "app") and index (their position
+# in the system description), so that a simulation (or a shard of one)
+# can fetch just the entities and apikeys that it needs:
+#
+#	store = open_store("registration_info")
+#	store.count("device")                # number of devices registered
+#	devices = store.entities("device", 0, 1000)       # a range by index
+#	some = store.subset("device", [3, 17, 42])        # a subset by index
+#	apikeys = store.apikeys(devices)      # entity name : apikey
+#	permissions = store.permissions(apps=..., devices=...)
+#
+# As in the registration info module, entity names carry the "admin/"
+# prefix and the permissions (<app>, <device>, <permission>) do not.
+#
+# A RegistrationStore can be passed to other processes (such as the
+# shards of a sharded simulation): only its path is pickled, and
+# each process opens the database itself.
+
+from __future__ import print_function
+import os
+import sqlite3
+import importlib
+import importlib.util
+import logging
+logger = logging.getLogger(__name__)
+
+
+ROLES = ("device", "app")
+
+# maximum number of parameters in an SQL statement
+MAX_PARAMETERS = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entities (
+	role TEXT NOT NULL,
+	idx INTEGER NOT NULL,
+	name TEXT NOT NULL UNIQUE,
+	apikey TEXT NOT NULL,
+	PRIMARY KEY (role, idx)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS permissions (
+	app TEXT NOT NULL,
+	device TEXT NOT NULL,
+	permission TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS permissions_by_app ON permissions (app);
+CREATE INDEX IF NOT EXISTS permissions_by_device ON permissions (device);
+"""
+
+
+def chunks(items, size=MAX_PARAMETERS):
+	items = list(items)
+	for i in range(0, len(items), size):
+		yield items[i:i+size]
+
+
+def unprefixed(name):
+	return name[len("admin/"):] if name.startswith("admin/") else name
+
+
+class RegistrationStore(object):
+
+	def __init__(self, path):
+		self.path = path
+		self.name = path
+		self.db = sqlite3.connect(path)
+		self.db.executescript(SCHEMA)
+
+	# only the path is pickled
+	def __getstate__(self):
+		return {"path": self.path}
+
+	def __setstate__(self, state):
+		self.__init__(state["path"])
+
+	def write(self, system_description, registered_entities):
+		""" Replace the contents of the store with the entities of
+		<system_description> and their apikeys <registered_entities>."""
+		logger.info("SETUP: writing info about registered entities into {}.".format(self.path))
+		with self.db:
+			self.db.execute("DELETE FROM entities")
+			self.db.execute("DELETE FROM permissions")
+			for role in ROLES:
+				names = ["admin/"+str(i) for i in system_description[role+"s"]]
+				self.db.executemany("INSERT INTO entities VALUES (?, ?, ?, ?)",
+					((role, idx, name, registered_entities[name]) for idx, name in enumerate(names)))
+			self.db.executemany("INSERT INTO permissions VALUES (?, ?, ?)",
+				(tuple(p) for p in system_description["permissions"]))
+
+	def count(self, role):
+		assert(role in ROLES), "Invalid role {}".format(role)
+		return self.db.execute("SELECT COUNT(*) FROM entities WHERE role = ?", (role,)).fetchone()[0]
+
+	def entities(self, role, start=0, stop=None):
+		""" Names of the entities of <role> with indices start..stop-1
+		(all of them from <start> by default), in order of index."""
+		assert(role in ROLES), "Invalid role {}".format(role)
+		if stop is None:
+			stop = self.count(role)
+		rows = self.db.execute("SELECT name FROM entities WHERE role = ? AND idx >= ? AND idx < ? ORDER BY idx",
+			(role, start, stop))
+		return [r[0] for r in rows]
+
+	def subset(self, role, indices):
+		""" Names of the entities of <role> with the given indices, in the same order."""
+		assert(role in ROLES), "Invalid role {}".format(role)
+		names = {}
+		for c in chunks(indices):
+			rows = self.db.execute("SELECT idx, name FROM entities WHERE role = ? AND idx IN ({})".format(
+				",".join("?" * len(c))), [role] + c)
+			names.update(rows)
+		missing = [i for i in indices if i not in names]
+		assert(not missing), "No {}s with indices {}".format(role, missing[:10])
+		return [names[i] for i in indices]
+
+	def apikeys(self, names):
+		""" entity name : apikey, for a list of entity names."""
+		apikeys = {}
+		for c in chunks(names):
+			rows = self.db.execute("SELECT name, apikey FROM entities WHERE name IN ({})".format(
+				",".join("?" * len(c))), c)
+			apikeys.update(rows)
+		missing = [n for n in names if n not in apikeys]
+		assert(not missing), "Entities {} are not registered".format(missing[:10])
+		return apikeys
+
+	def permissions(self, apps=None, devices=None):
+		""" The permissions (<app>, <device>, <permission>) between the
+		entities <apps> and <devices> (all of them by default)."""
+		if apps is None and devices is None:
+			return self.db.execute("SELECT app, device, permission FROM permissions").fetchall()
+		# look up the permissions by device if possible (each device
+		# has a few permissions, an app can have one for every device),
+		# and filter them by app.
+		column, names = ("app", apps) if devices is None else ("device", devices)
+		rows = []
+		for c in chunks(unprefixed(n) for n in names):
+			rows += self.db.execute("SELECT app, device, permission FROM permissions WHERE {} IN ({})".format(
+				column, ",".join("?" * len(c))), c).fetchall()
+		if devices is not None and apps is not None:
+			apps = set(unprefixed(a) for a in apps)
+			rows = [r for r in rows if r[0] in apps]
+		return rows
+
+	def close(self):
+		self.db.close()
+
+
+def open_store(registration_info_name):
+	""" Open the registration store "<registration_info_name>.db"
+	(or <registration_info_name> if it ends with ".db").
+	If there is no store but a registration info module
+	<registration_info_name> written by an older setup,
+	the module is converted into a store."""
+	path = registration_info_name
+	if not path.endswith(".db"):
+		path += ".db"
+	if not os.path.exists(path) and not registration_info_name.endswith(".db") \
+			and importlib.util.find_spec(registration_info_name) is not None:
+		logger.info("Converting the module {} into the registration store {}".format(registration_info_name, path))
+		c = importlib.import_module(registration_info_name, package=None)
+		system_description = {"devices": [unprefixed(d) for d in c.devices],
+			"apps": [unprefixed(a) for a in c.apps],
+			"permissions": c.permissions}
+		store = RegistrationStore(path)
+		store.write(system_description, c.registered_entities)
+		return store
+	assert(os.path.exists(path)), "No registration store {} (run the setup first)".format(path)
+	return RegistrationStore(path)
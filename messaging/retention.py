@@ -0,0 +1,88 @@
+# !python3
+#
+# Bounded storage for the messages collected by entities.
+#
+# Entity models used to keep every message they received in a list,
+# which grows without bound in long runs. A MessageStore can be used
+# in place of such a list (it supports append, extend, len and iteration),
+# but retains only the last <max_per_sender> messages of each sender.
+# It also keeps rolling aggregates (the number of messages received in
+# total and from each sender) and can optionally stream every message
+# to a file (as JSON lines), so no message is lost for later analysis.
+#
+# The memory used depends only on the number of senders,
+# not on the length of the run.
+#
+# Usage:
+#	self.device_data = retention.MessageStore(max_per_sender=10)
+#	...
+#	self.device_data.append(msg)
+#	...
+#	len(self.device_data)   # number of messages received in total
+#	self.device_data.close()
+
+from __future__ import print_function
+from collections import deque
+import json
+import logging
+logger = logging.getLogger(__name__)
+
+
+# the sender of a message as pushed into a
+# queue by the communication interfaces.
+def sender_of(msg):
+	return msg.get("sender") if isinstance(msg, dict) else None
+
+
+class MessageStore(object):
+	""" Retains the last <max_per_sender> messages of each sender
+	(all of them if max_per_sender is None). If <path> is specified,
+	every message is also appended to that file as a line of JSON.
+	"""
+	def __init__(self, max_per_sender=10, path=None, key=sender_of):
+		assert(max_per_sender is None or max_per_sender > 0)
+		self.max_per_sender = max_per_sender
+		self.key = key
+		# the messages retained for each sender
+		self.messages = {}
+		# number of messages received in total, and from each sender
+		self.count = 0
+		self.counts = {}
+		self.path = path
+		self.file = open(path, "a") if path is not None else None
+
+	def append(self, msg):
+		sender = self.key(msg)
+		retained = self.messages.get(sender)
+		if retained is None:
+			retained = self.messages[sender] = deque(maxlen=self.max_per_sender)
+		retained.append(msg)
+		self.count += 1
+		self.counts[sender] = self.counts.get(sender, 0) + 1
+		if self.file is not None:
+			self.file.write(json.dumps(msg, default=str) + "\n")
+
+	def extend(self, msgs):
+		for msg in msgs:
+			self.append(msg)
+
+	def recent(self, sender):
+		""" The messages retained for <sender>, oldest first."""
+		return list(self.messages.get(sender, ()))
+
+	# the number of messages received in total
+	# (not just those retained).
+	def __len__(self):
+		return self.count
+
+	# iterate over the messages retained
+	def __iter__(self):
+		for retained in self.messages.values():
+			for msg in retained:
+				yield msg
+
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+			logger.debug("Wrote {} messages to {}".format(self.count, self.path))
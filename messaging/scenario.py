@@ -0,0 +1,374 @@
+#! python3
+#
+# Declarative test scenarios.
+#
+# A scenario file (JSON) describes a test: the entities to register and
+# the permissions between them, the simulation to run (duration, real-time
+# factor, backend, arrival processes and fault schedule) and optionally
+# a parameter sweep. run_scenario() runs the pipeline
+#	setup -> simulate (once for each point of the sweep) -> teardown
+# with the run_simulation() function of a demo (see run_scenario.py in
+# /simple_entities and /streetlight_demo).
+#
+# The registered fleet is kept in a registration store (see
+# registration_store.py) and reused by all the runs of a sweep, and by
+# later scenarios with the same topology if it is not torn down.
+# Only the simulation parameters can be swept.
+# With the setup backend "local", nothing is registered with the
+# middleware: the store gets made-up apikeys, for simulations with
+# the "local" simulation backend (see local_broker.py).
+#
+# Alternatively, with "setup": {"pool": <name of an entity pool>}, the
+# runs use a block of entities leased from an entity pool (see
+# entity_pool.py) instead of a fleet of their own. The topology and
+# permissions of the scenario are then those of the pool's blocks.
+#
+# With "setup": {"drain": "purge"} (or "consume"), the messages left in
+# the queues of the entities of a run (by an earlier run) are drained
+# before the run (see queue_drain.py).
+#
+# An example scenario (all the fields are optional; see DEFAULTS):
+#	{
+#	  "topology": {"devices": 100, "apps": 2},
+#	  "permissions": [{"apps": "all", "devices": "all", "permission": "read-write"}],
+#	  "setup": {"backend": "threads", "concurrency": 8},
+#	  "simulation": {"devices": 100, "apps": 2, "duration": 30, "factor": 1,
+#	                 "backend": "pool", "num_shards": 1, "logging_level": "WARNING"},
+#	  "arrivals": {"process": "poisson", "rate": 1.0, "count": 30},
+#	  "faults": [{"time": 5, "fraction": 0.1, "seed": 1}],
+#	  "sweep": {"simulation.devices": [10, 50, 100], "arrivals.rate": [1.0, 2.0]},
+#	  "results_file": "results.jsonl",
+#	  "teardown": true
+#	}
+#
+# Permissions are given as a list of rules. Each rule selects apps and
+# devices ("all", or a range [<start>, <stop>] of indices) and a pattern:
+#	"all":       every selected app gets <permission> for every selected device
+#	"partition": the selected devices are dealt out to the selected apps
+#	             (device i goes to app i % <number of apps>)
+#
+# Not every demo supports every section: the parameters of the runs are
+# checked against the arguments of the demo's run_simulation() before
+# the fleet is set up (the streetlight demo has no arrival processes).
+#
+# A sweep is a dict of <dotted path to a parameter>: <list of values>.
+# The scenario is run for every combination of the values.
+# The parameters of each run and a summary of its counters are appended to
+# the <results_file> (one line of JSON per run) and returned.
+
+from __future__ import print_function
+import os
+import copy
+import json
+import inspect
+import itertools
+import logging
+logger = logging.getLogger(__name__)
+
+import setup_entities
+import setup_journal
+import registration_store
+import entity_pool
+import queue_drain
+
+
+DEFAULTS = {
+	"topology": {"devices": 2, "apps": 1, "device_prefix": "device", "app_prefix": "app"},
+	"permissions": [{"apps": "all", "devices": "all", "permission": "read-write", "pattern": "all"}],
+	"setup": {"backend": "threads", "concurrency": 8,
+		"registration_info": "registration_info", "journal": "setup_journal.jsonl", "pool": None,
+		"drain": None},
+	"simulation": {"devices": None, "apps": None, "duration": 12, "factor": 1,
+		"backend": "pool", "num_shards": 1, "logging_level": "INFO"},
+	"arrivals": None,
+	"faults": None,
+	"sweep": {},
+	"results_file": None,
+	"teardown": True,
+}
+
+# sections whose parameters can be swept
+SWEEPABLE = ("simulation", "arrivals", "faults")
+
+
+def merge(defaults, values):
+	""" <values> on top of <defaults>, for nested dicts."""
+	if not isinstance(defaults, dict) or not isinstance(values, dict):
+		return copy.deepcopy(values)
+	merged = copy.deepcopy(defaults)
+	for key, value in values.items():
+		merged[key] = merge(defaults.get(key), value)
+	return merged
+
+
+def load(path, overrides=None):
+	""" Read a scenario file, with <overrides> ({<dotted path>: value})
+	on top of it, and fill in the defaults."""
+	with open(path) as f:
+		scenario = json.load(f)
+	for key, value in (overrides or {}).items():
+		set_parameter(scenario, key, value)
+	return check(merge(DEFAULTS, scenario))
+
+
+def check(scenario):
+	unknown = set(scenario) - set(DEFAULTS)
+	assert(not unknown), "Unknown fields {} in scenario".format(sorted(unknown))
+	topology = scenario["topology"]
+	assert(topology["devices"] > 0 and topology["apps"] > 0), "Invalid topology {}".format(topology)
+	for rule in scenario["permissions"]:
+		assert(rule.get("pattern", "all") in ("all", "partition")), "Invalid permission pattern in {}".format(rule)
+	assert(scenario["setup"]["drain"] in (None, "purge", "consume")), \
+		"Invalid drain mode {}".format(scenario["setup"]["drain"])
+	if scenario["arrivals"] is not None:
+		import arrivals
+		process = scenario["arrivals"].get("process") if isinstance(scenario["arrivals"], dict) else None
+		assert(process in arrivals.PROCESSES), "Invalid arrival process {} in {} (expected one of {})".format(
+			process, scenario["arrivals"], sorted(arrivals.PROCESSES))
+	for key in scenario["sweep"]:
+		assert(key.split(".")[0] in SWEEPABLE), \
+			"Only the parameters of {} can be swept (the fleet is registered once), not {}".format(SWEEPABLE, key)
+	return scenario
+
+
+def set_parameter(scenario, key, value):
+	""" Set the parameter at the dotted path <key> (such as "simulation.devices")."""
+	path = key.split(".")
+	d = scenario
+	for name in path[:-1]:
+		if d.get(name) is None:
+			d[name] = {}
+		d = d[name]
+	d[path[-1]] = value
+
+
+def select(selector, num):
+	""" Indices selected by "all" or a range [<start>, <stop>]."""
+	if selector == "all":
+		return range(num)
+	start, stop = selector
+	assert(0 <= start <= stop <= num), "Invalid selection {} of {} entities".format(selector, num)
+	return range(start, stop)
+
+
+def system_description(scenario):
+	""" The system description (see setup_entities.register_entities)
+	for the topology and permissions of a scenario."""
+	topology = scenario["topology"]
+	devices = [topology["device_prefix"]+str(i) for i in range(topology["devices"])]
+	apps = [topology["app_prefix"]+str(i) for i in range(topology["apps"])]
+	permissions = []
+	for rule in scenario["permissions"]:
+		selected_apps = [apps[i] for i in select(rule.get("apps", "all"), len(apps))]
+		selected_devices = [devices[i] for i in select(rule.get("devices", "all"), len(devices))]
+		permission = rule.get("permission", "read-write")
+		if rule.get("pattern", "all") == "all":
+			permissions += [(a, d, permission) for a in selected_apps for d in selected_devices]
+		else:
+			permissions += [(selected_apps[i % len(selected_apps)], d, permission) for i, d in enumerate(selected_devices)]
+	return {"devices": devices, "apps": apps, "permissions": permissions}
+
+
+def sweep_points(scenario):
+	""" A list of (parameters, scenario) for each point of the sweep."""
+	sweep = scenario["sweep"]
+	keys = sorted(sweep)
+	points = []
+	for values in itertools.product(*[sweep[k] for k in keys]):
+		s = copy.deepcopy(scenario)
+		for key, value in zip(keys, values):
+			set_parameter(s, key, value)
+		points.append((dict(zip(keys, values)), s))
+	return points
+
+
+def setup_fleet(scenario):
+	""" Register the fleet of a scenario, unless it is already registered
+	(in the registration store). Returns the name of the store."""
+	setup = scenario["setup"]
+	name = setup["registration_info"]
+	description = system_description(scenario)
+	path = name if name.endswith(".db") else name + ".db"
+	if os.path.exists(path):
+		store = registration_store.open_store(name)
+		same = (store.entities("device") == ["admin/"+d for d in description["devices"]]
+			and store.entities("app") == ["admin/"+a for a in description["apps"]]
+			and sorted(store.permissions()) == sorted(tuple(p) for p in description["permissions"]))
+		store.close()
+		assert(same), "The fleet registered in {} is not the fleet of this scenario. Tear it down first.".format(path)
+		logger.info("SCENARIO: reusing the fleet registered in {}.".format(path))
+		return name
+
+	store = registration_store.RegistrationStore(path)
+	if setup["backend"] == "local":
+		entities = ["admin/"+e for e in description["devices"] + description["apps"]]
+		store.write(description, dict((e, "local-apikey") for e in entities))
+		store.close()
+		return name
+
+	setup_module = setup_entities
+	if setup["backend"] == "asyncio":
+		import async_setup_entities
+		setup_module = async_setup_entities
+	journal = setup_journal.SetupJournal(setup["journal"])
+	try:
+		success, registered_entities = setup_module.register_entities(description, store,
+			concurrency=setup["concurrency"], journal=journal)
+		assert(success)
+	except:
+		# no partial store: the setup is resumed from the journal.
+		store.close()
+		os.remove(path)
+		raise
+	finally:
+		journal.close()
+	store.close()
+	return name
+
+
+def teardown_fleet(scenario):
+	""" Deregister the fleet of a scenario and remove its registration store."""
+	setup = scenario["setup"]
+	store = registration_store.open_store(setup["registration_info"])
+	entities = store.entities("device") + store.entities("app")
+	store.close()
+	if setup["backend"] == "local":
+		os.remove(store.path)
+		return
+	setup_module = setup_entities
+	if setup["backend"] == "asyncio":
+		import async_setup_entities
+		setup_module = async_setup_entities
+	journal = setup_journal.SetupJournal(setup["journal"])
+	try:
+		setup_module.deregister_entities(entities, setup["concurrency"], journal=journal)
+	finally:
+		journal.close()
+	os.remove(store.path)
+	os.remove(setup["journal"])
+
+
+def summary(counters):
+	""" The counters of a run, with histograms and
+	reports replaced by their summaries."""
+	return dict((k, v.summary() if hasattr(v, "summary") else v) for k, v in counters.items())
+
+
+# time (in seconds) that a lease of entities for a run
+# lasts beyond the end of the run
+LEASE_MARGIN = 300
+
+
+def lease_entities(points):
+	""" Lease a block of the entity pool of a scenario,
+	with enough entities for all the points of its sweep."""
+	def needed(key):
+		values = [s["simulation"][key] for parameters, s in points]
+		return None if None in values else max(values)
+	scenario = points[0][1]
+	pool = entity_pool.EntityPool(scenario["setup"]["pool"])
+	run_time = scenario["simulation"]["duration"] * scenario["simulation"]["factor"]
+	return pool.lease(needed("devices"), needed("apps"), duration=run_time + LEASE_MARGIN)
+
+
+def simulation_arguments(scenario, lease=None):
+	""" Arguments of run_simulation() for a scenario
+	(and the entities leased for it, if any)."""
+	simulation = dict(scenario["simulation"])
+	topology = scenario["topology"]
+	if lease is not None:
+		topology = {"devices": len(lease.devices), "apps": len(lease.apps)}
+	kwargs = {"num_devices": simulation.pop("devices") or topology["devices"],
+		"num_apps": simulation.pop("apps") or topology["apps"],
+		"simulation_time": simulation.pop("duration"),
+		"logging_level": getattr(logging, simulation.pop("logging_level"))}
+	kwargs.update(simulation)
+	if scenario["arrivals"] is not None:
+		kwargs["arrival_process"] = scenario["arrivals"]
+	if scenario["faults"] is not None:
+		kwargs["fault_schedule"] = scenario["faults"]
+	if lease is not None:
+		kwargs["lease"] = lease
+	return kwargs
+
+
+def drain_run(scenario, name, arguments):
+	""" Drain the queues of the entities of a run with the arguments
+	<arguments> (see simulation_arguments), if the scenario says so."""
+	mode = scenario["setup"]["drain"]
+	if mode is None or arguments.get("backend") == "local":
+		return
+	store = registration_store.open_store(name)
+	try:
+		lease = arguments.get("lease")
+		if lease is not None:
+			devices = lease.devices[:arguments["num_devices"]]
+			apps = lease.apps[:arguments["num_apps"]]
+		else:
+			devices = store.entities("device", 0, arguments["num_devices"])
+			apps = store.entities("app", 0, arguments["num_apps"])
+		apikeys = store.apikeys(devices + apps)
+	finally:
+		store.close()
+	removed = queue_drain.drain_queues(queue_drain.entity_queues(apps, devices), apikeys, mode=mode)
+	failed = sorted(q for q, count in removed.items() if count is None)
+	assert(not failed), "Could not drain the queues {} before the run".format(failed[:10])
+
+
+def check_arguments(scenario, run_simulation):
+	""" Check that <run_simulation> takes all the
+	arguments that a scenario passes to it."""
+	parameters = inspect.signature(run_simulation).parameters
+	if any(p.kind == p.VAR_KEYWORD for p in parameters.values()):
+		return
+	unsupported = sorted(set(simulation_arguments(scenario)) - set(parameters))
+	assert(not unsupported), "{}.run_simulation() does not take the arguments {} of this scenario".format(
+		run_simulation.__module__, unsupported)
+
+
+def run_scenario(scenario, run_simulation, teardown=None):
+	""" Run the pipeline setup -> simulate -> teardown for a scenario
+	(as returned by load()) with the function <run_simulation> of a demo.
+	The fleet is torn down at the end if scenario["teardown"] is true
+	(or <teardown>, if specified), and kept if a run fails.
+	With an entity pool, the lease is released at the end instead.
+	Returns a list of the parameters and results of each run."""
+	points = sweep_points(scenario)
+	for parameters, s in points:
+		check(s)
+		check_arguments(s, run_simulation)
+	lease = None
+	if scenario["setup"]["pool"] is not None:
+		name = scenario["setup"]["pool"]
+		lease = lease_entities(points)
+	else:
+		name = setup_fleet(scenario)
+	results = []
+	results_file = open(scenario["results_file"], "a") if scenario["results_file"] else None
+	try:
+		for n, (parameters, s) in enumerate(points):
+			logger.info("SCENARIO: run {} of {}: {}".format(n+1, len(points), parameters))
+			if lease is not None:
+				lease.renew(s["simulation"]["duration"] * s["simulation"]["factor"] + LEASE_MARGIN)
+			arguments = simulation_arguments(s, lease)
+			drain_run(s, name, arguments)
+			counters = run_simulation(name, **arguments)
+			result = {"parameters": parameters, "counters": summary(counters)}
+			results.append(result)
+			if results_file is not None:
+				results_file.write(json.dumps(result, default=repr) + "\n")
+				results_file.flush()
+	except:
+		if lease is None:
+			logger.error("SCENARIO: a run failed. The fleet is kept in {} for the next runs.".format(name))
+		raise
+	finally:
+		if results_file is not None:
+			results_file.close()
+		if lease is not None:
+			lease.release()
+			lease.pool.close()
+
+	if lease is None and (scenario["teardown"] if teardown is None else teardown):
+		teardown_fleet(scenario)
+	return results
@@ -23,29 +23,250 @@
 # Optionally, if a file handle is passed as an argument,
 # information about the registered entities is saved in this file.
 #
+# Registrations and permission set-up can be done in parallel 
+# by a bounded pool of worker threads (sharing a pool of 
+# keep-alive HTTPS connections) by specifying <concurrency>.
+#
+# Optionally, the progress of setup and teardown can be recorded in a
+# journal (see setup_journal.py), so that they can be resumed after
+# a failure instead of starting over.
+#
 #
 # Author: Neha Karanjkar
 
 from __future__ import print_function 
 import corinthian_messaging
+import permission_handshake
+import registration_store
 import logging
 logger = logging.getLogger(__name__)
 import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+#=========================================
+# Helpers for running requests in parallel
+#=========================================
 
+def log_progress(stage, done, total):
+	""" Default progress callback: logs the progress 
+	of a stage after every 10% of the work."""
+	step = max(1, total//10)
+	if done % step == 0 or done == total:
+		logger.info("{}: {}/{} done.".format(stage, done, total))
 
 
-def deregister_entities(list_of_entity_names):
+def run_in_parallel(function, items, concurrency=1, stage="", progress_callback=log_progress):
+	""" Call function(item) for each item using a pool of
+	<concurrency> worker threads. After each call completes, 
+	progress_callback(stage, num_done, num_items) is called.
+	On the first exception, the calls that have not yet started
+	are cancelled and the exception is re-raised 
+	once the calls in progress have finished.
+	"""
+	assert(concurrency > 0)
+	items = list(items)
+	done = 0
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		futures = [executor.submit(function, item) for item in items]
+		try:
+			for f in as_completed(futures):
+				f.result()
+				done += 1
+				if progress_callback:
+					progress_callback(stage, done, len(items))
+		except:
+			for f in futures:
+				f.cancel()
+			raise
+
+
+def deregister_entities(list_of_entity_names, concurrency=1, progress_callback=log_progress, journal=None):
 	""" Takes a list of entity names and 
-	deregisters them one-by-one.
+	deregisters them, using <concurrency> parallel workers.
+	With a <journal>, entities already deregistered
+	(as recorded in the journal) are skipped.
 	"""
-	for entity in list_of_entity_names:
+	# a pool of keep-alive connections shared by the workers
+	client = corinthian_messaging.CorinthianClient(pool_size=concurrency)
+	def deregister(entity):
 		# Admin prefix is not needed since the dict already contains prefixed entity names
-		success = corinthian_messaging.deregister(entity)
-		logger.info("DE-REGISTER: de-registering {} successful.".format(entity))
+		if journal is None:
+			success = corinthian_messaging.deregister(entity, session=client)
+		else:
+			deregister_journaled(entity, journal, lambda: corinthian_messaging.deregister(entity, session=client))
+		logger.debug("DE-REGISTER: de-registering {} successful.".format(entity))
+	if journal is not None:
+		list_of_entity_names = pending_deregistrations(list_of_entity_names, journal)
+	try:
+		run_in_parallel(deregister, list_of_entity_names, concurrency, "DE-REGISTER", progress_callback)
+	finally:
+		client.close()
+
+
+def pending_deregistrations(list_of_entity_names, journal):
+	pending = [e for e in list_of_entity_names if e not in journal.deregistered or journal.is_uncertain(e)]
+	if len(pending) < len(list_of_entity_names):
+		logger.info("DE-REGISTER: resuming. {} of {} entities were already deregistered.".format(
+			len(list_of_entity_names) - len(pending), len(list_of_entity_names)))
+	return pending
+
+
+def deregister_journaled(entity, journal, deregister):
+	""" Call deregister() for an entity, recording it in the journal.
+	If the entity was being (de)registered when an earlier run died,
+	it may not exist at the middleware, so errors are ignored."""
+	uncertain = journal.is_uncertain(entity)
+	journal.deregistering(entity)
+	try:
+		deregister()
+	except AssertionError:
+		if not uncertain:
+			raise
+		logger.debug("DE-REGISTER: {} was not registered.".format(entity))
+	journal.record_deregistration(entity)
+
+
+
+def check_system_description(system_description):
+	""" check that the entity names and permissions 
+	in a system description are sane."""
+	devices = system_description["devices"]
+	apps   = system_description["apps"]
+	entities = devices+apps
+	permissions = system_description["permissions"]
+	
+	# check if all entity names are sane.
+	for name in entities:
+		if not (all(c.isdigit() or c.islower() for c in name)):
+			logger.error("Illegal entity name:{}".format(name))
+			logger.error("Entity names can only contain lowercase letters and numbers.")
+			assert(False),"Illegal entity name"
+	
+	# check if all permissions are sane
+	for p in permissions:
+		assert(len(p)==3)
+		app = p[0]
+		dev = p[1]
+		permission = p[2]
+		
+		assert(app in apps)
+		assert(dev in devices)
+		assert(permission=="read" or permission=="write" or permission=="read-write")
+
+
+def write_registration_info(registration_info_file, system_description, registered_entities):
+	""" write out the registration info into a file,
+	or into a registration store (see registration_store.py)."""
+	if isinstance(registration_info_file, registration_store.RegistrationStore):
+		registration_info_file.write(system_description, registered_entities)
+		return
+	logger.info("SETUP: writing info about registered entities into file {}.".format(registration_info_file.name))
+	devices = ["admin/"+str(i) for i in system_description["devices"]]
+	apps = ["admin/"+str(i) for i in system_description["apps"]]
+	registration_info_file.write("\ndevices= %s"%devices)
+	registration_info_file.write("\napps= %s"%apps)
+	registration_info_file.write("\npermissions= %s"%system_description["permissions"])
+	registration_info_file.write("\nregistered_entities= %s"%registered_entities)
 
 
+# A device (or app) is polled up to HANDSHAKE_POLL_ATTEMPTS times, 
+# HANDSHAKE_POLL_INTERVAL seconds apart, for follow requests 
+# (or approvals) that have not shown up yet.
+HANDSHAKE_POLL_ATTEMPTS = 5
+HANDSHAKE_POLL_INTERVAL = 0.5
 
-def register_entities(system_description, registration_info_file=None):
+
+def json_body(response):
+	""" decoded JSON body of a response, or None if there isn't one."""
+	try:
+		return response.json()
+	except ValueError:
+		return None
+
+
+def setup_permissions(permissions, registered_entities, client=None, concurrency=1, progress_callback=log_progress, on_done=None):
+	""" Set up a list of permissions (<app name>, <device name>, <permission>)
+	between registered entities, using <concurrency> parallel workers.
+	Follow requests and approvals are matched by the PermissionHandshake
+	(see permission_handshake.py), so the devices are polled once each 
+	for pending requests and the apps once each for approvals.
+	If specified, on_done(permission) is called for each permission
+	as soon as it is fully set up.
+	"""
+	handshake = permission_handshake.PermissionHandshake(permissions)
+	
+	# FOLLOW: each app sends follow requests to the devices.
+	def follow(p):
+		app, target_device, permission = p
+		r = corinthian_messaging.follow("admin/"+app, registered_entities["admin/"+app], "admin/"+target_device, permission, session=client)
+		handshake.record_follow_response(json_body(r))
+		logger.debug("FOLLOW: {} sent a follow request to {} for permission {}".format(app, target_device, permission))
+	logger.info("SETUP: sending {} follow requests...".format(len(permissions)))
+	run_in_parallel(follow, permissions, concurrency, "FOLLOW", progress_callback)
+	
+	# SHARE: each device approves all the follow requests meant for it.
+	def share(device):
+		apikey = registered_entities[device]
+		for attempt in range(HANDSHAKE_POLL_ATTEMPTS):
+			if attempt:
+				time.sleep(HANDSHAKE_POLL_INTERVAL)
+			pending = corinthian_messaging.follow_requests(device, apikey, "requests", session=client).json()
+			to_approve, missing = handshake.match_follow_requests(device, pending)
+			for follow_id, requester in to_approve:
+				corinthian_messaging.share(device, apikey, follow_id, session=client)
+				handshake.record_approval(follow_id, requester)
+				logger.debug("SHARE: {} approved follow request {} from {}".format(device, follow_id, requester))
+			if not missing:
+				return
+		assert(False), "Follow requests {} never reached {}".format(sorted(missing), device)
+	logger.info("SETUP: approving follow requests at {} devices...".format(len(handshake.devices())))
+	run_in_parallel(share, handshake.devices(), concurrency, "SHARE", progress_callback)
+	
+	# STATUS: each app checks that its follow requests were approved.
+	def check_status(app):
+		apikey = registered_entities[app]
+		for attempt in range(HANDSHAKE_POLL_ATTEMPTS):
+			if attempt:
+				time.sleep(HANDSHAKE_POLL_INTERVAL)
+			statuses = corinthian_messaging.follow_requests(app, apikey, "status", session=client).json()
+			not_approved = handshake.check_follow_status(app, statuses)
+			if not not_approved:
+				logger.debug("FOLLOW: follow requests made by {} were approved.".format(app))
+				if on_done is not None:
+					for p in handshake.completed_by_status(app):
+						on_done(p)
+				return
+		assert(False), "Follow requests {} of {} were not approved".format(sorted(not_approved), app)
+	run_in_parallel(check_status, handshake.apps(), concurrency, "STATUS", progress_callback)
+	
+	# BIND: for read permissions, get the app to bind to the device's protected stream.
+	def bind(b):
+		app, target_device = b
+		corinthian_messaging.bind_unbind("admin/"+app, registered_entities["admin/"+app], "admin/"+target_device, "#", "protected", session=client)
+		logger.debug("BIND: {} sent a bind request for {} .".format(app, target_device))
+		if on_done is not None:
+			for p in handshake.completed_by_bind(app, target_device):
+				on_done(p)
+	run_in_parallel(bind, handshake.binds(), concurrency, "BIND", progress_callback)
+
+
+def resume_from_journal(journal, entities, permissions):
+	""" The entities already registered (with their apikeys), and
+	the entities and permissions still to be set up, from a journal."""
+	registered_entities = dict(("admin/"+e, journal.registered["admin/"+e]) for e in entities
+		if journal.is_registered("admin/"+e) and not journal.is_uncertain("admin/"+e))
+	to_register = [e for e in entities if "admin/"+e not in registered_entities]
+	to_set_up = [p for p in permissions if not journal.is_set_up(p)]
+	if registered_entities or len(to_set_up) < len(permissions):
+		logger.info("SETUP: resuming. {} of {} entities already registered, {} of {} permissions already set up.".format(
+			len(registered_entities), len(entities), len(permissions) - len(to_set_up), len(permissions)))
+	return registered_entities, to_register, to_set_up
+
+
+def register_entities(system_description, registration_info_file=None, concurrency=1, progress_callback=log_progress, journal=None):
 	""" routine to register a bunch of entities 
 	and setup the required permissions between them.
 	
@@ -62,7 +283,20 @@ def register_entities(system_description, registration_info_file=None):
 	                       }
 	
 	    registration_info_file (optional): File handle for an open file with
-	    write permission. If specified, registration information is saved into this file.
+	    write permission, or a registration_store.RegistrationStore. 
+	    If specified, registration information is saved into it.
+	    
+	    concurrency (optional): number of requests to the middleware
+	    that can be in progress at the same time.
+	    
+	    progress_callback (optional): called as progress_callback(stage, num_done, num_total)
+	    during each stage ("REGISTER", "FOLLOW", "SHARE", "STATUS", "BIND").
+	    
+	    journal (optional): a setup_journal.SetupJournal. Each entity registered
+	    and each permission set up is recorded in the journal. Entities and
+	    permissions recorded in it by an earlier (failed) run are not set up
+	    again, and if setup fails, the entities registered are kept
+	    (instead of being deregistered) so that setup can be resumed.
 	
 	 Return Values:
 	     The routines returns True if there were no errors 
@@ -70,96 +304,65 @@ def register_entities(system_description, registration_info_file=None):
 	     the entities that were registered successfully and their corresponding apikeys.
 	 """
 	registered_entities = {}
+	registered_entities_lock = threading.Lock()
 	logger.info("SETUP: setting up entities and permissions from system description.")
 	
+	# a pool of keep-alive connections shared by the workers
+	client = corinthian_messaging.CorinthianClient(pool_size=concurrency)
+	
 	try:
 	
 		devices = system_description["devices"]
 		apps   = system_description["apps"]
 		entities = devices+apps
 		permissions = system_description["permissions"]
+		check_system_description(system_description)
 		
-		# check if all entity names are sane.
-		for name in entities:
-			if not (all(c.isdigit() or c.islower() for c in name)):
-				logger.error("Illegal entity name:{}".format(name))
-				logger.error("Entity names can only contain lowercase letters and numbers.")
-				assert(False),"Illegal entity name"
-		
-		# check if all permissions are sane
-		for p in permissions:
-			assert(len(p)==3)
-			app = p[0]
-			dev = p[1]
-			permission = p[2]
-			
-			assert(app in apps)
-			assert(dev in devices)
-			assert(permission=="read" or permission=="write" or permission=="read-write")
-		
+		# skip what an earlier run recorded in the journal
+		to_register = entities
+		to_set_up = permissions
+		if journal is not None:
+			registered_entities, to_register, to_set_up = resume_from_journal(journal, entities, permissions)
 		
 		# Now register all entities:
-		for i in entities:
-			apikey = corinthian_messaging.register(i)
-			logger.info("REGISTER: registering entity {} successful. apikey ={} ".format(i,apikey))
-			registered_entities["admin/"+i]=apikey
+		def register(i):
+			if journal is not None:
+				if journal.is_uncertain("admin/"+i):
+					# an earlier run died while registering it
+					deregister_journaled("admin/"+i, journal, lambda: corinthian_messaging.deregister("admin/"+i, session=client))
+				journal.registering("admin/"+i)
+			apikey = corinthian_messaging.register(i, session=client)
+			logger.debug("REGISTER: registering entity {} successful. apikey ={} ".format(i,apikey))
+			with registered_entities_lock:
+				registered_entities["admin/"+i]=apikey
+			if journal is not None:
+				journal.record_registration("admin/"+i, apikey)
+		
+		logger.info("SETUP: registering {} entities...".format(len(to_register)))
+		run_in_parallel(register, to_register, concurrency, "REGISTER", progress_callback)
 				
-		# Set up permissions one-by-one
-		logger.info("SETUP: setting up permissions between entities...")
-		for p in permissions:
-			app = p[0]
-			target_device = p[1]
-			permission = p[2]
-			
-			app_apikey = registered_entities["admin/"+app]
-			target_device_apikey = registered_entities["admin/"+target_device]
-			
-			# send a follow request
-			success = corinthian_messaging.follow("admin/"+app, app_apikey, "admin/"+target_device, permission)
-			logger.debug("FOLLOW: {} sent a follow request to {} for permission {}".format(app, target_device, permission))
-			
-			# get the target_device to check the follow request
-			messages = corinthian_messaging.follow_requests("admin/"+target_device, target_device_apikey,"requests")
-			follow_list = []
-			if permission == "read" or permission == "write":
-				follow_list.append(messages.json()[0]["follow-id"])
-			elif permission == "read-write":
-				follow_list.append(messages.json()[0]["follow-id"])
-				follow_list.append(messages.json()[1]["follow-id"])
-			logger.debug("FOLLOW: {} received a follow request from {} for permission {}".format(target_device,app, permission))
-			# get the target entitity to approve the follow request using "share" 
-			for follow_id in follow_list:
-				success = corinthian_messaging.share("admin/"+target_device,target_device_apikey, follow_id)
-			logger.debug("SHARE: {} sent a share request for entity {} for permission {}".format(target_device, app, permission))
-			# get the app to check for the follow notification
-			follow_status_response = corinthian_messaging.follow_requests("admin/"+app, app_apikey, "status")
-			statuses = follow_status_response.json()
-			for status in statuses:
-				assert(status["status"] == "approved")
-			logger.debug("FOLLOW: follow request made by {} was approved.".format(app))
-			if permission == "read" or permission == "read-write":
-				# get the app to bind to the target entity's protected stream
-				success = corinthian_messaging.bind_unbind("admin/"+app, app_apikey, "admin/"+target_device, "#", "protected")
-				logger.debug("BIND: {} sent a bind request for {} .".format(app, target_device))
+		# Set up permissions
+		setup_permissions(to_set_up, registered_entities, client, concurrency, progress_callback,
+			on_done=journal.record_permission if journal is not None else None)
 		
 		# setup done!
 		logger.info("SETUP: done.")
 		# write out the registration info in a file.
 		if(registration_info_file):
-			logger.info("SETUP: writing info about registered entities into file {}.".format(registration_info_file.name))
-			devices = ["admin/"+str(i) for i in devices]
-			apps = ["admin/"+str(i) for i in apps]
-			registration_info_file.write("\ndevices= %s"%devices)
-			registration_info_file.write("\napps= %s"%apps)
-			registration_info_file.write("\npermissions= %s"%permissions)
-			registration_info_file.write("\nregistered_entities= %s"%registered_entities)
+			write_registration_info(registration_info_file, system_description, registered_entities)
 		
 		return True, registered_entities
 	
 	except:
+		if journal is not None:
+			logger.error("An exception occurred during setup. The progress so far is recorded in {}."
+				" Run the setup again to resume.".format(journal.path))
+			raise
 		logger.error("An exception occurred during setup. Deregistering all registered entities.") 
-		deregister_entities(registered_entities)
+		deregister_entities(list(registered_entities), concurrency)
 		raise
+	finally:
+		client.close()
 
 
 
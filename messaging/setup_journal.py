@@ -0,0 +1,132 @@
+#! python3
+#
+# A durable journal of the progress of setup and teardown.
+#
+# Registering a large fleet and setting up its permissions takes a long
+# time. With a SetupJournal, register_entities() and deregister_entities()
+# (in setup_entities.py and async_setup_entities.py) record each entity
+# registered, each permission set up and each entity deregistered as soon
+# as it is done, in an append-only file (one JSON record per line, flushed
+# to disk after each record). If setup or teardown fails part-way, running
+# it again with the same journal resumes from where it stopped, instead of
+# starting over.
+#
+# The journal records:
+#	{"op": "registering", "entity": ...}     before a registration request
+#	{"op": "registered", "entity": ..., "apikey": ...}
+#	{"op": "permission", "permission": [<app>, <device>, <permission>]}
+#	{"op": "deregistering", "entity": ...}   before a deregistration request
+#	{"op": "deregistered", "entity": ...}
+# An entity with a request started but not finished (the process died
+# while the request was in progress) may or may not have been
+# (de)registered by the middleware. Such entities are deregistered
+# (ignoring errors) and registered again on resume.
+#
+# Usage:
+#	journal = SetupJournal("setup_journal.jsonl")
+#	success, registered_entities = register_entities(system_description, f, journal=journal)
+#	...
+#	deregister_entities(list(registered_entities), journal=journal)
+#	journal.close()
+
+from __future__ import print_function
+import os
+import json
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+
+class SetupJournal(object):
+
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.Lock()
+
+		# registered entity : apikey
+		self.registered = {}
+		# permissions set up, as (<app>, <device>, <permission>)
+		self.permissions = set()
+		# entities with a request in progress
+		self.in_progress = set()
+		self.deregistered = set()
+
+		if os.path.exists(path):
+			self.load()
+		self.file = open(path, "a")
+
+	def load(self):
+		with open(self.path) as f:
+			text = f.read()
+		# each record ends with a newline, so anything after
+		# the last newline is a record cut short when the process died.
+		complete = text.rfind("\n") + 1
+		if complete < len(text):
+			logger.warning("Ignoring an incomplete last record in {}".format(self.path))
+			with open(self.path, "r+") as f:
+				f.truncate(len(text[:complete].encode()))
+		for line in text[:complete].splitlines():
+			try:
+				record = json.loads(line)
+			except ValueError:
+				assert(False), "Corrupt record in setup journal {}: {}".format(self.path, line)
+			self.apply(record)
+		logger.info("SETUP JOURNAL: {} entities registered, {} permissions set up, {} entities deregistered so far (from {}).".format(
+			len(self.registered), len(self.permissions), len(self.deregistered), self.path))
+
+	def apply(self, record):
+		op = record["op"]
+		if op in ("registering", "deregistering"):
+			self.in_progress.add(record["entity"])
+		elif op == "registered":
+			self.in_progress.discard(record["entity"])
+			self.deregistered.discard(record["entity"])
+			self.registered[record["entity"]] = record["apikey"]
+		elif op == "permission":
+			self.permissions.add(tuple(record["permission"]))
+		elif op == "deregistered":
+			entity = record["entity"]
+			self.in_progress.discard(entity)
+			self.registered.pop(entity, None)
+			self.deregistered.add(entity)
+			# the permissions of the entity are gone with it
+			self.permissions = set(p for p in self.permissions if entity not in ("admin/"+p[0], "admin/"+p[1]))
+		else:
+			assert(False), "Invalid record in setup journal: {}".format(record)
+
+	def write(self, record):
+		with self.lock:
+			self.apply(record)
+			self.file.write(json.dumps(record) + "\n")
+			self.file.flush()
+			os.fsync(self.file.fileno())
+
+	# routines used by setup/teardown to record their progress
+	def registering(self, entity):
+		self.write({"op": "registering", "entity": entity})
+
+	def record_registration(self, entity, apikey):
+		self.write({"op": "registered", "entity": entity, "apikey": apikey})
+
+	def record_permission(self, permission):
+		self.write({"op": "permission", "permission": list(permission)})
+
+	def deregistering(self, entity):
+		self.write({"op": "deregistering", "entity": entity})
+
+	def record_deregistration(self, entity):
+		self.write({"op": "deregistered", "entity": entity})
+
+	# routines used for resuming setup/teardown
+	def is_registered(self, entity):
+		return entity in self.registered
+
+	def is_uncertain(self, entity):
+		""" Was a request for the entity in progress when the process died?"""
+		return entity in self.in_progress
+
+	def is_set_up(self, permission):
+		return tuple(permission) in self.permissions
+
+	def close(self):
+		self.file.close()
@@ -0,0 +1,169 @@
+# !python3
+#
+# Running a simulation as several processes (shards).
+#
+# A simulation in a single Python process is bound to a single core.
+# The sharded runner splits the devices and apps into <num_shards> shards
+# and runs each shard in its own process, with its own SimPy environment
+# and its own connections to the middleware. The entities of different
+# shards talk to each other only via the middleware, so an app in one shard
+# receives data from (and sends commands to) devices in all the shards.
+#
+# After creating its entities, each shard waits at a barrier until all the
+# shards are ready, and then syncs its real-time clock. So all the shards
+# start their simulations at (almost) the same wall-clock time.
+#
+# Log records of all shards are sent to the parent process and logged there
+# with the name of the shard. The counters returned by the shards
+# are merged (added up, or the maximum for counters named "max_...";
+# values with a merge() method, such as latency histograms, are merged).
+#
+# Usage:
+#	counters = run_sharded(shard_function, devices, apps, num_shards)
+# where shard_function(devices, apps, wait_for_start, **kwargs) is a
+# module-level function that creates the entities of one shard, calls
+# wait_for_start() once they are ready, runs the simulation and
+# returns a dict of counters. (See run_simulation.py in the demos.)
+# Arguments with one item per device (such as a schedule of publish
+# times) can be given as split_kwargs: each shard gets the items of
+# its own devices.
+
+from __future__ import print_function
+import multiprocessing
+from queue import Empty
+import logging
+import logging.handlers
+logger = logging.getLogger(__name__)
+
+
+# maximum time (in seconds) that a shard waits
+# for the other shards to be ready.
+START_TIMEOUT = 600
+
+
+def split(items, num_shards):
+	""" Split a list into <num_shards> lists of (almost) the same length."""
+	return [items[i::num_shards] for i in range(num_shards)]
+
+
+def entity_counters(device_instances, app_instances):
+	""" Counts of the messages sent and received by the
+	communication interfaces of a set of device and app instances.
+	A device instance can also be a fleet of <num_devices> devices."""
+	devices = list(device_instances.values())
+	apps = list(app_instances.values())
+	return {"devices": sum(getattr(d, "num_devices", 1) for d in devices),
+		"apps": len(apps),
+		"published": sum(d.publish_thread.count for d in devices),
+		"commands_received": sum(d.receive_commands_thread.count for d in devices),
+		"received": sum(a.subscribe_thread.count for a in apps),
+		"commands_sent": sum(a.send_commands_thread.count for a in apps)}
+
+
+def merge_counters(list_of_counters):
+	""" Merge the counters of several shards."""
+	merged = {}
+	for counters in list_of_counters:
+		for key, value in counters.items():
+			if key.startswith("max_"):
+				merged[key] = max(merged.get(key, value), value)
+			elif hasattr(value, "merge"):
+				# such as latency histograms
+				if key in merged:
+					merged[key].merge(value)
+				else:
+					merged[key] = value
+			else:
+				merged[key] = merged.get(key, 0) + value
+	return merged
+
+
+def _run_shard(shard_function, index, devices, apps, barrier, log_queue, result_queue, logging_level, kwargs):
+	# send all log records to the parent process.
+	root = logging.getLogger()
+	root.handlers = [logging.handlers.QueueHandler(log_queue)]
+	root.setLevel(logging_level)
+
+	def wait_for_start():
+		logger.info("SHARD {}: {} devices and {} apps ready. Waiting for the other shards.".format(
+			index, len(devices), len(apps)))
+		barrier.wait(timeout=START_TIMEOUT)
+
+	try:
+		counters = shard_function(devices, apps, wait_for_start, **kwargs)
+		result_queue.put((index, counters, None))
+	except BaseException as e:
+		# don't leave the other shards waiting.
+		barrier.abort()
+		logger.exception("SHARD {}: failed.".format(index))
+		result_queue.put((index, None, repr(e)))
+
+
+def run_sharded(shard_function, devices, apps, num_shards, logging_level=logging.INFO, split_kwargs=None, **kwargs):
+	""" Run <shard_function> for <num_shards> shards of the lists
+	<devices> and <apps>, each in its own process. Extra keyword
+	arguments are passed on to shard_function. The values of
+	<split_kwargs> (sequences with one item per device) are split
+	as the devices are, and each shard gets its own part.
+	Returns the merged counters of all the shards.
+	"""
+	assert(num_shards > 0)
+	assert(len(devices) >= num_shards), "Each shard needs at least one device"
+	device_shards = split(devices, num_shards)
+	app_shards = split(apps, num_shards)
+	shard_kwargs = [dict(kwargs) for i in range(num_shards)]
+	for key, values in (split_kwargs or {}).items():
+		assert(len(values) == len(devices)), "{} needs one item per device".format(key)
+		for i, part in enumerate(split(values, num_shards)):
+			shard_kwargs[i][key] = part
+
+	log_queue = multiprocessing.Queue()
+	result_queue = multiprocessing.Queue()
+	barrier = multiprocessing.Barrier(num_shards)
+
+	# log the records of all shards here, with the shard's name.
+	handler = logging.StreamHandler()
+	handler.setFormatter(logging.Formatter("%(processName)s:%(levelname)s:%(name)s:%(message)s"))
+	listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=False)
+	listener.start()
+
+	processes = []
+	for i in range(num_shards):
+		p = multiprocessing.Process(target=_run_shard, name="shard-{}".format(i),
+			args=(shard_function, i, device_shards[i], app_shards[i], barrier, log_queue, result_queue, logging_level, shard_kwargs[i]))
+		p.start()
+		processes.append(p)
+	logger.info("Started {} shards with {} devices and {} apps.".format(num_shards, len(devices), len(apps)))
+
+	try:
+		results = {}
+		failed = set()
+		while len(results) + len(failed) < num_shards:
+			try:
+				index, counters, error = result_queue.get(timeout=1)
+			except Empty:
+				# check for shards that died without a result
+				for i, p in enumerate(processes):
+					if i not in results and i not in failed and p.exitcode not in (None, 0):
+						failed.add(i)
+						barrier.abort()
+						logger.error("Shard {} exited with code {}".format(i, p.exitcode))
+				continue
+			if error is None:
+				results[index] = counters
+				logger.info("Shard {} done: {}".format(index, counters))
+			else:
+				failed.add(index)
+				logger.error("Shard {} failed: {}".format(index, error))
+		for p in processes:
+			p.join()
+	finally:
+		for p in processes:
+			if p.is_alive():
+				p.terminate()
+		listener.stop()
+
+	assert(not failed), "Shards {} failed".format(sorted(failed))
+	counters = merge_counters([results[i] for i in range(num_shards)])
+	logger.info("All shards done: {}".format(counters))
+	return counters
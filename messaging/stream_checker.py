@@ -0,0 +1,130 @@
+# !python3
+#
+# Checking message streams for loss, duplication and reordering.
+#
+# Each sender numbers its messages 0, 1, 2, ... (the "seq" header,
+# see "Message stamps" in communication_interface.py). A StreamChecker
+# attached to a receiving interface tracks the stream from each sender
+# with a sliding window of the last <window> sequence numbers, kept as
+# a bitmap (a Python int). For each stream it counts:
+#	received:   messages received
+#	duplicates: messages whose seq was already seen
+#	reordered:  messages that arrived after a message with a higher seq
+#	late:       messages that arrived more than <window> messages late
+#	            (these can't be told apart from duplicates, and are
+#	            counted as if they were not)
+# and at the end of a run, the messages lost: the sequence numbers up to
+# the highest one seen that never arrived.
+#
+# The memory used is a few words per stream, however many messages
+# are received, so the checker is suitable for long soak tests.
+
+from __future__ import print_function
+import logging
+logger = logging.getLogger(__name__)
+
+
+class StreamReport(object):
+	""" Counts of the messages received, duplicated, reordered,
+	late and lost in a set of streams. Reports can be merged."""
+	FIELDS = ("streams", "expected", "received", "duplicates", "reordered", "late", "lost")
+
+	def __init__(self, **counts):
+		for f in self.FIELDS:
+			setattr(self, f, counts.get(f, 0))
+
+	def merge(self, other):
+		for f in self.FIELDS:
+			setattr(self, f, getattr(self, f) + getattr(other, f))
+		return self
+
+	def rate(self, count):
+		return count / float(self.expected) if self.expected else 0.0
+
+	def summary(self):
+		s = dict((f, getattr(self, f)) for f in self.FIELDS)
+		s["loss_rate"] = self.rate(self.lost)
+		s["duplicate_rate"] = self.rate(self.duplicates)
+		s["reorder_rate"] = self.rate(self.reordered)
+		return s
+
+	def __repr__(self):
+		return "StreamReport({})".format(self.summary())
+
+
+class _Stream(object):
+	__slots__ = ("highest", "bitmap", "received", "duplicates", "reordered", "late")
+
+	def __init__(self):
+		self.highest = -1
+		# bit i is set if seq (highest - i) was received
+		self.bitmap = 0
+		self.received = 0
+		self.duplicates = 0
+		self.reordered = 0
+		self.late = 0
+
+
+class StreamChecker(object):
+	""" Tracks the streams of messages received from each sender."""
+	def __init__(self, window=1024):
+		assert(window > 0)
+		self.window = window
+		self.mask = (1 << window) - 1
+		self.streams = {}
+
+	def check(self, sender, seq):
+		""" Record the arrival of message number <seq> from <sender>."""
+		s = self.streams.get(sender)
+		if s is None:
+			s = self.streams[sender] = _Stream()
+		s.received += 1
+		if seq > s.highest:
+			s.bitmap = ((s.bitmap << (seq - s.highest)) | 1) & self.mask
+			s.highest = seq
+			return
+		offset = s.highest - seq
+		if offset >= self.window:
+			s.late += 1
+		elif s.bitmap >> offset & 1:
+			s.duplicates += 1
+		else:
+			s.bitmap |= 1 << offset
+			s.reordered += 1
+
+	def report(self):
+		r = StreamReport()
+		for s in self.streams.values():
+			r.streams += 1
+			r.expected += s.highest + 1
+			r.received += s.received
+			r.duplicates += s.duplicates
+			r.reordered += s.reordered
+			r.late += s.late
+			r.lost += max(0, s.highest + 1 - (s.received - s.duplicates))
+		return r
+
+
+def collect(device_instances, app_instances):
+	""" Merged stream reports of the interfaces of a set of device
+	(or fleet) and app instances:
+	    "data_streams": devices -> apps
+	    "command_streams": apps -> devices
+	"""
+	data = StreamReport()
+	command = StreamReport()
+	for a in app_instances.values():
+		data.merge(a.subscribe_thread.checker.report())
+	for d in device_instances.values():
+		command.merge(d.receive_commands_thread.checker.report())
+	return {"data_streams": data, "command_streams": command}
+
+
+def log_reports(counters):
+	""" Log the stream reports in a dict of counters."""
+	for name, r in sorted(counters.items()):
+		if isinstance(r, StreamReport):
+			if r.lost or r.duplicates or r.reordered or r.late:
+				logger.warning("STREAMS {}: {}".format(name, r.summary()))
+			else:
+				logger.info("STREAMS {}: {}".format(name, r.summary()))
@@ -0,0 +1,180 @@
+# !python3
+#
+# Replaying recorded traffic through the communication interfaces.
+#
+# A trace is a sequence of events, in order of time:
+#	(time, entity, kind, to, body)
+# where <time> is in seconds, <kind> is PUBLISH (a device publishing data)
+# or COMMAND (an app sending a command to the device <to>), and <body> is
+# the message (a JSON string) to be sent.
+#
+# Traces are streamed from disk, never loaded into memory as a whole.
+# Two formats are supported:
+#	- JSON lines (files ending in .jsonl or .json), one event per line:
+#	      {"time": 12.5, "entity": "dev7", "type": "publish", "body": {...}}
+#	      {"time": 12.7, "entity": "app1", "type": "command", "to": "dev7",
+#	       "body": {"command": "RESUME"}}
+#	  Instead of a body, an event can give the "size" of its message
+#	  in bytes; a dummy message of (about) that size is sent.
+#	  This is the format to convert traces of real deployments into.
+#	- traffic logs written by recorder.Recorder. Only the messages
+#	  published are replayed (the log does not record the devices
+#	  that commands were sent to), as dummy messages of the recorded size.
+#
+# The entities in a trace need not be those registered with the
+# middleware: each device (or app) in the trace is mapped to one of the
+# registered devices (or apps) in order of first appearance, cycling
+# through them if the trace has more entities than were registered.
+#
+# A TraceReplayer is a SimPy process that sends each event at its
+# original time (relative to the first event), divided by <speedup>.
+# In a real-time environment this reproduces the original inter-arrival
+# times (and bursts) of the trace.
+
+from __future__ import print_function
+import json
+import struct
+import logging
+logger = logging.getLogger(__name__)
+
+import communication_interface
+import recorder
+
+PUBLISH = "publish"
+COMMAND = "command"
+
+
+def dummy_body(size, key="data"):
+	""" A JSON message of (about) <size> bytes."""
+	return json.dumps({key: "x" * max(0, size - len(key) - 8)})
+
+def dummy_command(size):
+	return json.dumps({"command": "REPLAY", "data": "x" * max(0, size - 35)})
+
+
+def read_jsonl(path):
+	""" Stream the events of a JSON-lines trace."""
+	with open(path) as f:
+		for line in f:
+			line = line.strip()
+			if not line:
+				continue
+			e = json.loads(line)
+			kind = e.get("type", PUBLISH)
+			assert(kind in (PUBLISH, COMMAND)), "Invalid event type {}".format(kind)
+			if "body" in e:
+				body = e["body"] if isinstance(e["body"], str) else json.dumps(e["body"])
+			elif kind == PUBLISH:
+				body = dummy_body(e.get("size", 32))
+			else:
+				body = dummy_command(e.get("size", 32))
+			yield float(e["time"]), e["entity"], kind, e.get("to"), body
+
+
+def read_recording(path, chunk_size=65536):
+	""" Stream the messages published in a traffic log of recorder.Recorder."""
+	with open(path + ".entities") as f:
+		entities = f.read().splitlines()
+	skipped = 0
+	with open(path, "rb") as f:
+		while True:
+			chunk = f.read(chunk_size * recorder.RECORD_SIZE)
+			if not chunk:
+				break
+			chunk = chunk[:len(chunk) - len(chunk) % recorder.RECORD_SIZE]
+			for timestamp, entity, direction, size, seq in struct.iter_unpack(recorder.RECORD_FORMAT, chunk):
+				if direction == recorder.PUBLISHED:
+					yield timestamp / 1e9, entities[entity], PUBLISH, None, dummy_body(size)
+				elif direction == recorder.COMMAND_SENT:
+					skipped += 1
+	if skipped:
+		logger.warning("Skipped {} commands in {} (their devices were not recorded).".format(skipped, path))
+
+
+def read_trace(path):
+	if path.endswith(".jsonl") or path.endswith(".json"):
+		return read_jsonl(path)
+	return read_recording(path)
+
+
+class ReplayedDevice(object):
+	""" A device that only publishes the data and receives
+	the commands given by the trace."""
+	def __init__(self, ID, apikey):
+		self.ID = ID
+		self.publish_thread = communication_interface.PublishInterface(ID, apikey)
+		self.receive_commands_thread = communication_interface.ReceiveCommandsInterface(ID, apikey)
+
+	def end(self):
+		self.publish_thread.stop()
+		self.receive_commands_thread.stop()
+
+
+class TraceReplayer(object):
+	""" Replays the events of <trace> (an iterable of events, such as
+	read_trace(path)) from the registered <devices> and apps
+	(<app_instances>: app ID : app instance with a send_commands_thread).
+	"""
+	def __init__(self, env, trace, devices, registered_entities, app_instances, speedup=1.0):
+		assert(speedup > 0)
+		assert(len(devices) > 0)
+		self.env = env
+		self.trace = trace
+		self.devices = list(devices)
+		self.apps = list(app_instances)
+		self.registered_entities = registered_entities
+		self.app_instances = app_instances
+		self.speedup = speedup
+
+		# trace entity : registered entity
+		self.device_map = {}
+		self.app_map = {}
+
+		# registered device ID : ReplayedDevice,
+		# created when the device is first used.
+		self.device_instances = {}
+
+		# count of the events replayed
+		self.count = 0
+
+		self.behavior_process = self.env.process(self.behavior())
+
+	def map_entity(self, name, mapping, registered):
+		ID = mapping.get(name)
+		if ID is None:
+			ID = mapping[name] = registered[len(mapping) % len(registered)]
+		return ID
+
+	def device(self, name):
+		ID = self.map_entity(name, self.device_map, self.devices)
+		d = self.device_instances.get(ID)
+		if d is None:
+			d = self.device_instances[ID] = ReplayedDevice(ID, self.registered_entities[ID])
+		return d
+
+	def behavior(self):
+		start_time = self.env.now
+		first_event_time = None
+		for time, entity, kind, to, body in self.trace:
+			if first_event_time is None:
+				first_event_time = time
+			# wait until the (scaled) time of the event.
+			# Events at the same time are sent together.
+			delay = start_time + (time - first_event_time) / self.speedup - self.env.now
+			if delay > 0:
+				yield self.env.timeout(delay)
+
+			if kind == PUBLISH:
+				self.device(entity).publish_thread.publish(body)
+			else:
+				assert(self.apps), "The trace has commands but there are no apps"
+				app = self.map_entity(entity, self.app_map, self.apps)
+				device = self.device(to)
+				self.app_instances[app].send_commands_thread.send_command(device.ID, body)
+			self.count += 1
+		logger.info("SIM_TIME:{} TraceReplayer replayed {} events from {} devices and {} apps.".format(
+			self.env.now, self.count, len(self.device_map), len(self.app_map)))
+
+	def end(self):
+		for d in self.device_instances.values():
+			d.end()
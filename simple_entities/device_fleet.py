@@ -0,0 +1,229 @@
+#!python3
+
+# SimPy model for a fleet of simple devices.
+#
+# The DeviceFleet behaves like a set of SimpleDevice instances,
+# but keeps the state of all its devices in NumPy arrays and
+# advances all of them in a single SimPy process. The data of all
+# the devices publishing at the same time is handed to the publish
+# interface as a single batch, and the commands received by all
+# devices are read from a single queue.
+#
+# As in SimpleDevice, each device:
+#	- in the NORMAL state, publishes sensor data once per period
+#	  (up to max_publish_count messages) and reads its commands.
+#	- when a fault is injected, enters the FAULT state: it publishes
+#	  a "FAULT" status, stops publishing data and waits for a RESUME
+#	  command (woken up when a command arrives, see event_bridge.py).
+#	- goes back to the NORMAL state as soon as the RESUME command
+#	  arrives, publishes right away, and then once per period again.
+#
+# Alternatively, the devices can publish at the times given by a schedule
+# (publish_times, an array of shape (num_devices, count), see
+# /messaging/arrivals.py), as SimpleDevices with a schedule do. The fleet
+# then wakes up once every <resolution> seconds (at most) and publishes
+# the data of all the devices whose publish times have come. Publish
+# times that pass while a device is in the FAULT state are skipped.
+#
+# Requires NumPy and a shared transport
+# (see "Fleet interfaces" in communication_interface.py).
+
+import sys
+import json
+import numpy as np
+import logging
+logger = logging.getLogger(__name__)
+
+# Interfaces for communication with the middleware
+sys.path.insert(0, '../messaging')
+import communication_interface
+import event_bridge
+
+# device states
+NORMAL = 0
+FAULT = 1
+
+# tolerance (in seconds) when comparing publish times with the
+# simulation time (which is advanced by floating-point timeouts)
+EPSILON = 1e-9
+
+
+class DeviceFleet(object):
+
+	def __init__(self, env, IDs, apikeys, period=1, max_publish_count=10, publish_times=None, resolution=0.01):
+		self.env = env
+		self.IDs = list(IDs)       # unique identifiers of the devices
+		self.num_devices = len(self.IDs)
+		self.period = period       # operational period of the devices (in seconds)
+		self.max_publish_count = max_publish_count # number of messages published by each device
+
+		# device number of each ID
+		self.index = dict((ID, i) for i, ID in enumerate(self.IDs))
+
+		# state of each device (NORMAL or FAULT)
+		self.state = np.full(self.num_devices, NORMAL, dtype=np.int8)
+		# number of data messages published by each device
+		self.publish_count = np.zeros(self.num_devices, dtype=np.int64)
+		# devices in the FAULT state that received a RESUME command
+		self.resume_received = np.zeros(self.num_devices, dtype=bool)
+		# time at which each device publishes next (without a schedule)
+		self.next_publish = np.zeros(self.num_devices)
+
+		# interfaces for publishing data and receiving commands:
+		self.publish_thread = communication_interface.FleetPublishInterface(self.IDs, apikeys)
+		self.receive_commands_thread = communication_interface.FleetReceiveCommandsInterface(self.IDs, apikeys)
+		# triggered when a command arrives
+		self.command_arrived = event_bridge.MessageSignal(self.env, self.receive_commands_thread)
+		# triggered when faults are injected
+		self.faults_injected = self.env.event()
+
+		# optional schedule of publish times
+		self.schedule_times = None
+		if publish_times is not None:
+			self.init_schedule(publish_times, resolution)
+			self.behavior_process=self.env.process(self.behavior_scheduled())
+			return
+
+		# start a single simpy process for the behavior of all devices
+		self.behavior_process=self.env.process(self.behavior())
+
+	def init_schedule(self, publish_times, resolution):
+		publish_times = np.asarray(publish_times, dtype=float)
+		assert(publish_times.shape[0] == self.num_devices)
+		self.resolution = resolution
+		# all publish times of all devices, in order of time
+		order = np.argsort(publish_times, axis=None, kind="stable")
+		self.schedule_times = publish_times.ravel()[order]
+		self.schedule_devices = (order // publish_times.shape[1]).astype(np.int64)
+		# index of the next publish time in the schedule
+		self.schedule_index = 0
+		self.max_publish_count = publish_times.shape[1]
+
+	# devices that have not yet published all their messages
+	def active(self):
+		return self.publish_count < self.max_publish_count
+
+	# main behavior of the fleet:
+	def behavior(self):
+		while self.active().any():
+			# check for commands from the middleware first, so that
+			# the devices that were resumed publish right away.
+			self.resume()
+
+			#---------------------------
+			# NORMAL STATE: publish sensor data
+			# (the devices whose next period has come)
+			#---------------------------
+			normal = (self.state == NORMAL) & self.active()
+			publishing = np.flatnonzero(normal & (self.next_publish <= self.env.now + EPSILON))
+			if len(publishing):
+				counts = self.publish_count[publishing].tolist()
+				data = ['{"sensor_value": "%d"}' % c for c in counts]
+				self.publish_count[publishing] += 1
+				self.next_publish[publishing] = self.env.now + self.period
+				self.publish_thread.publish_batch(publishing.tolist(), data)
+				logger.debug("SIM_TIME:{} FLEET: {} devices published data".format(self.env.now, len(publishing)))
+
+			# wait till the next period of a device
+			# (or until a command arrives for a device in the FAULT state).
+			if not self.active().any():
+				break
+			normal = (self.state == NORMAL) & self.active()
+			delay = self.next_publish[normal].min() - self.env.now if normal.any() else None
+			yield self.wait(delay)
+
+	# main behavior of the fleet with a schedule of publish times:
+	def behavior_scheduled(self):
+		while self.schedule_index < len(self.schedule_times):
+			# check for commands from the middleware first, so that
+			# the devices that were resumed publish at the times that
+			# have come.
+			self.resume()
+
+			# devices whose publish times have come
+			end = int(np.searchsorted(self.schedule_times, self.env.now + EPSILON, side="right"))
+			due = self.schedule_devices[self.schedule_index:end]
+			self.schedule_index = end
+
+			# publish sensor data (devices in the FAULT state skip it)
+			publishing = due[self.state[due] == NORMAL]
+			if len(publishing):
+				counts = self.publish_count[publishing].tolist()
+				data = ['{"sensor_value": "%d"}' % c for c in counts]
+				np.add.at(self.publish_count, publishing, 1)
+				self.publish_thread.publish_batch(publishing.tolist(), data)
+				logger.debug("SIM_TIME:{} FLEET: {} devices published data".format(self.env.now, len(publishing)))
+
+			# wait until the next publish time (at least <resolution>
+			# seconds), or until a command arrives for a device in
+			# the FAULT state.
+			if self.schedule_index == len(self.schedule_times):
+				break
+			delay = max(self.schedule_times[self.schedule_index] - self.env.now, self.resolution)
+			yield self.wait(delay)
+
+	# an event for waiting <delay> seconds (or forever if None), until
+	# a command arrives while devices are in the FAULT state, or until
+	# faults are injected.
+	def wait(self, delay):
+		if self.faults_injected.triggered:
+			self.faults_injected = self.env.event()
+		events = [self.faults_injected]
+		if delay is not None:
+			events.append(self.env.timeout(max(delay, 0)))
+		if (self.state == FAULT).any():
+			# (or till the next clock cycle in environments
+			# that messages can't wake up)
+			events.append(self.command_arrived.wait(self.period))
+		return self.env.any_of(events)
+
+	# check for commands from the middleware, and put the devices
+	# that got a RESUME command back into the NORMAL state.
+	def resume(self):
+		self.check_commands()
+		resumed = (self.state == FAULT) & self.resume_received
+		if resumed.any():
+			self.state[resumed] = NORMAL
+			self.resume_received[resumed] = False
+			self.next_publish[resumed] = self.env.now
+			logger.debug("SIM_TIME:{} FLEET: {} devices resumed".format(self.env.now, int(resumed.sum())))
+
+	def check_commands(self):
+		queue = self.receive_commands_thread.queue
+		while not queue.empty():
+			i, cmd = queue.get()
+			logger.debug("SIM_TIME:{} ENTITY:{} received command {}.".format(self.env.now, self.IDs[i], cmd))
+			if self.state[i] == FAULT:
+				assert("command" in cmd["data"])
+				if cmd["data"]["command"] == "RESUME":
+					self.resume_received[i] = True
+
+	def inject_faults(self, IDs):
+		""" Put the devices <IDs> into the FAULT state (as an interrupt
+		with cause "FAULT" does for a SimpleDevice). Devices that have
+		published all their messages are not affected."""
+		indices = np.array([self.index[ID] for ID in IDs], dtype=np.int64)
+		if self.schedule_times is not None:
+			# devices with publish times left
+			left = np.zeros(self.num_devices, dtype=bool)
+			left[self.schedule_devices[self.schedule_index:]] = True
+			indices = indices[left[indices]]
+		else:
+			indices = indices[self.active()[indices]]
+		if not len(indices):
+			return
+		self.state[indices] = FAULT
+		self.resume_received[indices] = False
+		# wake up the fleet to wait for commands
+		if not self.faults_injected.triggered:
+			self.faults_injected.succeed()
+		logger.debug("SIM_TIME:{} FLEET: {} devices entered the FAULT state.".format(self.env.now, len(indices)))
+		# send a "fault" status to the app
+		status = json.dumps({"status":"FAULT"})
+		self.publish_thread.publish_batch(indices.tolist(), [status]*len(indices))
+
+	# stop all communication interfaces
+	def end(self):
+		self.publish_thread.stop()
+		self.receive_commands_thread.stop()
+		logger.debug("SIM_TIME:{} FLEET: {} devices stopping.".format(self.env.now, self.num_devices))
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-# Script for deregistering all entities listed in file registration_info.py
+# Script for deregistering all entities listed in the registration store registration_info.db
 #
 # Author: Neha Karanjkar
 
@@ -15,19 +15,35 @@ logger = logging.getLogger(__name__)
 # and for registrations/deregistratiosn etc:
 sys.path.insert(0, '../messaging')
 import setup_entities
+import setup_journal
+import registration_store
 
-def do_deregistrations(registration_info_modulename):
+def do_deregistrations(registration_info_modulename, concurrency=1, backend="threads", journal_path=None):
 	""" de-register all entities specified 
-	in the file (.py) registration_info_modulename.
+	in the registration store <registration_info_modulename>
+	(see registration_store.open_store),
+	using <concurrency> parallel requests.
+	The requests are made by a pool of threads (backend="threads")
+	or from an asyncio event loop (backend="asyncio", requires aiohttp).
+	If <journal_path> is specified, the progress is recorded in a
+	setup journal (see setup_journal.py), and the entities that a
+	previous (failed) run already deregistered are skipped.
 	"""
-	import importlib
-	c = importlib.import_module(registration_info_modulename, package=None)
-	devices = c.devices
-	apps = c.apps
-	logger.info("DE-REGISTER: de-registering all devices from file {}....".format(registration_info_modulename))
-	setup_entities.deregister_entities(devices)
-	logger.info("DE-REGISTER: de-registering all apps from file {}....".format(registration_info_modulename))
-	setup_entities.deregister_entities(apps)
+	setup_module = setup_entities
+	if backend == "asyncio":
+		import async_setup_entities
+		setup_module = async_setup_entities
+	store = registration_store.open_store(registration_info_modulename)
+	devices = store.entities("device")
+	apps = store.entities("app")
+	store.close()
+	journal = setup_journal.SetupJournal(journal_path) if journal_path is not None else None
+	try:
+		logger.info("DE-REGISTER: de-registering all devices and apps from file {}....".format(registration_info_modulename))
+		setup_module.deregister_entities(devices + apps, concurrency, journal=journal)
+	finally:
+		if journal is not None:
+			journal.close()
 	logger.info("DE-REGISTER: done.")
 
 
@@ -44,9 +60,13 @@ if __name__=='__main__':
 	logging.getLogger("setup_entities").setLevel(logging.INFO)
 
 	registration_info_modulename = "registration_info"
-	registration_info_filename = registration_info_modulename+".py"
+	registration_info_filename = registration_info_modulename+".db"
 	
 	# DO DEREGISTRATIONS
-	do_deregistrations(registration_info_modulename)
+	# (resumes from the journal written by do_setup.py, if any)
+	journal_path = "setup_journal.jsonl"
+	do_deregistrations(registration_info_modulename, concurrency=8, journal_path=journal_path)
 	os.remove(registration_info_filename)
+	if os.path.exists(journal_path):
+		os.remove(journal_path)
 	
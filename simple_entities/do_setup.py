@@ -17,6 +17,8 @@ logger = logging.getLogger(__name__)
 # and for registrations/deregistration etc:
 sys.path.insert(0, '../messaging')
 import setup_entities
+import setup_journal
+import registration_store
 
 if __name__=='__main__':
 
@@ -40,11 +42,30 @@ if __name__=='__main__':
 	                        "apps"          : apps,
 	                        "permissions"   : [ (a,d,"read-write") for a in apps for d in devices ]
 	                    }
-	registration_info_modulename = "registration_info"
-	registration_info_filename = registration_info_modulename+".py"
+	# the registration information is saved into
+	# a registration store (see registration_store.py)
+	registration_info_filename = "registration_info.db"
+	
+	# Requests to the middleware can be made either by a pool 
+	# of threads ("threads") or from a single asyncio event loop 
+	# ("asyncio", requires aiohttp). CONCURRENCY is the number of 
+	# requests in progress at the same time.
+	SETUP_BACKEND = "threads"
+	CONCURRENCY = 8
+	setup_module = setup_entities
+	if SETUP_BACKEND == "asyncio":
+		import async_setup_entities
+		setup_module = async_setup_entities
+	
+	# The progress of the setup is recorded in a journal.
+	# If the setup fails, running this script again resumes it
+	# (the journal is used by do_deregistrations.py too).
+	journal = setup_journal.SetupJournal("setup_journal.jsonl")
 	
 	# REGISTRATIONS
-	with open(registration_info_filename, "w+") as f:
-		success, registered_entities = setup_entities.register_entities(system_description,f)
+	store = registration_store.RegistrationStore(registration_info_filename)
+	success, registered_entities = setup_module.register_entities(system_description,store,concurrency=CONCURRENCY,journal=journal)
 	assert(success)
+	store.close()
+	journal.close()
 	
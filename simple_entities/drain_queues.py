@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+# Script for draining the messages left in the queues of the registered
+# apps and devices (by an earlier test run), so that the next run doesn't
+# receive them (see /messaging/queue_drain.py).
+#
+# Usage:
+#	./drain_queues.py                          # purge the queues of all the entities
+#	./drain_queues.py --devices 100 --apps 1   # only those used by a smaller run
+#	./drain_queues.py --mode consume           # consume the messages instead of purging
+
+import sys
+import argparse
+
+# logging
+import logging
+logger = logging.getLogger(__name__)
+
+sys.path.insert(0, '../messaging')
+import registration_store
+import queue_drain
+
+
+if __name__=='__main__':
+
+	parser = argparse.ArgumentParser(description="Drain the queues of the registered entities.")
+	parser.add_argument("--registration-info", default="registration_info", help="name of the registration store")
+	parser.add_argument("--devices", type=int, default=None, help="drain the queues of the first DEVICES devices only")
+	parser.add_argument("--apps", type=int, default=None, help="drain the queues of the first APPS apps only")
+	parser.add_argument("--mode", choices=["purge", "consume"], default="purge")
+	parser.add_argument("--concurrency", type=int, default=200, help="number of queues drained in parallel")
+	parser.add_argument("--prefetch", type=int, default=1000, help="messages in flight per queue (consume mode)")
+	args = parser.parse_args()
+
+	# logging settings:
+	logging.basicConfig(level=logging.INFO)
+
+	# suppress debug messages from other modules used.
+	logging.getLogger("pika").setLevel(logging.WARNING)
+
+	store = registration_store.open_store(args.registration_info)
+	devices = store.entities("device", 0, args.devices)
+	apps = store.entities("app", 0, args.apps)
+	apikeys = store.apikeys(devices + apps)
+	store.close()
+
+	removed = queue_drain.drain_queues(queue_drain.entity_queues(apps, devices), apikeys, mode=args.mode,
+		concurrency=args.concurrency, prefetch=args.prefetch)
+	if None in removed.values():
+		sys.exit(1)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+# Script for managing an entity pool: a fleet of pre-registered devices
+# and apps, divided into blocks that test runs can lease
+# (see /messaging/entity_pool.py).
+#
+# Usage:
+#	./manage_pool.py create --blocks 8 --devices-per-block 1000 --apps-per-block 2
+#	./manage_pool.py status
+#	./manage_pool.py destroy
+#
+# A scenario can then lease a block of the pool with
+# "setup": {"pool": "entity_pool"} (see run_scenario.py).
+
+import sys
+import time
+import argparse
+
+# logging
+import logging
+logger = logging.getLogger(__name__)
+
+sys.path.insert(0, '../messaging')
+import entity_pool
+
+
+if __name__=='__main__':
+
+	parser = argparse.ArgumentParser(description="Manage an entity pool.")
+	parser.add_argument("command", choices=["create", "status", "destroy"])
+	parser.add_argument("--pool", default="entity_pool", help="name of the pool's registration store")
+	parser.add_argument("--blocks", type=int, default=4)
+	parser.add_argument("--devices-per-block", type=int, default=100)
+	parser.add_argument("--apps-per-block", type=int, default=1)
+	parser.add_argument("--concurrency", type=int, default=8, help="number of requests to the middleware in parallel")
+	parser.add_argument("--force", action="store_true", help="destroy the pool even if blocks are leased")
+	args = parser.parse_args()
+
+	# logging settings:
+	logging.basicConfig(level=logging.INFO)
+
+	# suppress debug messages from other modules used.
+	logging.getLogger("requests").setLevel(logging.WARNING)
+	logging.getLogger("urllib3").setLevel(logging.WARNING)
+	logging.getLogger("pika").setLevel(logging.WARNING)
+	logging.getLogger("corinthian_messaging").setLevel(logging.WARNING)
+
+	if args.command == "create":
+		pool = entity_pool.create_pool(args.pool, args.blocks, args.devices_per_block, args.apps_per_block,
+			concurrency=args.concurrency)
+		pool.close()
+	elif args.command == "status":
+		pool = entity_pool.EntityPool(args.pool)
+		leases = pool.status()
+		print("{}: {} blocks of {} devices and {} apps, {} leased".format(
+			args.pool, pool.num_blocks, pool.devices_per_block, pool.apps_per_block, len(leases)))
+		for block, owner, expires in leases:
+			print("  block {}: leased by {} until {}".format(block, owner, time.ctime(expires)))
+		pool.close()
+	else:
+		entity_pool.destroy_pool(args.pool, concurrency=args.concurrency, force=args.force)
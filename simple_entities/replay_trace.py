@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+# Script for replaying a recorded traffic trace through the middleware.
+#
+# The devices in the trace are mapped to pre-registered devices, which
+# publish data and receive commands as given by the trace (with the
+# original inter-arrival times, divided by <speedup>). SimpleApp
+# instances receive the data, and send the commands in the trace.
+# (See /messaging/trace_replay.py for the trace formats.)
+
+import sys
+import time
+
+# logging
+import logging
+logger = logging.getLogger(__name__)
+
+# interfaces for communication with the middleware
+sys.path.insert(0, '../messaging')
+import communication_interface
+import sharded_runner
+import latency
+import stream_checker
+import event_bridge
+import trace_replay
+import registration_store
+
+import simpy
+from simple_app import SimpleApp
+from run_simulation import print_time
+
+
+def replay_trace(registration_info_modulename, trace_path, num_devices, num_apps, speedup=1.0, logging_level=logging.INFO, backend="pool"):
+	"""
+	Replay the trace <trace_path> from <num_devices> devices and <num_apps>
+	apps pre-registered in the registration store "registration_info_modulename",
+	until the end of the trace. (See run_simulation for the backends.)
+	Returns a dict of counters, latency histograms and stream reports
+	(as run_simulation does).
+	"""
+
+	# logging settings:
+	logging.basicConfig(level=logging_level)
+
+	# read the apikeys for pre-registered devices
+	# from the registration store
+	store = registration_store.open_store(registration_info_modulename)
+	assert(num_devices>0 and num_devices<=store.count("device"))
+	assert(num_apps>0 and num_apps<=store.count("app"))
+	devices = store.entities("device", 0, num_devices)
+	apps = store.entities("app", 0, num_apps)
+	registered_entities = store.apikeys(devices + apps)
+	permissions = store.permissions(apps, devices) if backend == "local" else None
+	store.close()
+
+	transport = communication_interface.make_transport(backend, devices, apps, permissions)
+	communication_interface.set_transport(transport)
+	try:
+		real_time = (backend != "local")
+		if real_time:
+			env = event_bridge.WakeableRealtimeEnvironment(factor=1, strict=False)
+		else:
+			env = simpy.Environment()
+
+		app_instances = {}
+		for a in apps:
+			app_instances[a] = SimpleApp(env=env, ID=a, apikey=registered_entities[a])
+
+		replayer = trace_replay.TraceReplayer(env, trace_replay.read_trace(trace_path),
+			devices, registered_entities, app_instances, speedup)
+
+		stats = {"max_overshoot": 0.0}
+		env.process(print_time(env, stats))
+		if real_time:
+			env.sync()
+
+		# run until the whole trace has been replayed,
+		# and then some more for the last messages to arrive.
+		print("Replaying", trace_path, "....")
+		env.run(replayer.behavior_process)
+		env.run(env.now + 1)
+
+		print("Replay ended. Closing all threads...")
+		if real_time:
+			time.sleep(1)
+		replayer.end()
+		for a in app_instances:
+			app_instances[a].end()
+		if real_time:
+			time.sleep(1)
+
+		device_instances = replayer.device_instances
+		counters = sharded_runner.entity_counters(device_instances, app_instances)
+		counters.update(stats)
+		counters["events"] = replayer.count
+		counters.update(latency.collect(device_instances, app_instances))
+		counters.update(stream_checker.collect(device_instances, app_instances))
+		logger.info("Counters: {}".format(counters))
+		latency.log_latencies(counters)
+		stream_checker.log_reports(counters)
+		return counters
+	finally:
+		communication_interface.set_transport(None)
+		if transport is not None:
+			transport.close()
+
+
+if __name__=='__main__':
+
+	# suppress debug messages from other modules used.
+	logging.getLogger("requests").setLevel(logging.WARNING)
+	logging.getLogger("urllib3").setLevel(logging.WARNING)
+	logging.getLogger("pika").setLevel(logging.WARNING)
+	logging.getLogger("simple_app").setLevel(logging.WARNING)
+
+	# usage: ./replay_trace.py <trace file> [<speedup>]
+	assert(len(sys.argv) in (2, 3)), "Usage: {} <trace file> [<speedup>]".format(sys.argv[0])
+	trace_path = sys.argv[1]
+	speedup = float(sys.argv[2]) if len(sys.argv) == 3 else 1.0
+
+	registration_info_modulename = "registration_info"
+	num_devices_to_simulate = 2
+	num_apps_to_simulate = 1
+	replay_trace(registration_info_modulename, trace_path, num_devices_to_simulate, num_apps_to_simulate, speedup)
@@ -8,20 +8,35 @@ import sys
 import simpy
 import simpy.rt
 import time
+import multiprocessing
 import json
 
 # logging
 import logging
 logger = logging.getLogger(__name__)
 
+# interfaces for communication with the middleware
+sys.path.insert(0, '../messaging')
+import communication_interface
+import sharded_runner
+import latency
+import stream_checker
+import recorder
+import lag_monitor
+import event_bridge
+import registration_store
+
 # import the entity models.
 from simple_device import SimpleDevice
 from simple_app import SimpleApp
 from simple_injector import SimpleInjector
 
-# a dummy SimPy process to print simulation time and real time
-def print_time(env):
+# a dummy SimPy process to print simulation time and real time.
+# The maximum overshoot is recorded in stats["max_overshoot"].
+def print_time(env, stats=None):
     start_real_time = time.perf_counter()
+    # real seconds per simulated second
+    factor = getattr(env, "factor", 1)
     max_overshoot = 0.0
     PERIOD = 1
     while True:
@@ -30,62 +45,199 @@ def print_time(env):
         logger.info("SIM_TIME:{} REAL_TIME:{} =================".format(sim_time, elapsed_real_time))
         # check if the real-time overshot simulation time 
         # by more than <PERIOD> seconds.
-        if ( (elapsed_real_time - sim_time) >= float(PERIOD)):
-            overshoot = elapsed_real_time - sim_time
+        if ( (elapsed_real_time - sim_time * factor) >= float(PERIOD)):
+            overshoot = elapsed_real_time - sim_time * factor
             max_overshoot = max(overshoot, max_overshoot)
             logger.warning("Simulation time overshot real-time by {:.3f}s. Max_overshoot so far was {:.3f}s.".format(overshoot,max_overshoot))
+            if stats is not None:
+                stats["max_overshoot"] = max_overshoot
         yield env.timeout(PERIOD)
 
 
-def run_simulation(registration_info_modulename, num_devices, num_apps, simulation_time, logging_level=logging.INFO):
+def run_simulation(registration_info_modulename, num_devices, num_apps, simulation_time, logging_level=logging.INFO, backend="pool", num_shards=1, fleet=False, record_file=None, arrival_process=None, metrics_file=None, fault_schedule=None, factor=1, lease=None):
 	"""
 	Run simulation for <simulation_time> seconds.
 	The logging_level can be logging.DEBUG or logging.INFO etc.
 	
+	The backend used by the entities for communicating with 
+	the middleware can be:
+	    "threads": one connection and one thread per interface.
+	    "pool": a small pool of connections and I/O threads 
+	            shared by all interfaces (see connection_pool.py).
+	    "asyncio": a single asyncio event loop thread serving
+	            all interfaces (see asyncio_engine.py).
+	    "local": an in-process stand-in for the middleware
+	            (see local_broker.py). No middleware is needed
+	            and the simulation runs as fast as possible
+	            (in virtual time) instead of in real-time.
+	
 	This function assumes that all the devices and apps 
 	have been pre-registered with the middleware 
 	and the registration information has been written into 
-	the .py file "registration_info_modulename".
+	the registration store "registration_info_modulename"
+	(see registration_store.open_store).
 	
 	The number of entities <num_devices> and <num_apps>
 	to be used for the simulation needs to be specified
 	as this can be a subset of the total entities registered.
+	
+	With num_shards > 1, the devices and apps are split into 
+	<num_shards> shards and each shard is simulated in its own
+	process (see sharded_runner.py).
+	
+	With fleet=True, the devices are simulated together by a single
+	DeviceFleet (see device_fleet.py) instead of one SimpleDevice each.
+	This needs a shared transport (any backend other than "threads").
+	
+	If <record_file> is specified, the traffic of all the entities
+	is recorded to this file (see recorder.py). With num_shards > 1,
+	each shard writes to <record_file>.<shard name>.
+	
+	In real time, the lag of the simulation behind the wall clock is
+	monitored (see lag_monitor.py). The lag statistics and message counts
+	are appended to <metrics_file> (if specified) every second, with one
+	file per shard as for <record_file>.
+	
+	By default, each device publishes 10 messages, once per second.
+	Alternatively, <arrival_process> can specify a schedule of publish
+	times for the devices (see arrivals.py), as a dict with the name
+	of the "process", the "count" of messages per device (10 by default)
+	and the other arguments of arrivals.schedule(). For example:
+	    {"process": "poisson", "rate": 2.0, "count": 100, "seed": 1}
+	
+	A <fault_schedule> for the fault injector can be specified as a list
+	of faults, such as [{"time": 5, "fraction": 0.1}] for a fault in 10%
+	of the devices at time 5 (see simple_injector.py).
+	
+	In real time, a simulated second takes <factor> seconds
+	of wall-clock time.
+	
+	With a <lease> of entities from an entity pool (see entity_pool.py),
+	the devices and apps are taken from those leased (and the
+	registration store is that of the pool).
+	
+	Returns a dict of counters of the messages sent and received
+	by the entities (see sharded_runner.entity_counters), and
+	histograms of their latencies (see latency.collect) and reports
+	of lost, duplicated and reordered messages (see stream_checker.collect).
+	The latency percentiles and stream reports are logged at the end of the run.
 	"""
 	
 	# logging settings:
 	logging.basicConfig(level=logging_level) 
 	
-	# read the apikeys for pre-registered devices from file  
-	import importlib
-	c = importlib.import_module(registration_info_modulename, package=None)
-	registered_entities = c.registered_entities
+	# the pre-registered devices and apps. 
+	# (Each shard fetches the apikeys of its own entities from the store.)
+	store = registration_store.open_store(registration_info_modulename)
 	
 	# the list of devices and apps used for the simulation
 	# can be a subset of those registered.
-	assert(num_devices>0 and num_devices<=len(c.devices))
-	assert(num_apps>0 and num_apps<=len(c.apps))
 	assert(simulation_time>0)
+	assert(isinstance(simulation_time, int))
+	if lease is not None:
+		assert(num_devices>0 and num_devices<=len(lease.devices))
+		assert(num_apps>0 and num_apps<=len(lease.apps))
+		devices = lease.devices[0:num_devices]
+		apps = lease.apps[0:num_apps]
+	else:
+		assert(num_devices>0 and num_devices<=store.count("device"))
+		assert(num_apps>0 and num_apps<=store.count("app"))
+		devices = store.entities("device", 0, num_devices)
+		apps = store.entities("app", 0, num_apps)
+	
+	# schedules of publish times for the devices, if any
+	# (one schedule for all the devices, split between the shards,
+	# so that the devices of different shards don't publish in lockstep).
+	publish_times = None
+	if arrival_process is not None:
+		import arrivals
+		params = dict(arrival_process)
+		publish_times = arrivals.schedule(params.pop("process"), len(devices), params.pop("count", 10), **params)
 	
-	devices = c.devices[0:num_devices]
-	apps = c.apps[0:num_apps]
+	if num_shards > 1:
+		# entities in different processes can only
+		# communicate via the middleware.
+		assert(backend != "local"), "The local backend cannot be sharded"
+		counters = sharded_runner.run_sharded(simulate, devices, apps, num_shards, logging_level,
+			split_kwargs={"publish_times": publish_times} if publish_times is not None else None,
+			registered_entities=store, controlled_devices=devices,
+			simulation_time=simulation_time, backend=backend, fleet=fleet, record_file=record_file, metrics_file=metrics_file,
+			fault_schedule=fault_schedule, factor=factor)
+	else:
+		permissions = store.permissions(apps, devices) if backend == "local" else None
+		counters = simulate(devices, apps, None, store, devices, simulation_time, backend, permissions, fleet, record_file, publish_times, metrics_file, fault_schedule, factor)
+	store.close()
+	
+	# report the latency percentiles
+	# and the loss and reordering of messages
+	latency.log_latencies(counters)
+	stream_checker.log_reports(counters)
+	return counters
+
+
+def simulate(devices, apps, wait_for_start, registered_entities, controlled_devices, simulation_time, backend="pool", permissions=None, fleet=False, record_file=None, publish_times=None, metrics_file=None, fault_schedule=None, factor=1):
+	"""
+	Create the entities <devices> and <apps> in a SimPy environment
+	and run them for <simulation_time> seconds. Each app controls
+	the devices <controlled_devices>. If specified, wait_for_start()
+	is called once all the entities have been created.
+	The permissions are needed only for the "local" backend.
+	<registered_entities> is a dict of apikeys, or a registration
+	store from which the apikeys of <devices> and <apps> are fetched.
+	<publish_times> are the schedules of publish times of <devices>
+	(one row per device, see arrivals.schedule), if any.
+	(See run_simulation for the other arguments.)
+	Returns a dict of counters.
+	"""
+	
+	if isinstance(registered_entities, registration_store.RegistrationStore):
+		# (a connection of its own, in case this is a forked shard)
+		store = registration_store.RegistrationStore(registered_entities.path)
+		registered_entities = store.apikeys(devices + apps)
+		store.close()
+	
+	# set up the communication backend
+	assert(not (fleet and backend == "threads")), "A DeviceFleet needs a shared transport"
+	transport = communication_interface.make_transport(backend, devices, apps, permissions)
+	communication_interface.set_transport(transport)
+	
+	# record the traffic, if required
+	traffic_recorder = None
+	if record_file is not None:
+		if wait_for_start is not None:
+			# one file per shard
+			record_file += "." + multiprocessing.current_process().name
+		traffic_recorder = recorder.Recorder(record_file)
+	communication_interface.set_recorder(traffic_recorder)
 	
 	# run the simulation
 	try:
 		# create a SimPy Environment:
-		# real-time, but without strict checking:
-		env = simpy.rt.RealtimeEnvironment(factor=1, strict=False)
-		
-		# as-fast-as-possible (non real-time):
-		# env=simpy.Environment()
+		real_time = (backend != "local")
+		if real_time:
+			# real-time, but without strict checking.
+			# (The entities are woken up as soon as messages arrive.)
+			env = event_bridge.WakeableRealtimeEnvironment(factor=factor, strict=False)
+		else:
+			# as-fast-as-possible (non real-time):
+			env=simpy.Environment()
 		
 		device_instances={}
 		app_instances={}
 		
 		# populate the environment with devices.
-		for d in devices:
-		    apikey = registered_entities[d]
-		    device_instance = SimpleDevice(env=env,ID=d,apikey=apikey)
-		    device_instances[d]=device_instance
+		if fleet:
+			# a single fleet for all devices
+			from device_fleet import DeviceFleet
+			apikeys = [registered_entities[d] for d in devices]
+			device_instances["fleet"] = DeviceFleet(env=env,IDs=devices,apikeys=apikeys,
+				publish_times=publish_times)
+		else:
+			for i, d in enumerate(devices):
+			    apikey = registered_entities[d]
+			    device_instance = SimpleDevice(env=env,ID=d,apikey=apikey,
+			        publish_times=publish_times[i] if publish_times is not None else None)
+			    device_instances[d]=device_instance
 		
 		# populate the environment with apps.
 		for a in apps:
@@ -96,45 +248,79 @@ def run_simulation(registration_info_modulename, num_devices, num_apps, simulati
 		# for each app, provide a list of devices that it should control.
 		# it is assumed that each app controls each of the devices.
 		for a in apps:
-			app_instances[a].controlled_devices = devices
+			app_instances[a].controlled_devices = controlled_devices
 		
 		# Create a fault injector 
 		# that injects faults into devices
-		injector = SimpleInjector(env=env,name="Injector")
+		injector = SimpleInjector(env=env,name="Injector",fault_schedule=fault_schedule)
 		injector.device_instances = device_instances
 		
 		# create a dummy simpy process that simply prints the
 		# simulation time and real time.
-		time_printer = env.process(print_time(env))
+		stats = {"max_overshoot": 0.0}
+		time_printer = env.process(print_time(env, stats))
+		
+		# monitor the lag behind the wall clock
+		monitor = None
+		if real_time:
+			if metrics_file is not None and wait_for_start is not None:
+				metrics_file += "." + multiprocessing.current_process().name
+			def metrics():
+				c = sharded_runner.entity_counters(device_instances, app_instances)
+				return dict((k, c[k]) for k in ("published", "received", "commands_sent", "commands_received"))
+			monitor = lag_monitor.LagMonitor(env, metrics_file=metrics_file, metrics=metrics)
+		
+		# wait for the other shards (if any)
+		if wait_for_start is not None:
+			wait_for_start()
 	
 		# sync simpy's internal real-time with the 
 		# wall clock time.
 		#(This is necessary because quite a lot of time 
 		# could have elapsed between the creation of the env object and calling
 		# the run() method on it.)
-		env.sync()
+		if real_time:
+			env.sync()
 
 
 		# run simulation for a specified amount of time
-		assert(simulation_time > 0)
-		assert(isinstance(simulation_time, int))
 		print("Running simulation for",simulation_time,"seconds ....")
 		env.run(simulation_time)
+		if monitor is not None:
+			monitor.stop()
+			stats["scheduler_lag"] = monitor.lag
+			stats["max_scheduler_lag"] = monitor.max_lag
 		
 		# insert a delay here for all simulation
 		# to end before closing the threads.
 		print("Simulation ended. Closing all threads...")
-		time.sleep(1)
+		if real_time:
+			time.sleep(1)
 		# end all subscription threads on all entities
 		for d in device_instances:
 		    device_instances[d].end()
 		for a in app_instances:
 		    app_instances[a].end()
-		time.sleep(1)
+		if real_time:
+			time.sleep(1)
+		
+		counters = sharded_runner.entity_counters(device_instances, app_instances)
+		counters.update(stats)
+		counters.update(latency.collect(device_instances, app_instances))
+		counters.update(stream_checker.collect(device_instances, app_instances))
+		logger.info("Counters: {}".format(counters))
+		return counters
 		
 	except:
 		print("There was an exception")
 		raise
+	finally:
+		communication_interface.set_transport(None)
+		if transport is not None:
+			transport.close()
+		communication_interface.set_recorder(None)
+		if traffic_recorder is not None:
+			traffic_recorder.close()
 
 
 
@@ -156,13 +342,14 @@ if __name__=='__main__':
 	
 	# system description:
 	registration_info_modulename = "registration_info"
-	registration_info_filename = registration_info_modulename+".py"
 	
 	
 	# RUN SIMULATION
 	num_devices_to_simulate = 2
 	num_apps_to_simulate = 1
 	sim_time = 12
-	run_simulation(registration_info_modulename, num_devices_to_simulate, num_apps_to_simulate, sim_time)
+	# number of processes to run the simulation in
+	num_shards = 1
+	run_simulation(registration_info_modulename, num_devices_to_simulate, num_apps_to_simulate, sim_time, num_shards=num_shards)
 		
 	
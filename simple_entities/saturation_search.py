@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+# Benchmark for finding the maximum throughput that the middleware sustains.
+#
+# The offered load is stepped up, and each step is run as a simulation
+# (see run_simulation.py). A step is a number of devices and the rate at
+# which each of them publishes (as a Poisson process), so both the device
+# count and the publish rate can be stepped: by default (see load_steps),
+# the number of devices is stepped up first, and then the rate of all
+# the devices. After each step, the end-to-end
+# latency, the loss and the real-time overshoot of the simulation are
+# checked against thresholds. The search stops at the first step that
+# fails a check (the "knee"), and reports the throughput of the last step
+# that passed as the maximum sustainable throughput.
+#
+# The loss of a step is the larger of:
+#	- the loss rate found by the stream checks (gaps in sequence numbers)
+#	- the fraction of messages published that were not received by
+#	  all the apps (it is assumed that every app reads every device)
+
+import sys
+import math
+
+# logging
+import logging
+logger = logging.getLogger("saturation_search")
+
+sys.path.insert(0, '../messaging')
+from run_simulation import run_simulation
+
+
+def device_steps(start_devices, max_devices, factor=2):
+	""" Device counts from <start_devices> to <max_devices>,
+	growing by <factor> at each step."""
+	assert(start_devices > 0 and factor > 1)
+	steps = []
+	n = start_devices
+	while n < max_devices:
+		steps.append(int(n))
+		n = math.ceil(n * factor)
+	steps.append(max_devices)
+	return steps
+
+
+def rate_steps(start_rate, max_rate, factor=2):
+	""" Publish rates from <start_rate> to <max_rate>,
+	growing by <factor> at each step."""
+	assert(start_rate > 0 and factor > 1)
+	steps = []
+	r = start_rate
+	while r < max_rate:
+		steps.append(r)
+		r = r * factor
+	steps.append(max_rate)
+	return steps
+
+
+def load_steps(start_devices, max_devices, start_rate=1.0, max_rate=None, factor=2):
+	""" Steps (number of devices, rate) of growing offered load: the
+	number of devices grows from <start_devices> to <max_devices>, each
+	device publishing <start_rate> messages per second, and then the rate
+	of the <max_devices> devices grows up to <max_rate> (if given)."""
+	steps = [(n, start_rate) for n in device_steps(start_devices, max_devices, factor)]
+	if max_rate is not None and max_rate > start_rate:
+		steps += [(max_devices, r) for r in rate_steps(start_rate, max_rate, factor)[1:]]
+	return steps
+
+
+def check_step(counters, num_apps, max_p99_latency, max_loss_rate, max_overshoot):
+	""" The results of a step, and the list of checks it failed."""
+	published = counters["published"]
+	received = counters["received"]
+	shortfall = 1.0 - received / float(published * num_apps) if published else 0.0
+	loss_rate = max(counters["data_streams"].summary()["loss_rate"], shortfall)
+	p99 = counters["data_latency"].percentile(99)
+	overshoot = counters.get("max_overshoot", 0.0)
+
+	failed = []
+	if p99 is None or p99 > max_p99_latency:
+		failed.append("latency")
+	if loss_rate > max_loss_rate:
+		failed.append("loss")
+	if overshoot > max_overshoot:
+		failed.append("overshoot")
+	return {"p99_latency": p99, "loss_rate": loss_rate, "max_overshoot": overshoot}, failed
+
+
+def saturation_search(registration_info_modulename, steps, step_time, num_apps=1,
+		max_p99_latency=0.5, max_loss_rate=0.001, max_overshoot=1.0,
+		logging_level=logging.WARNING, backend="pool", num_shards=1, fleet=False):
+	"""
+	Run a simulation of <step_time> seconds for each step (<number of
+	devices>, <rate>) in <steps> (in order of increasing offered load, see
+	load_steps), with each device publishing <rate> messages per second,
+	until a step has a p99 latency above <max_p99_latency>
+	seconds, a loss rate above <max_loss_rate> or a real-time overshoot above
+	<max_overshoot> seconds. (See run_simulation for the other arguments.)
+
+	Returns a dict with the results of each step and
+	"max_throughput": the number of messages per second received
+	(by all apps) in the last step that passed, or None if none did.
+	"""
+	assert(isinstance(step_time, int) and step_time > 0)
+	results = []
+	max_throughput = None
+	for num_devices, rate in steps:
+		count = max(1, int(rate * step_time))
+		logger.info("STEP: {} devices at {} messages/s each, for {} seconds".format(num_devices, rate, step_time))
+		counters = run_simulation(registration_info_modulename, num_devices, num_apps, step_time,
+			logging_level=logging_level, backend=backend, num_shards=num_shards, fleet=fleet,
+			arrival_process={"process": "poisson", "rate": rate, "count": count})
+
+		step, failed = check_step(counters, num_apps, max_p99_latency, max_loss_rate, max_overshoot)
+		step.update({"devices": num_devices,
+			"rate": rate,
+			"offered": num_devices * rate,
+			"published": counters["published"] / float(step_time),
+			"throughput": counters["received"] / float(step_time),
+			"failed": failed})
+		results.append(step)
+		logger.info("STEP: {}".format(step))
+		if failed:
+			logger.info("Knee reached at {} devices publishing {} messages/s each ({} failed).".format(
+				num_devices, rate, ", ".join(failed)))
+			break
+		max_throughput = step["throughput"]
+
+	# summary table
+	logger.info("{:>10} {:>8} {:>12} {:>12} {:>12} {:>10} {:>10}  {}".format(
+		"devices", "rate", "offered/s", "published/s", "received/s", "p99(ms)", "loss", "failed"))
+	for s in results:
+		p99 = "-" if s["p99_latency"] is None else "{:.1f}".format(s["p99_latency"] * 1e3)
+		logger.info("{:>10} {:>8.2f} {:>12.1f} {:>12.1f} {:>12.1f} {:>10} {:>10.4f}  {}".format(
+			s["devices"], s["rate"], s["offered"], s["published"], s["throughput"], p99, s["loss_rate"], ",".join(s["failed"])))
+	logger.info("Maximum sustainable throughput: {} messages/s".format(max_throughput))
+	return {"steps": results, "max_throughput": max_throughput}
+
+
+if __name__=='__main__':
+
+	# logging settings:
+	# (only the results of the steps are logged)
+	logging.basicConfig(level=logging.WARNING)
+	logger.setLevel(logging.INFO)
+
+	registration_info_modulename = "registration_info"
+	import registration_store
+	store = registration_store.open_store(registration_info_modulename)
+	num_registered = store.count("device")
+	store.close()
+
+	# step the number of devices up from 10 to all the registered devices,
+	# each publishing once per second on average, and then the rate
+	# of all the devices up to 16 messages per second.
+	steps = load_steps(10, num_registered, start_rate=1.0, max_rate=16.0)
+	saturation_search(registration_info_modulename, steps, step_time=30, num_apps=1)
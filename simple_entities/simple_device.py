@@ -4,6 +4,11 @@
 # A device publishes data to the middleware 
 # and responds to commands from the middleware.
 #
+# By default, a device publishes 10 messages, once per period.
+# Alternatively, it can publish at the times given by a schedule
+# (publish_times, see /messaging/arrivals.py). Publish times that
+# pass while the device is in the FAULT state are skipped.
+#
 # Author: Neha Karanjkar
 
 import sys
@@ -15,11 +20,12 @@ logger = logging.getLogger(__name__)
 # Interfaces for communication with the middleware
 sys.path.insert(0, '../messaging')
 import communication_interface
+import event_bridge
 
 
 class SimpleDevice(object):
 	
-	def __init__(self, env, ID, apikey):
+	def __init__(self, env, ID, apikey, publish_times=None):
 		self.env = env
 		self.ID = ID         # unique identifier for the device
 		self.apikey = apikey # apikey required for authentication
@@ -29,21 +35,42 @@ class SimpleDevice(object):
 		# interface for publishing data:
 		self.publish_thread = communication_interface.PublishInterface(self.ID, self.apikey)
 		self.publish_count =0
+		self.max_publish_count = 10
+		
+		# optional schedule of publish times (in seconds)
+		# and the index of the next one.
+		self.publish_times = publish_times
+		self.publish_index = 0
 		
 		# interface for receiving commands:
 		self.receive_commands_thread = communication_interface.ReceiveCommandsInterface(self.ID, self.apikey)
+		# triggered when a command arrives
+		self.command_arrived = event_bridge.MessageSignal(self.env, self.receive_commands_thread)
 		    
 		# start a simpy process for the main device behavior
 		self.behavior_process=self.env.process(self.behavior())
 		
+	# does the device have more messages to publish?
+	def publishing(self):
+		if self.publish_times is None:
+			return self.publish_count < self.max_publish_count
+		return self.publish_index < len(self.publish_times)
+	
 	# main behavior of the device:
 	def behavior(self):
-		while (self.publish_count<10): # the main loop.
+		while (self.publishing()): # the main loop.
 			try:
 				#---------------------------
 				# NORMAL STATE
 				#---------------------------
 				if self.state == "NORMAL":
+					if self.publish_times is not None:
+						# wait until the next publish time
+						delay = self.publish_times[self.publish_index] - self.env.now
+						if delay > 0:
+							yield self.env.timeout(delay)
+						self.publish_index +=1
+					
 					# publish sensor data
 					data = json.dumps({"sensor_value": str(self.publish_count)})
 					self.publish_count+=1
@@ -57,7 +84,8 @@ class SimpleDevice(object):
 							logger.debug("SIM_TIME:{} ENTITY:{} received command {}.".format(self.env.now, self.ID, cmd))
 							
 					# wait till the next clock cycle
-					yield self.env.timeout(self.period)
+					if self.publish_times is None:
+						yield self.env.timeout(self.period)
 					
 				#---------------------------
 				# FAULT STATE
@@ -76,11 +104,18 @@ class SimpleDevice(object):
 								assert("command" in cmd["data"])
 								if (cmd["data"]["command"]=="RESUME"):
 									self.resume_command_received=True
-						# wait till the next clock cycle
-						yield self.env.timeout(self.period)
+						if not self.resume_command_received:
+							# wait until a command arrives
+							# (or till the next clock cycle in environments
+							# that messages can't wake up).
+							yield self.command_arrived.wait(self.period)
 					# resume command received.
 					# go back to normal state.
 					self.state="NORMAL"
+					# skip the publish times missed during the fault.
+					if self.publish_times is not None:
+						while self.publishing() and self.publish_times[self.publish_index] < self.env.now:
+							self.publish_index +=1
 					  
 				else:
 					assert(0),"Invalid device state"
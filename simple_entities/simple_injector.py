@@ -4,9 +4,16 @@
 # The injector module injects faults into devices
 # at a predetermined time (via a SimPy interrupt).
 #
+# Optionally, a fault schedule can be specified as a list of faults,
+# each a dict with the "time" (in seconds) of the fault and the "fraction"
+# of the devices to inject it into (all of them by default). The devices
+# are picked at random (with an optional "seed").
+#
 # Author: Neha Karanjkar
 
 import sys
+import math
+import random
 import simpy
 import json
 import logging
@@ -19,9 +26,10 @@ import communication_interface
 
 class SimpleInjector(object):
 	
-	def __init__(self, env, name):
+	def __init__(self, env, name, fault_schedule=None):
 		self.env = env
 		self.name = name     # name of the fault injector
+		self.fault_schedule = fault_schedule
 		
 		# a dictionary of device instaces
 		# to be interrupted.
@@ -31,8 +39,30 @@ class SimpleInjector(object):
 		# start a simpy process for the main behavior
 		self.behavior_process=self.env.process(self.behavior())
 
+	# inject a fault into a <fraction> of the devices
+	def inject(self, fraction=1.0, seed=None):
+		IDs = []
+		for d, instance in self.device_instances.items():
+			IDs += getattr(instance, "IDs", [d])
+		IDs = random.Random(seed).sample(IDs, int(math.ceil(fraction * len(IDs))))
+		selected = set(IDs)
+		for d, instance in self.device_instances.items():
+			if hasattr(instance, "inject_faults"):
+				# a DeviceFleet
+				instance.inject_faults(IDs)
+			elif d in selected and instance.behavior_process.is_alive:
+				instance.behavior_process.interrupt("FAULT")
+		logger.info("SIM_TIME:{} SimpleInjector {} injected a fault into {} devices".format(self.env.now, self.name, len(IDs)))
+
 	 # main behavior:
 	def behavior(self):
+
+		if self.fault_schedule is not None:
+			for fault in sorted(self.fault_schedule, key=lambda f: f["time"]):
+				if fault["time"] > self.env.now:
+					yield self.env.timeout(fault["time"] - self.env.now)
+				self.inject(fault.get("fraction", 1.0), fault.get("seed"))
+			return
 	    
 		# wait until some time T
 		yield self.env.timeout(5)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+# Script for running a test scenario described in a scenario file:
+# the devices and apps are registered (or a fleet registered earlier is
+# reused), the simulation is run once for each point of the parameter
+# sweep, and the devices and apps are deregistered at the end.
+# (See /messaging/scenario.py for the format of scenario files.)
+#
+# Usage:
+#	./run_scenario.py scenario.json
+#	./run_scenario.py scenario.json --set simulation.duration=60 --set simulation.factor=0.5
+#	./run_scenario.py scenario.json --keep-fleet     # no teardown at the end
+
+import sys
+import json
+import argparse
+
+# logging
+import logging
+logger = logging.getLogger(__name__)
+
+sys.path.insert(0, '../messaging')
+import scenario
+from run_simulation import run_simulation
+
+
+def parse_overrides(assignments):
+	""" {<dotted path>: value} for a list of "<dotted path>=<value>".
+	Values are parsed as JSON if possible (and as strings otherwise)."""
+	overrides = {}
+	for a in assignments:
+		key, sep, value = a.partition("=")
+		assert(sep), "Invalid assignment {} (expected <parameter>=<value>)".format(a)
+		try:
+			overrides[key] = json.loads(value)
+		except ValueError:
+			overrides[key] = value
+	return overrides
+
+
+if __name__=='__main__':
+
+	parser = argparse.ArgumentParser(description="Run a test scenario.")
+	parser.add_argument("scenario_file")
+	parser.add_argument("--set", action="append", default=[], metavar="PARAMETER=VALUE",
+		help="override a parameter of the scenario, such as simulation.duration=60")
+	parser.add_argument("--keep-fleet", action="store_true",
+		help="do not deregister the devices and apps at the end (to reuse them)")
+	args = parser.parse_args()
+
+	s = scenario.load(args.scenario_file, parse_overrides(args.set))
+
+	# logging settings:
+	# (the progress of the scenario is always logged)
+	logging.basicConfig(level=getattr(logging, s["simulation"]["logging_level"]))
+	logger.setLevel(logging.INFO)
+	logging.getLogger("scenario").setLevel(logging.INFO)
+
+	# suppress debug messages from other modules used.
+	logging.getLogger("requests").setLevel(logging.WARNING)
+	logging.getLogger("urllib3").setLevel(logging.WARNING)
+	logging.getLogger("pika").setLevel(logging.WARNING)
+	logging.getLogger("corinthian_messaging").setLevel(logging.WARNING)
+	results = scenario.run_scenario(s, run_simulation, teardown=False if args.keep_fleet else None)
+	for r in results:
+		logger.info("RESULT: {}".format(json.dumps(r, default=repr)))
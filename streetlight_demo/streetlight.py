@@ -36,6 +36,7 @@ from string import digits
 # helper class for communication with the middleware
 sys.path.insert(0, '../messaging')
 import communication_interface
+import retention
 DEV_PROTOCOL = "AMQP" # can be either "AMQP" or "HTTP"
 
 
@@ -53,6 +54,7 @@ class Streetlight(object):
         self.DIM_INTENSITY = 0.2            # intensity when light is dimmed
         self.AMBIENT_LIGHT_THRESHOLD = 0.8  # threshold for turning on/off the led
         self.AUTOMATIC_DIM_TIMEOUT = 2      # dim the light automatically after these many periods of inactivity
+        self.MAX_RETAINED_MESSAGES = 100    # number of received messages kept in memory
      
         # max number of messages to be published.
         # set to inf to publish unlimited messages
@@ -84,7 +86,9 @@ class Streetlight(object):
         self.state = "NORMAL"       # state of the device. ("NORMAL"/"FAULT")
         self.published_count = 0    # number of messages sent
         self.subscribed_count= 0    # number of messages received
-        self.received_messages =[]  # list of messages received by the device
+        # messages received by the device
+        # (only the last <MAX_RETAINED_MESSAGES> are kept, see retention.py)
+        self.received_messages = retention.MessageStore(max_per_sender=self.MAX_RETAINED_MESSAGES, key=lambda msg: None)
         
         # start a simpy process for the main device behavior
         self.behavior_process=self.env.process(self.behavior())
@@ -16,10 +16,12 @@ logger = logging.getLogger(__name__)
 # Interfaces for communication with the middleware
 sys.path.insert(0, '../messaging')
 import communication_interface
+import event_bridge
+import retention
 
 class StreetlightApp(object):
 	
-	def __init__(self, env, ID, apikey):
+	def __init__(self, env, ID, apikey, max_retained=10, data_file=None):
 		self.env = env
 		self.ID = ID         # unique identifier for the app
 		self.apikey = apikey # apikey required for authentication
@@ -27,6 +29,8 @@ class StreetlightApp(object):
 		
 		# interface for obtaining data published by devices:
 		self.subscribe_thread = communication_interface.SubscribeInterface(self.ID, self.apikey)
+		# triggered when data arrives
+		self.data_arrived = event_bridge.MessageSignal(self.env, self.subscribe_thread)
 		
 		# interface for sending commands to devices:
 		self.send_commands_thread = communication_interface.SendCommandsInterface(self.ID, self.apikey)
@@ -35,7 +39,10 @@ class StreetlightApp(object):
 		self.controlled_devices=[]
 		    
 		# data collected by the app
-		self.device_data=[]
+		# (only the last <max_retained> messages of each device are kept
+		# in memory. If <data_file> is specified, all the messages are
+		# also written to this file. See retention.py)
+		self.device_data=retention.MessageStore(max_retained, data_file)
 		
 		# start a simpy process for the main app behavior
 		self.behavior_process=self.env.process(self.behavior())
@@ -43,6 +50,11 @@ class StreetlightApp(object):
 
 	def behavior(self):
 		while True:
+			# wait until data arrives.
+			# (In environments that messages can't wake up,
+			# check again every <period> seconds.)
+			yield self.data_arrived.wait(self.period)
+			
 			#receive data published by devices
 			if not self.subscribe_thread.queue.empty():
 				while (not self.subscribe_thread.queue.empty()):
@@ -55,17 +67,16 @@ class StreetlightApp(object):
 						# send a resume command to the device.
 						device_id = msg["sender"]
 						command = json.dumps({"command":"RESUME"})
-						self.send_commands_thread.send_command(device_id,command)
+						self.send_commands_thread.send_command(device_id,command,in_reply_to=msg)
 					else:
 						# store the message
 						self.device_data.append(msg)
-			# now check again sometime later.
-			yield self.env.timeout(self.period)
 	
 	# stop all communication threads
 	def end(self):
 		self.subscribe_thread.stop()
 		self.send_commands_thread.stop()
+		self.device_data.close()
 		logger.info("SIM_TIME:{} ENTITY:{} stopping.".format(self.env.now, self.ID))
 		logger.info("SIM_TIME:{} ENTITY:{} received {} messages in total".format(self.env.now,self.ID, len(self.device_data)))
 
@@ -22,6 +22,7 @@ logger = logging.getLogger(__name__)
 # Interfaces for communication with the middleware
 sys.path.insert(0, '../messaging')
 import communication_interface
+import event_bridge
 
 
 class StreetlightDevice(object):
@@ -44,6 +45,8 @@ class StreetlightDevice(object):
 		
 		# interface for receiving commands:
 		self.receive_commands_thread = communication_interface.ReceiveCommandsInterface(self.ID, self.apikey)
+		# triggered when a command arrives
+		self.command_arrived = event_bridge.MessageSignal(self.env, self.receive_commands_thread)
 		    
 		# start a simpy process for the main device behavior
 		self.behavior_process=self.env.process(self.behavior())
@@ -60,7 +63,7 @@ class StreetlightDevice(object):
 		if(self.ambient_light_level >= 0.8):
 			# Light is OFF during daytime
 			self.led_output_level = 0
-		elif(self.activity_detected == False)
+		elif(self.activity_detected == False):
 			# Light is dimmed at night when no activity is detected
 			self.led_output_level = 0.3
 		else:
@@ -116,8 +119,11 @@ class StreetlightDevice(object):
 								assert("command" in cmd["data"])
 								if (cmd["data"]["command"]=="RESUME"):
 									self.resume_command_received=True
-						# wait till the next clock cycle
-						yield self.env.timeout(self.period)
+						if not self.resume_command_received:
+							# wait until a command arrives
+							# (or till the next clock cycle in environments
+							# that messages can't wake up).
+							yield self.command_arrived.wait(self.period)
 					# resume command received.
 					# go back to normal state.
 					self.state="NORMAL"
@@ -5,10 +5,17 @@
 # faults into devices at predetermined times
 # (via a SimPy interrupt).
 #
+# Optionally, a fault schedule can be specified as a list of faults,
+# each a dict with the "time" (in seconds) of the fault and the "fraction"
+# of the devices to inject it into (all of them by default). The devices
+# are picked at random (with an optional "seed").
+#
 # Author: Neha Karanjkar
 
 from __future__ import print_function 
 import os, sys
+import math
+import random
 import threading
 from queue import Queue
 import simpy
@@ -23,9 +30,10 @@ import communication_interface
 
 class StreetlightInjector(object):
 	
-	def __init__(self, env, name):
+	def __init__(self, env, name, fault_schedule=None):
 		self.env = env
 		self.name = name     # name of the fault injector
+		self.fault_schedule = fault_schedule
 		
 		# a dictionary of device instaces
 		# to be interrupted.
@@ -35,8 +43,23 @@ class StreetlightInjector(object):
 		# start a simpy process for the main behavior
 		self.behavior_process=self.env.process(self.behavior())
 
+	# inject a fault into a <fraction> of the devices
+	def inject(self, fraction=1.0, seed=None):
+		IDs = random.Random(seed).sample(sorted(self.device_instances), int(math.ceil(fraction * len(self.device_instances))))
+		for d in IDs:
+			if self.device_instances[d].behavior_process.is_alive:
+				self.device_instances[d].behavior_process.interrupt("FAULT")
+		logger.info("SIM_TIME:{} StreetlightInjector {} injected a fault into {} devices".format(self.env.now, self.name, len(IDs)))
+
 	 # main behavior:
 	def behavior(self):
+
+		if self.fault_schedule is not None:
+			for fault in sorted(self.fault_schedule, key=lambda f: f["time"]):
+				if fault["time"] > self.env.now:
+					yield self.env.timeout(fault["time"] - self.env.now)
+				self.inject(fault.get("fraction", 1.0), fault.get("seed"))
+			return
 	    
 		# wait until some time T
 		yield self.env.timeout(5)